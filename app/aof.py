@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Callable, List, Tuple
+
+from app import redis_utils
+from .resp_parser import ProtocolError, RespParser
+
+EVERYSEC_PERIOD = 1.0
+WRITE_RETRY_DELAY = 1.0
+REPLAY_READ_SIZE = 1024 * 1024
+
+writer: "AofWriter | None" = None
+
+
+class AofWriter:
+    """
+    Appends the write commands of the replication stream to the append only file, the counterpart of Redis'
+    aof_buf and its background fsync
+
+    Commands are appended to an in-memory buffer under a short lock, a flusher thread hands the whole buffer to
+    the file in one write and fsyncs it according to the appendfsync policy: after every write with "always",
+    about once per second with "everysec", never with "no" (the kernel decides). Offsets count the bytes ever
+    fed, so everything fed while the flusher waits for a write or an fsync goes out with the next one: under
+    load one fsync covers the writes of many clients (group commit). With "always" the replies of a client
+    wait until the offset of its last write is synced, see `wait_synced` and `call_when_synced`.
+
+    Args:
+        path (str): The path of the file, created if missing
+        appendfsync (str): The fsync policy: "always", "everysec" or "no"
+    """
+
+    def __init__(self, path: str, appendfsync: str):
+        self.path = path
+        self.appendfsync = appendfsync
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.buf = bytearray()
+        self.offset = self.written_offset = self.synced_offset = os.fstat(self.fd).st_size
+        self.lock = threading.Lock()
+        self.fed = threading.Condition(self.lock)
+        self.synced = threading.Condition(self.lock)
+        self.callbacks: List[Tuple[int, int, Callable[[], None]]] = []
+        self.callback_seq = itertools.count()
+        self.commands = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.last_fsync = time.monotonic()
+
+    def feed(self, command: bytes) -> int:
+        """
+        Appends an encoded command to the buffer of the flusher
+
+        Args:
+            command (bytes): The command, encoded as a RESP array
+
+        Returns:
+            int: The offset of the file right after the command
+        """
+        with self.lock:
+            self.buf += command
+            self.offset += len(command)
+            self.commands += 1
+            self.fed.notify()
+            return self.offset
+
+    def must_wait(self, offset: int) -> bool:
+        """
+        Checks whether the replies of a client whose last write ended at `offset` must wait for an fsync
+        """
+        return self.appendfsync == "always" and offset > self.synced_offset
+
+    def wait_synced(self, offset: int):
+        """
+        Blocks the calling thread until the file is synced up to `offset`, used by the threaded IO model
+
+        Args:
+            offset (int): The offset returned by feed
+        """
+        with self.lock:
+            while offset > self.synced_offset:
+                self.synced.wait()
+
+    def call_when_synced(self, offset: int, callback: Callable[[], None]) -> bool:
+        """
+        Registers a callback the flusher thread runs once the file is synced up to `offset`, used by the event
+        loop which cannot block
+
+        Args:
+            offset (int): The offset returned by feed
+            callback (Callable[[], None]): The callback, it must be thread safe
+
+        Returns:
+            bool: False if the file is already synced up to `offset`, the callback is not registered then
+        """
+        with self.lock:
+            if offset <= self.synced_offset:
+                return False
+            heapq.heappush(self.callbacks, (offset, next(self.callback_seq), callback))
+            return True
+
+    def run(self):
+        """
+        Loop of the flusher thread: waits for commands, writes everything buffered at once, fsyncs according to
+        the policy and wakes the clients waiting for the synced offset. With "everysec" a write that was not
+        fsynced yet gets its fsync within a second even if no other command comes. A failed write is retried
+        every second, the commands stay buffered meanwhile.
+        """
+        while True:
+            with self.lock:
+                while not self.buf and not self.fsync_due():
+                    self.fed.wait(self.fsync_delay())
+                data, self.buf = self.buf, bytearray()
+                end = self.offset
+            view = memoryview(data)
+            try:
+                while view:
+                    view = view[os.write(self.fd, view):]
+                fsync = self.appendfsync == "always" or (
+                    self.appendfsync == "everysec" and time.monotonic() - self.last_fsync >= EVERYSEC_PERIOD)
+                if fsync:
+                    os.fsync(self.fd)
+                    self.fsyncs += 1
+                    self.last_fsync = time.monotonic()
+            except OSError as e:
+                print(f"Error writing the append only file {self.path}: {e}")
+                with self.lock:
+                    self.buf[:0] = view
+                    self.written_offset = end - len(view)
+                time.sleep(WRITE_RETRY_DELAY)
+                continue
+            ready = []
+            with self.lock:
+                self.writes += bool(data)
+                self.written_offset = end
+                if fsync or self.appendfsync == "no":
+                    self.synced_offset = end
+                    self.synced.notify_all()
+                    while self.callbacks and self.callbacks[0][0] <= end:
+                        ready.append(heapq.heappop(self.callbacks)[2])
+            for callback in ready:
+                callback()
+
+    def fsync_due(self) -> bool:
+        """
+        Checks whether bytes written to the file owe an fsync now: right away with "always" (after a failed
+        fsync), a second after the previous fsync with "everysec"
+        """
+        return self.fsync_delay() == 0
+
+    def fsync_delay(self) -> float | None:
+        """
+        Returns how long the flusher may sleep before the fsync it owes, None if it owes none
+        """
+        if self.appendfsync == "no" or self.written_offset == self.synced_offset:
+            return None
+        if self.appendfsync == "always":
+            return 0
+        return max(self.last_fsync + EVERYSEC_PERIOD - time.monotonic(), 0)
+
+
+def aof_path() -> str:
+    """
+    Returns the path of the append only file, --appendfilename in --dir
+    """
+    return os.path.join(redis_utils.dir, redis_utils.appendfilename)
+
+
+def start():
+    """
+    Opens the append only file for appending and starts its flusher thread, every write command propagated
+    from now on is appended to it
+    """
+    global writer
+    writer = AofWriter(aof_path(), redis_utils.appendfsync)
+    threading.Thread(target=writer.run, daemon=True).start()
+
+
+def load(apply: Callable[[List[bytes]], None]) -> int:
+    """
+    Replays the append only file at startup: the file is read in large chunks and every command is parsed with
+    the RESP parser of the connections and applied, like a replica applies the replication stream.
+
+    A file cut in the middle of a command (a crash during a write) or ending inside MULTI without its EXEC is
+    truncated to the last complete command, or to the MULTI, so the next appends start on a command boundary.
+
+    Args:
+        apply (Callable[[List[bytes]], None]): Runs one parsed command
+
+    Returns:
+        int: The number of commands applied
+    """
+    path = aof_path()
+    parser = RespParser()
+    start = time.perf_counter()
+    applied = 0
+    valid_end = 0
+    multi_start = None
+    try:
+        with open(path, "rb") as aof_file:
+            while data := aof_file.read(REPLAY_READ_SIZE):
+                parser.feed(data)
+                for cmd in parser.commands():
+                    name = cmd[0].lower()
+                    if name == b"multi":
+                        multi_start = valid_end
+                    elif name in (b"exec", b"discard"):
+                        multi_start = None
+                    try:
+                        apply(cmd)
+                    except Exception as e:
+                        print(f"Error occurred while applying {cmd[0]} from the append only file: {e}")
+                    applied += 1
+                    valid_end = parser.consumed()
+    except FileNotFoundError:
+        return 0
+    except ProtocolError as e:
+        print(f"Protocol error in the append only file {path}: {e}")
+    if multi_start is not None:
+        valid_end = multi_start
+    if valid_end < os.path.getsize(path):
+        print(f"Truncating the append only file {path} to its last complete command at {valid_end} bytes")
+        os.truncate(path, valid_end)
+    print(f"Append only file loaded: {applied} commands in {int((time.perf_counter() - start) * 1000)} ms")
+    return applied
@@ -0,0 +1,104 @@
+import threading
+from typing import Callable, Dict, List
+
+blocking_keys: Dict[str, List["BlockedClient"]] = {}
+blocking_lock = threading.Lock()
+
+
+class BlockedClient:
+    """
+    A client blocked until one of some keys receives new data, the counterpart of Redis' blocked.c
+
+    The command that blocks provides two callbacks: `serve` tries to reply with the data available now and
+    returns whether it did, `on_timeout` replies when the timeout fires first. The IO model of the client
+    decides how to wait (see ConnContext.block), nothing polls and nothing is copied while waiting.
+
+    Args:
+        client (ConnContext): The blocked client
+        keys (List[str]): The keys the client waits on
+        serve (Callable[[], bool]): Replies and returns True if the client can be served
+        on_timeout (Callable[[], None]): Replies when the timeout expired
+    """
+    __slots__ = ("client", "keys", "serve", "on_timeout", "timer", "ready", "unblocked")
+
+    def __init__(self, client, keys: List[str], serve: Callable[[], bool], on_timeout: Callable[[], None]):
+        self.client = client
+        self.keys = keys
+        self.serve = serve
+        self.on_timeout = on_timeout
+        self.timer = None
+        self.ready = threading.Event()
+        self.unblocked = False
+
+
+def block_for_keys(client, keys: List[str], timeout_ms: int, serve: Callable[[], bool],
+                   on_timeout: Callable[[], None]):
+    """
+    Blocks a client on keys until `serve` succeeds after one of them was signaled as ready,
+    or until the timeout expires. Inside EXEC a client never blocks, it gets the timeout reply right away.
+
+    Example:
+        block_for_keys(client, ["mystream"], 1000, serve, on_timeout)
+
+    Args:
+        client (ConnContext): The client to block
+        keys (List[str]): The keys to wait on
+        timeout_ms (int): The timeout in milliseconds, 0 to wait forever
+        serve (Callable[[], bool]): Replies and returns True if the client can be served
+        on_timeout (Callable[[], None]): Replies when the timeout expired
+    """
+    if client.deny_blocking:
+        on_timeout()
+        return
+    blocked = BlockedClient(client, list(dict.fromkeys(keys)), serve, on_timeout)
+    with blocking_lock:
+        for key in blocked.keys:
+            blocking_keys.setdefault(key, []).append(blocked)
+    client.block(blocked, timeout_ms)
+
+
+def unblock(blocked: BlockedClient) -> bool:
+    """
+    Removes a blocked client from the waiters of its keys
+
+    Args:
+        blocked (BlockedClient): The blocked client
+
+    Returns:
+        bool: False if it was already unblocked
+    """
+    with blocking_lock:
+        if blocked.unblocked:
+            return False
+        blocked.unblocked = True
+        for key in blocked.keys:
+            waiters = blocking_keys.get(key)
+            if waiters:
+                waiters.remove(blocked)
+                if not waiters:
+                    del blocking_keys[key]
+    return True
+
+
+def signal_key_as_ready(key: str):
+    """
+    Wakes up the clients blocked on a key, called by the commands adding data to it.
+    Clients are woken in the order they blocked.
+
+    Args:
+        key (str): The key that received new data
+    """
+    if key not in blocking_keys:
+        return
+    with blocking_lock:
+        waiters = list(blocking_keys.get(key, ()))
+    for blocked in waiters:
+        blocked.client.wake(blocked)
+
+
+def blocked_clients() -> int:
+    """
+    Returns the number of clients blocked on keys
+    """
+    with blocking_lock:
+        return len({id(blocked) for waiters in blocking_keys.values() for blocked in waiters})
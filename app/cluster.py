@@ -0,0 +1,146 @@
+import hashlib
+import sys
+from typing import Dict, List, Tuple
+
+from app import redis_utils
+from .slots import HASH_SLOTS, key_hash_slot
+
+enabled = False
+nodes: List["ClusterNode"] = []
+myself: "ClusterNode" = None
+slot_owners: List["ClusterNode | None"] = [None] * HASH_SLOTS
+migrating: Dict[int, "ClusterNode"] = {}
+importing: Dict[int, "ClusterNode"] = {}
+
+
+class ClusterNode:
+    """
+    A node of the cluster as configured at startup, its ID is derived from its address so every node of the
+    cluster agrees on it without a cluster bus
+
+    Args:
+        host (str): The address clients connect to
+        port (int): The port clients connect to
+    """
+    __slots__ = ("id", "host", "port")
+
+    def __init__(self, host: str, port: int):
+        self.id = hashlib.sha1(f"{host}:{port}".encode()).hexdigest()
+        self.host = host
+        self.port = port
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+
+def parse_slot_ranges(ranges: str) -> List[Tuple[int, int]]:
+    """
+    Parses a comma separated list of slots and slot ranges
+
+    Example:
+        parse_slot_ranges("0-5460,16000") -> [(0, 5460), (16000, 16000)]
+
+    Args:
+        ranges (str): The slots
+
+    Returns:
+        List[Tuple[int, int]]: The first and last slot of each range
+
+    Raises:
+        ValueError: If a slot is not a number between 0 and 16383
+    """
+    parsed = []
+    for slot_range in ranges.split(","):
+        first, _, last = slot_range.partition("-")
+        first, last = int(first), int(last or first)
+        if not 0 <= first <= last < HASH_SLOTS:
+            raise ValueError(f"Invalid slot range {slot_range}")
+        parsed.append((first, last))
+    return parsed
+
+
+def setup():
+    """
+    Builds the slot ownership table from --cluster-node "<host>:<port>:<slots>" options, the node listening on
+    --port being this one. Without any --cluster-node this node owns every slot. Enables the per-slot key index
+    of the keyspace, so it must run before any key is loaded.
+    """
+    global enabled, myself
+    if not redis_utils.cluster_enabled:
+        return
+    enabled = True
+    for spec in redis_utils.cluster_nodes or [f"127.0.0.1:{redis_utils.port}:0-{HASH_SLOTS - 1}"]:
+        try:
+            host, port, ranges = spec.rsplit(":", 2)
+            node = ClusterNode(host, int(port))
+            slot_ranges = parse_slot_ranges(ranges)
+        except ValueError as e:
+            sys.exit(f"Invalid --cluster-node {spec}: {e}")
+        nodes.append(node)
+        for first, last in slot_ranges:
+            slot_owners[first:last + 1] = [node] * (last - first + 1)
+        if node.port == redis_utils.port:
+            myself = node
+    if myself is None:
+        sys.exit(f"No --cluster-node listens on port {redis_utils.port}")
+    redis_utils.keyspace.slot_keys = [set() for _ in range(HASH_SLOTS)]
+
+
+def node_by_id(node_id: str) -> ClusterNode | None:
+    """
+    Returns the node with the given ID, None if there is none
+    """
+    return next((node for node in nodes if node.id == node_id), None)
+
+
+def slot_ranges_of(node: ClusterNode) -> List[Tuple[int, int]]:
+    """
+    Returns the ranges of consecutive slots a node owns
+
+    Args:
+        node (ClusterNode): The node
+
+    Returns:
+        List[Tuple[int, int]]: The first and last slot of each range, ascending
+    """
+    ranges = []
+    for slot, owner in enumerate(slot_owners):
+        if owner is not node:
+            continue
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1] = (ranges[-1][0], slot)
+        else:
+            ranges.append((slot, slot))
+    return ranges
+
+
+def redirect(keys: List[str], asking: bool) -> str | None:
+    """
+    Checks whether this node serves a command on some keys, like getNodeByQuery of Redis Cluster.
+
+    The keys must share one slot. A slot owned by another node is answered with MOVED, unless the client sent
+    ASKING and the slot is being imported here. A slot being migrated away is still served here for the keys
+    that exist, the client is sent to the target node with ASK when one of the keys is missing.
+
+    Args:
+        keys (List[str]): The keys of the command, at least one
+        asking (bool): Whether the client sent ASKING right before the command
+
+    Returns:
+        str | None: The error to reply, None if the command runs here
+    """
+    slot = key_hash_slot(keys[0])
+    for key in keys[1:]:
+        if key_hash_slot(key) != slot:
+            return "CROSSSLOT Keys in request don't hash to the same slot"
+    owner = slot_owners[slot]
+    if owner is None:
+        return "CLUSTERDOWN Hash slot not served"
+    if owner is not myself:
+        if asking and slot in importing:
+            return None
+        return f"MOVED {slot} {owner.address}"
+    if slot in migrating and any(key not in redis_utils.keyspace.data for key in keys):
+        return f"ASK {slot} {migrating[slot].address}"
+    return None
@@ -0,0 +1,238 @@
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple
+
+from app import aof, blocking, redis_utils, workers
+from .resp_parser import RespParser
+
+READ_BUFFER_SIZE = 64 * 1024
+
+
+@dataclass
+class ConnContext:
+    """
+    Per-connection state shared by every IO model
+
+    Command helpers never send on the socket themselves, they append encoded replies with `write`
+    and the IO model decides when the buffered bytes actually hit the wire by calling `flush`,
+    once per read cycle so a pipeline of commands costs a single send. Output written from another
+    connection, like the replication stream, is sent with `schedule_flush` instead so the writer never
+    waits for this peer.
+
+    A client inside MULTI has its queue of validated commands in `multi`, and the keys it WATCHes with the
+    version they had in `watched`, the commands propagated while its EXEC runs wait in `propagated`. With
+    --workers, the commands of the client owned by other workers wait in `forward_queue` until a reply has to be
+    written, so a pipeline is forwarded in a few round trips, and `from_worker` tells the connections of the
+    other workers apart.
+
+    Args:
+        id (int): The file descriptor of the connection
+        conn (socket.socket): The socket representing the connection
+        addr (str): The address of the client for IP sockets
+    """
+    id: int
+    conn: socket.socket
+    addr: str = ""
+    parser: RespParser = field(default_factory=RespParser, repr=False)
+    out_buf: bytearray = field(default_factory=bytearray, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    closing: bool = False
+    soft_limit_since: float = 0.0
+    replica: "replication.Replica" = None
+    woff: int = 0
+    aof_off: int = 0
+    from_master: bool = False
+    send_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    writer_wakeup: threading.Event = field(default_factory=threading.Event, repr=False)
+    writer: threading.Thread = None
+    multi: list = None
+    multi_error: bool = False
+    asking: bool = False
+    watched: dict = field(default_factory=dict, repr=False)
+    deny_blocking: bool = False
+    held_stripes: list = None
+    propagated: list = None
+    forward_queue: list = field(default_factory=list, repr=False)
+    forward_queue_bytes: int = 0
+    from_worker: bool = False
+
+    def write(self, data: bytes, force: bool = False):
+        """
+        Appends an encoded reply to the output buffer of the connection.
+        Replies to a connection scheduled for closing are dropped, and so are the replies to the commands
+        a replica applies from its master unless forced (REPLCONF ACK).
+
+        Args:
+            data (bytes): The encoded reply
+            force (bool, optional): Whether to write to the master link too. Defaults to False.
+        """
+        if self.forward_queue:
+            self.flush_forwarded()
+        with self.lock:
+            if self.closing or (self.from_master and not force):
+                return
+            self.out_buf += data
+            self.check_output_buffer_limit()
+
+    def forward(self, commands: List[Tuple[int, list]], merge: Callable[[List[bytes]], bytes] = b"".join):
+        """
+        Queues commands owned by other workers, their replies are merged into one reply appended in order by
+        flush_forwarded
+
+        Args:
+            commands (List[Tuple[int, list]]): The index of the owning worker and the parsed message array, for each
+                command
+            merge (Callable[[List[bytes]], bytes], optional): Builds the reply of the client from the replies of
+                the commands. Defaults to concatenating them.
+        """
+        self.forward_queue.append((commands, merge))
+        self.forward_queue_bytes += sum(sum(map(len, message_arr)) + 16 * len(message_arr)
+                                        for _, message_arr in commands)
+        if self.forward_queue_bytes >= workers.FORWARD_BATCH_BYTES:
+            self.flush_forwarded()
+
+    def flush_forwarded(self):
+        """
+        Runs the queued commands on their workers and appends their replies to the output buffer, called
+        before any other reply is written and by the IO model once every command of a read has run
+        """
+        queue, self.forward_queue, self.forward_queue_bytes = self.forward_queue, [], 0
+        if not queue:
+            return
+        replies = iter(workers.forward([command for commands, _ in queue for command in commands]))
+        with self.lock:
+            if self.closing:
+                return
+            for commands, merge in queue:
+                self.out_buf += merge([next(replies) for _ in commands])
+            self.check_output_buffer_limit()
+
+    def check_output_buffer_limit(self):
+        """
+        Schedules the connection for closing when its pending output overcomes the client output buffer
+        limit, so a client that never reads its replies cannot make the server grow without bounds.
+        Must be called with the lock held.
+        """
+        if self.replica is not None:
+            hard_limit, soft_limit, soft_seconds = redis_utils.replica_output_buffer_limit
+        else:
+            hard_limit, soft_limit, soft_seconds = redis_utils.client_output_buffer_limit
+        used = len(self.out_buf)
+        if hard_limit and used > hard_limit:
+            self.close_asap()
+        elif soft_limit and used > soft_limit:
+            now = time.monotonic()
+            if not self.soft_limit_since:
+                self.soft_limit_since = now
+            elif now - self.soft_limit_since > soft_seconds:
+                self.close_asap()
+        else:
+            self.soft_limit_since = 0.0
+
+    def close_asap(self):
+        """
+        Drops the pending output and flags the connection so the IO model closes it on the next flush.
+        The socket is shut down right away, a thread stuck sending to a peer that stopped reading returns.
+        Must be called with the lock held.
+        """
+        print(f"Client {self.addr} scheduled to be closed ASAP for overcoming of output buffer limits.")
+        self.closing = True
+        self.out_buf.clear()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def wait_drained(self, limit: int):
+        """
+        Blocks until at most `limit` bytes of output are pending, the backpressure of large transfers
+        like the snapshot sent to a replica. Flushing is blocking in the threaded IO model, so this only flushes.
+
+        Args:
+            limit (int): The number of pending bytes to wait for
+        """
+        self.flush()
+
+    def flush(self):
+        """
+        Sends everything buffered so far, blocking until the socket accepted all of it.
+        Used by the threaded IO model where every connection owns its own thread.
+
+        The buffer is swapped out under the lock and sent without it, so other threads keep appending
+        while a send waits for a slow peer. The send lock keeps concurrent flushes in order.
+        With appendfsync always, replies wait until the last write of the client reached the disk.
+        """
+        if aof.writer is not None and aof.writer.must_wait(self.aof_off):
+            aof.writer.wait_synced(self.aof_off)
+        with self.send_lock:
+            with self.lock:
+                if not self.out_buf:
+                    return
+                data, self.out_buf = self.out_buf, bytearray()
+            self.conn.sendall(data)
+
+    def schedule_flush(self):
+        """
+        Sends the output buffer in the background, the caller never blocks on the peer.
+        A writer thread owned by the connection wakes up and sends everything appended until then in one
+        go, so commands written while a send is in flight are coalesced into the next one.
+        """
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                    self.writer.start()
+        self.writer_wakeup.set()
+
+    def _write_loop(self):
+        while self.conn.fileno() != -1 and not self.closing:
+            if not self.writer_wakeup.wait(1):
+                continue
+            self.writer_wakeup.clear()
+            try:
+                self.flush()
+            except OSError:
+                return
+
+    def block(self, blocked: "blocking.BlockedClient", timeout_ms: int):
+        """
+        Waits until the blocked client is served or its timeout expires.
+        Used by the threaded IO model, where blocking the connection thread blocks nobody else.
+        The keyspace lock stripes taken to run the command are released while waiting and taken again to serve.
+
+        Args:
+            blocked (blocking.BlockedClient): The registered blocked client
+            timeout_ms (int): The timeout in milliseconds, 0 to wait forever
+        """
+        deadline = time.monotonic() + timeout_ms / 1000 if timeout_ms else None
+        locks = redis_utils.keyspace.locks
+        try:
+            while True:
+                blocked.ready.clear()
+                if blocked.serve():
+                    return
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    blocked.on_timeout()
+                    return
+                locks.release(self.held_stripes)
+                try:
+                    ready = blocked.ready.wait(remaining)
+                finally:
+                    locks.acquire(self.held_stripes)
+                if not ready:
+                    blocked.on_timeout()
+                    return
+        finally:
+            blocking.unblock(blocked)
+
+    def wake(self, blocked: "blocking.BlockedClient"):
+        """
+        Tells a blocked client one of its keys got new data, it tries to serve itself on its own thread
+
+        Args:
+            blocked (blocking.BlockedClient): The blocked client
+        """
+        blocked.ready.set()
@@ -0,0 +1,605 @@
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Tuple
+
+from app import aof, blocking, redis_utils, replication, workers
+from .connection import READ_BUFFER_SIZE, ConnContext
+from .resp_encoder import encode_command, write_error
+from .resp_parser import ProtocolError
+from .routes import choose_argument_and_send_output, decode_command, is_blocking_command, unwatch_all_keys
+
+
+class ForwardedReply:
+    """
+    A reply of a client of the event loop that comes from other workers: the replies of one or more forwarded
+    commands, merged into one once the last of them arrived. The replies written meanwhile by the commands
+    running on this worker wait behind it as complete ForwardedReply, so the client gets its replies in order.
+
+    Args:
+        count (int): The number of forwarded commands
+        merge (Callable[[List[bytes]], bytes]): Builds the reply from the replies of the commands
+        data (bytes, optional): The reply of a command that ran here. Defaults to None.
+    """
+    __slots__ = ("replies", "missing", "merge", "data")
+
+    def __init__(self, count: int, merge: Callable[[List[bytes]], bytes], data: bytes = None):
+        self.replies = [None] * count
+        self.missing = count
+        self.merge = merge
+        self.data = data
+
+    def set(self, index: int, reply: bytes):
+        """
+        Stores the reply of the forwarded command at `index`, merges the replies once they all arrived
+        """
+        self.replies[index] = reply
+        self.missing -= 1
+        if not self.missing:
+            self.data = self.merge(self.replies)
+            self.replies = None
+
+
+@dataclass
+class LoopConnContext(ConnContext):
+    """
+    Connection context of the event loop IO model
+
+    The socket is non-blocking, so a flush only sends what the kernel accepts right now and asks the
+    loop to wait for writability when something is left over. With --workers, the commands owned by other
+    workers are sent right away over the peer links of the loop and the client keeps running its next
+    commands, the replies wait in `pending` until the ones forwarded before them arrived.
+    """
+    loop: "EventLoop" = None
+    events: int = 0
+    blocked: bool = False
+    blocked_on_keys: "blocking.BlockedClient" = None
+    drain_limit: int = 0
+    flush_scheduled: bool = False
+    aof_waiting: bool = False
+    drained: threading.Event = field(default_factory=threading.Event, repr=False)
+    pending: Deque[ForwardedReply] = field(default_factory=collections.deque, repr=False)
+
+    def write(self, data: bytes, force: bool = False):
+        """
+        Appends an encoded reply to the output buffer of the connection, or behind the forwarded replies
+        the client still waits for
+
+        Args:
+            data (bytes): The encoded reply
+            force (bool, optional): Whether to write to the master link too. Defaults to False.
+        """
+        with self.lock:
+            if self.closing or (self.from_master and not force):
+                return
+            if self.pending:
+                self.pending.append(ForwardedReply(0, None, data))
+                return
+            self.out_buf += data
+            self.check_output_buffer_limit()
+
+    def forward(self, commands: List[Tuple[int, list]], merge: Callable[[List[bytes]], bytes] = b"".join):
+        """
+        Sends commands owned by other workers without waiting for their replies, must be called from the
+        loop thread. Their replies are merged into one reply, appended once it and every reply before it
+        arrived (see deliver_forwarded).
+
+        Args:
+            commands (List[Tuple[int, list]]): The index of the owning worker and the parsed message array, for each
+                command
+            merge (Callable[[List[bytes]], bytes], optional): Builds the reply of the client from the replies of
+                the commands. Defaults to concatenating them.
+        """
+        reply = ForwardedReply(len(commands), merge)
+        with self.lock:
+            self.pending.append(reply)
+        for index, (worker, message_arr) in enumerate(commands):
+            try:
+                self.loop.peer(worker).send(encode_command(message_arr), self, reply, index)
+            except OSError as e:
+                reply.set(index, workers.unreachable_error(worker, e))
+        if not reply.missing:
+            self.deliver_forwarded()
+
+    def deliver_forwarded(self):
+        """
+        Moves the replies at the head of `pending` that are complete to the output buffer, the flush is
+        left to the caller
+        """
+        with self.lock:
+            while self.pending and not self.pending[0].missing:
+                data = self.pending.popleft().data
+                if not self.closing:
+                    self.out_buf += data
+            self.check_output_buffer_limit()
+
+    def wait_drained(self, limit: int):
+        """
+        Blocks the calling thread, never the loop thread, until at most `limit` bytes of output are pending
+        or the connection is closed
+
+        Args:
+            limit (int): The number of pending bytes to wait for
+        """
+        self.drain_limit = limit
+        self.drained.clear()
+        self.flush()
+        self.drained.wait()
+
+    def flush(self):
+        """
+        Sends as much of the output buffer as the socket accepts without blocking.
+        Flushes requested from another thread are handed over to the loop thread. With appendfsync always
+        nothing is sent until the last write of the client reached the disk, the flusher thread of the AOF
+        schedules the flush then, so the loop keeps serving the other clients meanwhile.
+        """
+        if threading.get_ident() != self.loop.thread_id:
+            self.loop.call_soon_threadsafe(self.flush)
+            return
+        if self.closing:
+            self.loop.close_client(self)
+            return
+        if aof.writer is not None and aof.writer.must_wait(self.aof_off):
+            if not self.aof_waiting:
+                self.aof_waiting = True
+                if not aof.writer.call_when_synced(self.aof_off, self._aof_synced):
+                    self.aof_waiting = False
+                    self.flush()
+            return
+        with self.lock:
+            if self.out_buf:
+                try:
+                    sent = self.conn.send(self.out_buf)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self.out_buf.clear()
+                    sent = 0
+                del self.out_buf[:sent]
+            if len(self.out_buf) <= self.drain_limit:
+                self.drained.set()
+        self.loop.update_interest(self)
+
+    def _aof_synced(self):
+        self.aof_waiting = False
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        Flushes on the loop thread once the current loop iteration is done, whatever thread asks, so
+        everything written to the connection meanwhile goes out with a single send
+        """
+        if self.flush_scheduled:
+            return
+        self.flush_scheduled = True
+        self.loop.call_soon_threadsafe(self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self.flush_scheduled = False
+        self.flush()
+
+    def block(self, blocked: "blocking.BlockedClient", timeout_ms: int):
+        """
+        Stops processing commands of the connection until the blocked client is served or times out.
+        Returns right away, the loop keeps serving the other clients meanwhile.
+
+        Args:
+            blocked (blocking.BlockedClient): The registered blocked client
+            timeout_ms (int): The timeout in milliseconds, 0 to wait forever
+        """
+        self.blocked = True
+        self.blocked_on_keys = blocked
+        if timeout_ms:
+            blocked.timer = self.loop.call_later(timeout_ms / 1000, self._block_timeout, blocked)
+
+    def wake(self, blocked: "blocking.BlockedClient"):
+        """
+        Serves the blocked client if its keys hold what it waits for, on the loop thread once the command
+        signaling the key is done, so the stripes of the blocked keys are never taken while it holds its own
+
+        Args:
+            blocked (blocking.BlockedClient): The blocked client
+        """
+        self.loop.call_soon_threadsafe(self._serve_blocked, blocked)
+
+    def _serve_blocked(self, blocked: "blocking.BlockedClient"):
+        with redis_utils.keyspace.locks.hold(blocked.keys):
+            if not blocked.unblocked and blocked.serve():
+                self.unblock(blocked)
+
+    def _block_timeout(self, blocked: "blocking.BlockedClient"):
+        if not blocked.unblocked:
+            blocked.on_timeout()
+            self.unblock(blocked)
+
+    def unblock(self, blocked: "blocking.BlockedClient"):
+        """
+        Unregisters the blocked client and resumes processing the commands of the connection
+
+        Args:
+            blocked (blocking.BlockedClient): The blocked client
+        """
+        if not blocking.unblock(blocked):
+            return
+        if blocked.timer:
+            blocked.timer.cancel()
+        self.blocked_on_keys = None
+        self.loop.call_soon_threadsafe(self.loop._resume, self)
+
+
+class TimerHandle:
+    """
+    A callback scheduled with EventLoop.call_later, cancelled timers stay in the heap and are skipped
+    """
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback: Callable, args: tuple):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PeerLink:
+    """
+    Non-blocking connection of the event loop to the Unix socket of another worker, registered with the selector
+    like the clients. The commands forwarded during a loop iteration are sent together once it is done, the
+    replies are matched in order with the clients waiting for them as they arrive, so the loop never waits
+    for a worker and two workers forwarding to each other never wait on one another.
+
+    Args:
+        loop (EventLoop): The event loop
+        worker (int): The index of the worker
+
+    Raises:
+        OSError: If the worker cannot be reached
+    """
+
+    def __init__(self, loop: "EventLoop", worker: int):
+        self.loop = loop
+        self.worker = worker
+        self.conn = workers.connect_peer(worker)
+        self.conn.setblocking(False)
+        self.out_buf = bytearray()
+        self.reader = workers.ReplyReader()
+        self.waiting: Deque[Tuple[LoopConnContext, ForwardedReply, int]] = collections.deque()
+        self.flush_scheduled = False
+        self.events = selectors.EVENT_READ
+        loop.selector.register(self.conn, self.events, self)
+
+    def send(self, command: bytes, client: LoopConnContext, reply: ForwardedReply, index: int):
+        """
+        Queues a forwarded command, its reply is stored at `index` of `reply` once it arrives
+
+        Args:
+            command (bytes): The encoded command
+            client (LoopConnContext): The client the command comes from
+            reply (ForwardedReply): The reply the client waits for
+            index (int): The index of the command in the reply
+        """
+        self.out_buf += command
+        self.waiting.append((client, reply, index))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        Sends as much of the forwarded commands as the socket accepts without blocking, the loop waits for
+        writability when something is left over
+        """
+        self.flush_scheduled = False
+        if self.conn.fileno() == -1:
+            return
+        try:
+            sent = self.conn.send(self.out_buf)
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            self.fail(e)
+            return
+        del self.out_buf[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.out_buf else 0)
+        if events != self.events:
+            self.loop.selector.modify(self.conn, events, self)
+            self.events = events
+
+    def read(self):
+        """
+        Reads the replies available and hands every complete one to the client waiting for it, the clients
+        whose next reply is complete then are flushed
+        """
+        try:
+            data = self.conn.recv(READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(e)
+            return
+        if not data:
+            self.fail(ConnectionError("Worker connection closed"))
+            return
+        ready: Dict[int, LoopConnContext] = {}
+        for forwarded_reply in self.reader.feed(data):
+            client, reply, index = self.waiting.popleft()
+            reply.set(index, forwarded_reply)
+            if not reply.missing:
+                ready[id(client)] = client
+        for client in ready.values():
+            client.deliver_forwarded()
+            client.flush()
+
+    def fail(self, error: OSError):
+        """
+        Closes the link and replies with an error to every command still waiting for its reply, the next
+        command forwarded to the worker connects again
+        """
+        self.loop.selector.unregister(self.conn)
+        self.conn.close()
+        if self.loop.peers.get(self.worker) is self:
+            del self.loop.peers[self.worker]
+        error_reply = workers.unreachable_error(self.worker, error)
+        ready: Dict[int, LoopConnContext] = {}
+        while self.waiting:
+            client, reply, index = self.waiting.popleft()
+            reply.set(index, error_reply)
+            if not reply.missing:
+                ready[id(client)] = client
+        for client in ready.values():
+            client.deliver_forwarded()
+            client.flush()
+
+
+class EventLoop:
+    """
+    Single-threaded selectors based event loop multiplexing every client connection
+
+    Commands run on the loop thread and write into the per-connection output buffers, the loop flushes
+    them once every command parsed from the current read has run. A client blocked on keys (XREAD BLOCK) is
+    simply not processed until a write to one of its keys or a timer serves it, WAIT runs on a helper thread.
+    Either way the loop stops reading from that connection, so it never stalls the other clients.
+    With --workers, the commands forwarded to other workers go through one non-blocking PeerLink per worker.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.thread_id = None
+        self._callbacks: Deque[Tuple[Callable, tuple]] = collections.deque()
+        self._timers: List[Tuple[float, int, TimerHandle]] = []
+        self._timer_seq = itertools.count()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.peers: Dict[int, PeerLink] = {}
+
+    def call_soon(self, callback: Callable, *args):
+        """
+        Schedules a callback to run on the loop thread once the current loop iteration is done, must be called
+        from the loop thread
+
+        Args:
+            callback (Callable): The function to run
+            *args: The arguments to pass to the function
+        """
+        self._callbacks.append((callback, args))
+
+    def call_soon_threadsafe(self, callback: Callable, *args):
+        """
+        Schedules a callback to run on the loop thread, safe to call from any thread
+
+        Args:
+            callback (Callable): The function to run
+            *args: The arguments to pass to the function
+        """
+        self._callbacks.append((callback, args))
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def call_later(self, delay: float, callback: Callable, *args) -> TimerHandle:
+        """
+        Schedules a callback to run on the loop thread after the given delay, must be called from the loop thread
+
+        Args:
+            delay (float): The delay in seconds
+            callback (Callable): The function to run
+            *args: The arguments to pass to the function
+
+        Returns:
+            TimerHandle: The handle to cancel the timer with
+        """
+        handle = TimerHandle(callback, args)
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), handle))
+        return handle
+
+    def call_every(self, period: float, callback: Callable):
+        """
+        Runs a callback on the loop thread every period seconds, e.g. the active expire cycle
+
+        Args:
+            period (float): The period in seconds
+            callback (Callable): The function to run
+        """
+        def run_periodic():
+            callback()
+            self.call_later(period, run_periodic)
+
+        self.call_later(period, run_periodic)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, handle = heapq.heappop(self._timers)
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+    def peer(self, worker: int) -> PeerLink:
+        """
+        Returns the link to another worker, connecting it on first use
+
+        Args:
+            worker (int): The index of the worker
+
+        Returns:
+            PeerLink: The link
+
+        Raises:
+            OSError: If the worker cannot be reached
+        """
+        link = self.peers.get(worker)
+        if link is None:
+            link = self.peers[worker] = PeerLink(self, worker)
+        return link
+
+    def update_interest(self, client: LoopConnContext):
+        """
+        Registers the connection for the events it currently needs: readable unless a blocking
+        command is in flight, writable while output is pending.
+
+        Args:
+            client (LoopConnContext): The connection to update
+        """
+        if client.conn.fileno() == -1:
+            return
+        events = 0 if client.blocked else selectors.EVENT_READ
+        if client.out_buf:
+            events |= selectors.EVENT_WRITE
+        if events == client.events:
+            return
+        if client.events == 0:
+            self.selector.register(client.conn, events, client)
+        elif events == 0:
+            self.selector.unregister(client.conn)
+        else:
+            self.selector.modify(client.conn, events, client)
+        client.events = events
+
+    def run(self, server_socket: socket.socket):
+        """
+        Runs the loop forever, accepting clients on the given listening socket
+
+        Args:
+            server_socket (socket.socket): The listening server socket
+        """
+        self.thread_id = threading.get_ident()
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup_r)
+        while True:
+            timeout = max(self._timers[0][0] - time.monotonic(), 0) if self._timers else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self._accept(server_socket)
+                elif key.data is self._wakeup_r:
+                    self._drain_wakeup()
+                elif isinstance(key.data, PeerLink):
+                    if mask & selectors.EVENT_WRITE:
+                        key.data.flush()
+                    if mask & selectors.EVENT_READ:
+                        key.data.read()
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        key.data.flush()
+                    if mask & selectors.EVENT_READ:
+                        self._read(key.data)
+            while self._callbacks:
+                callback, args = self._callbacks.popleft()
+                callback(*args)
+            self._run_timers()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _accept(self, server_socket: socket.socket):
+        try:
+            client_socket, addr = server_socket.accept()
+        except BlockingIOError:
+            return
+        print(f"Accepted connection from {addr}")
+        client_socket.setblocking(False)
+        client = LoopConnContext(client_socket.fileno(), client_socket, addr, loop=self)
+        self.update_interest(client)
+
+    def close_client(self, client: LoopConnContext):
+        """
+        Unregisters and closes the connection, used on EOF, errors and overcome output buffer limits
+
+        Args:
+            client (LoopConnContext): The connection to close
+        """
+        if client.events:
+            self.selector.unregister(client.conn)
+            client.events = 0
+        if client.blocked_on_keys:
+            blocking.unblock(client.blocked_on_keys)
+            client.blocked_on_keys = None
+        replication.remove_replica(client)
+        unwatch_all_keys(client)
+        client.conn.close()
+        client.drained.set()
+
+    def _read(self, client: LoopConnContext):
+        try:
+            data: bytes = client.conn.recv(READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close_client(client)
+            return
+        client.parser.feed(data)
+        self._process(client)
+
+    def _process(self, client: LoopConnContext):
+        """
+        Runs every complete command buffered by the parser of the connection and flushes all replies at
+        once. Stops when a command blocks the client, WAIT is handed to a helper thread, and resumes
+        processing once it is unblocked.
+        """
+        try:
+            for cmd in client.parser.commands():
+                msg_arr = decode_command(cmd)
+                if client.multi is None and is_blocking_command(msg_arr):
+                    client.blocked = True
+                    threading.Thread(target=self._run_blocking, args=(client, msg_arr), daemon=True).start()
+                    break
+                choose_argument_and_send_output(msg_arr, len(msg_arr), client)
+                if client.closing or client.blocked:
+                    break
+        except ProtocolError as e:
+            client.write(write_error(bytearray(), f"ERR Protocol error: {e}"))
+            client.flush()
+            self.close_client(client)
+            return
+        except Exception as e:
+            print(f"Error occurred while handling client: {e}")
+            client.flush()
+            self.close_client(client)
+            return
+        client.flush()
+
+    def _run_blocking(self, client: LoopConnContext, msg_arr):
+        try:
+            choose_argument_and_send_output(msg_arr, len(msg_arr), client)
+        except Exception as e:
+            print(f"Error occurred while handling client: {e}")
+        self.call_soon_threadsafe(self._resume, client)
+
+    def _resume(self, client: LoopConnContext):
+        client.blocked = False
+        client.flush()
+        if client.conn.fileno() != -1:
+            self._process(client)
@@ -0,0 +1,77 @@
+import heapq
+import threading
+import time
+
+from app import redis_utils
+from .keyspace import now_ms
+
+ACTIVE_EXPIRE_CYCLE_SLOW_TIME_PERC = 25
+ACTIVE_EXPIRE_CYCLE_KEYS_PER_CHECK = 16
+
+expired_time_cap_reached_count = 0
+
+
+def active_expire_cycle(time_limit_ms: float | None = None) -> int:
+    """
+    Deletes keys whose expire time passed, soonest first, without exceeding a CPU budget.
+
+    The expires heap makes every popped entry either an expired key or a stale entry, so no time is spent
+    sampling keys that are still alive. The clock is only read every few keys, and the cycle gives up once
+    it used its budget, by default 25% of the cron period like Redis' activeExpireCycle. Each key is checked and
+    deleted holding only its own lock stripe, dropped before the next key, and the expires heap lock is never
+    held while waiting for a stripe, so commands on other keys keep running during the cycle.
+    Nothing is expired while the RDB file is still loading.
+
+    Args:
+        time_limit_ms (float | None, optional): The time budget of the cycle. Defaults to 25% of 1000/hz.
+
+    Returns:
+        int: The number of keys deleted
+    """
+    global expired_time_cap_reached_count
+    if redis_utils.loading:
+        return 0
+    keyspace = redis_utils.keyspace
+    expires_heap = keyspace.expires_heap
+    if time_limit_ms is None:
+        time_limit_ms = 1000 / redis_utils.hz * ACTIVE_EXPIRE_CYCLE_SLOW_TIME_PERC / 100
+    start = time.perf_counter()
+    now = now_ms()
+    deleted = 0
+    checked = 0
+    locks = keyspace.locks
+    while True:
+        with keyspace.expires_lock:
+            if not expires_heap or expires_heap[0][0] > now:
+                break
+            when_ms, key = heapq.heappop(expires_heap)
+        stripes = locks.stripes_for([key])
+        locks.acquire(stripes)
+        try:
+            if keyspace.expires.get(key) == when_ms:
+                keyspace.expire(key)
+                deleted += 1
+        finally:
+            locks.release(stripes)
+        checked += 1
+        if checked % ACTIVE_EXPIRE_CYCLE_KEYS_PER_CHECK == 0:
+            if (time.perf_counter() - start) * 1000 > time_limit_ms:
+                expired_time_cap_reached_count += 1
+                break
+    return deleted
+
+
+def active_expire_loop():
+    """
+    Runs the active expire cycle hz times per second, used by the threaded IO model
+    """
+    while True:
+        time.sleep(1 / redis_utils.hz)
+        active_expire_cycle()
+
+
+def start_active_expire_thread():
+    """
+    Starts the background thread running the active expire cycle
+    """
+    threading.Thread(target=active_expire_loop, daemon=True).start()
@@ -0,0 +1,562 @@
+import contextlib
+import heapq
+import itertools
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+from .slots import key_hash_slot
+
+DICT_ENTRY_SIZE = 3 * 8
+MEMORY_USAGE_SAMPLES = 5
+MAX_INT_ENCODED_LEN = 20
+DEFAULT_LOCK_STRIPES = 16
+
+
+def now_ms() -> int:
+    """
+    Returns the monotonic clock in milliseconds, the time base of every expire
+
+    Returns:
+        int: The current monotonic time in milliseconds
+    """
+    return time.monotonic_ns() // 1_000_000
+
+
+def unix_time_ms(when_ms: int) -> int:
+    """
+    Converts an expire time of the monotonic clock to unix time in milliseconds, the form expires are
+    propagated in so they survive a restart and do not depend on the clock of the master
+
+    Args:
+        when_ms (int): The monotonic time in milliseconds
+
+    Returns:
+        int: The unix time in milliseconds
+    """
+    return when_ms - now_ms() + time.time_ns() // 1_000_000
+
+
+def monotonic_time_ms(unix_ms: int) -> int:
+    """
+    Converts a unix time in milliseconds to the monotonic clock, the counterpart of unix_time_ms
+
+    Args:
+        unix_ms (int): The unix time in milliseconds
+
+    Returns:
+        int: The monotonic time in milliseconds
+    """
+    return unix_ms - time.time_ns() // 1_000_000 + now_ms()
+
+
+def element_size(element) -> int:
+    """
+    Returns the size of an element of an aggregate value, including the objects a tuple or dictionary refers to
+
+    Args:
+        element (object): A member, a (field, value) pair or a stream entry
+
+    Returns:
+        int: The size in bytes
+    """
+    size = sys.getsizeof(element)
+    if isinstance(element, tuple):
+        size += sum(sys.getsizeof(item) for item in element)
+    elif isinstance(element, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in element.items())
+    return size
+
+
+class RedisObject:
+    """
+    Base class of the value objects of aggregate types, each subclass wraps one Python container and returns it
+    from its container() method. Not an abc.ABC: its metaclass would slow down the isinstance checks GET and the
+    other string commands run on every value.
+    """
+    __slots__ = ()
+    type_name = ""
+
+    def elements(self) -> Iterable:
+        """
+        Returns an iterator over the elements of the value, as measured by MEMORY USAGE
+        """
+        return iter(self.container())
+
+    def __len__(self) -> int:
+        return len(self.container())
+
+    def memory_usage(self, samples: int = MEMORY_USAGE_SAMPLES) -> int:
+        """
+        Estimates the bytes used by the value from a sample of its elements, like MEMORY USAGE does
+
+        Args:
+            samples (int, optional): The number of elements to sample, 0 for all of them. Defaults to 5.
+
+        Returns:
+            int: The estimated size in bytes
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.container())
+        count = len(self)
+        if not count:
+            return size
+        sampled = list(self.elements() if samples == 0 else itertools.islice(self.elements(), samples))
+        return size + sum(element_size(element) for element in sampled) * count // len(sampled)
+
+
+class RedisList(RedisObject):
+    """
+    Value object of a list key
+
+    Args:
+        items (List[str]): The elements of the list, head first
+    """
+    __slots__ = ("items",)
+    type_name = "list"
+
+    def __init__(self, items: List[str] | None = None):
+        self.items = items if items is not None else []
+
+    def container(self):
+        return self.items
+
+
+class RedisSet(RedisObject):
+    """
+    Value object of a set key
+
+    Args:
+        members (Set[str]): The members of the set
+    """
+    __slots__ = ("members",)
+    type_name = "set"
+
+    def __init__(self, members: Set[str] | None = None):
+        self.members = members if members is not None else set()
+
+    def container(self):
+        return self.members
+
+
+class RedisHash(RedisObject):
+    """
+    Value object of a hash key
+
+    Args:
+        fields (Dict[str, str]): The field -> value dictionary
+    """
+    __slots__ = ("fields",)
+    type_name = "hash"
+
+    def __init__(self, fields: Dict[str, str] | None = None):
+        self.fields = fields if fields is not None else {}
+
+    def container(self):
+        return self.fields
+
+    def elements(self) -> Iterable:
+        return iter(self.fields.items())
+
+
+class RedisZSet(RedisObject):
+    """
+    Value object of a sorted set key
+
+    Args:
+        scores (Dict[str, float]): The member -> score dictionary
+    """
+    __slots__ = ("scores",)
+    type_name = "zset"
+
+    def __init__(self, scores: Dict[str, float] | None = None):
+        self.scores = scores if scores is not None else {}
+
+    def container(self):
+        return self.scores
+
+    def elements(self) -> Iterable:
+        return iter(self.scores.items())
+
+
+def encode_string(value: str) -> str | int:
+    """
+    Picks the most compact representation of a string value: strings holding a canonical 64 bit integer
+    are stored as int, like the int encoding of Redis, everything else is kept as str
+
+    Example:
+        encode_string("42") -> 42
+        encode_string("042") -> '042'
+
+    Args:
+        value (str): The string value
+
+    Returns:
+        str | int: The value to store
+    """
+    if 0 < len(value) <= MAX_INT_ENCODED_LEN and (value[0] == "-" or value[0].isdigit()):
+        try:
+            number = int(value)
+        except ValueError:
+            return value
+        if str(number) == value and -2 ** 63 <= number < 2 ** 63:
+            return number
+    return value
+
+
+def type_name_of(value) -> str:
+    """
+    Returns the Redis type name of a stored value
+
+    Args:
+        value (str | int | RedisObject): The stored value
+
+    Returns:
+        str: The type name as reported by TYPE
+    """
+    if isinstance(value, (str, int)):
+        return "string"
+    return value.type_name
+
+
+class KeyLocks:
+    """
+    Striped locks of a keyspace: every key is guarded by one of a fixed number of reentrant locks picked by the
+    hash of the key, so commands on unrelated keys run concurrently while a read-modify-write of a key (INCR,
+    SET NX, XADD ID validation) is atomic. Stripes are always taken in ascending order, which rules out
+    deadlocks between commands locking several keys. Acquisitions and contended acquisitions are counted per
+    stripe, under the stripe itself, for INFO.
+
+    Args:
+        stripes (int, optional): The number of locks. Defaults to 16.
+    """
+    __slots__ = ("locks", "acquisitions", "contentions")
+
+    def __init__(self, stripes: int = DEFAULT_LOCK_STRIPES):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+        self.acquisitions = [0] * stripes
+        self.contentions = [0] * stripes
+
+    def stripes_for(self, keys: List[str] | None) -> List[int]:
+        """
+        Returns the stripes guarding some keys in locking order
+
+        Args:
+            keys (List[str] | None): The keys, None for the whole keyspace
+
+        Returns:
+            List[int]: The stripe indexes, ascending
+        """
+        if keys is None:
+            return list(range(len(self.locks)))
+        if len(keys) == 1:
+            return [hash(keys[0]) % len(self.locks)]
+        return sorted({hash(key) % len(self.locks) for key in keys})
+
+    def acquire(self, stripes: List[int]):
+        """
+        Takes the locks of some stripes, blocking until each is free
+
+        Args:
+            stripes (List[int]): The stripe indexes, ascending as returned by stripes_for
+        """
+        for stripe in stripes:
+            lock = self.locks[stripe]
+            if not lock.acquire(blocking=False):
+                lock.acquire()
+                self.contentions[stripe] += 1
+            self.acquisitions[stripe] += 1
+
+    def release(self, stripes: List[int]):
+        """
+        Releases the locks of some stripes taken with acquire
+        """
+        for stripe in reversed(stripes):
+            self.locks[stripe].release()
+
+    @contextlib.contextmanager
+    def hold(self, keys: List[str] | None = None):
+        """
+        Holds the locks of some keys for the duration of a with block
+
+        Example:
+            with keyspace.locks.hold(["mystream"]):
+                ...
+
+        Args:
+            keys (List[str] | None, optional): The keys, None for the whole keyspace. Defaults to None.
+        """
+        stripes = self.stripes_for(keys)
+        self.acquire(stripes)
+        try:
+            yield
+        finally:
+            self.release(stripes)
+
+
+class Keyspace:
+    """
+    A Redis database
+
+    Values live in a plain key -> value dictionary, strings as bare str or int (the most compact forms Python
+    offers) and every other type as a __slots__ value object. Expires are kept apart in a sparse
+    key -> monotonic milliseconds dictionary, indexed by a min-heap for the active expire cycle, so keys
+    without a TTL pay nothing for expiry support.
+
+    Watched keys (WATCH) get a version counter bumped by every change of the key, kept only while some client
+    watches it, so keys nobody watches pay a single dictionary check per change.
+
+    Commands run holding the `locks` stripes of the keys they access, the expires heap shared by every key has a
+    lock of its own.
+
+    In cluster mode `slot_keys` indexes the keys by hash slot, for CLUSTER COUNTKEYSINSLOT and GETKEYSINSLOT.
+    Every key deleted because it expired is handed to `on_expire`, which propagates a DEL.
+    """
+    __slots__ = ("data", "expires", "expires_heap", "expired_keys", "versions", "watchers", "locks", "expires_lock",
+                 "slot_keys", "on_expire")
+
+    def __init__(self):
+        self.data: Dict[str, object] = {}
+        self.expires: Dict[str, int] = {}
+        self.expires_heap: List[Tuple[int, str]] = []
+        self.expired_keys = 0
+        self.versions: Dict[str, int] = {}
+        self.watchers: Dict[str, int] = {}
+        self.locks = KeyLocks()
+        self.expires_lock = threading.Lock()
+        self.slot_keys: List[Set[str]] | None = None
+        self.on_expire: Callable[[str], None] | None = None
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: str) -> bool:
+        return self.lookup(key) is not None
+
+    def lookup(self, key: str):
+        """
+        Returns the value of a key, lazily deleting it first when its expire time is in the past
+
+        Args:
+            key (str): The key
+
+        Returns:
+            str | int | RedisObject | None: The value, None if the key does not exist
+        """
+        if key in self.expires:
+            self.expire_if_needed(key)
+        return self.data.get(key)
+
+    def set(self, key: str, value):
+        """
+        Sets the value of a key, keeping its expire
+
+        Args:
+            key (str): The key
+            value (str | int | RedisObject): The value, strings are stored in their most compact encoding
+        """
+        if isinstance(value, str):
+            value = encode_string(value)
+        if self.slot_keys is not None and key not in self.data:
+            self.slot_keys[key_hash_slot(key)].add(key)
+        self.data[key] = value
+        if self.versions:
+            self.touch(key)
+
+    def delete(self, key: str) -> bool:
+        """
+        Deletes a key together with its expire
+
+        Args:
+            key (str): The key
+
+        Returns:
+            bool: True if the key existed
+        """
+        self.expires.pop(key, None)
+        if self.data.pop(key, None) is None:
+            return False
+        if self.slot_keys is not None:
+            self.slot_keys[key_hash_slot(key)].discard(key)
+        if self.versions:
+            self.touch(key)
+        return True
+
+    def clear(self):
+        """
+        Deletes every key, e.g. before a replica loads the snapshot of its master
+        """
+        self.data.clear()
+        self.expires.clear()
+        self.expires_heap.clear()
+        if self.slot_keys is not None:
+            for keys in self.slot_keys:
+                keys.clear()
+        for key in self.versions:
+            self.versions[key] += 1
+
+    def touch(self, key: str):
+        """
+        Records a change of a key for the clients watching it, called by every write to the key, including
+        the commands that modify a value in place like XADD
+
+        Args:
+            key (str): The key
+        """
+        if key in self.versions:
+            self.versions[key] += 1
+
+    def watch(self, key: str) -> int:
+        """
+        Starts tracking the changes of a key for a client, balanced by a call to unwatch
+
+        Args:
+            key (str): The key
+
+        Returns:
+            int: The current version of the key, EXEC compares it with version()
+        """
+        self.watchers[key] = self.watchers.get(key, 0) + 1
+        return self.versions.setdefault(key, 0)
+
+    def unwatch(self, key: str):
+        """
+        Stops tracking a key for a client, its version is dropped once no client watches it
+
+        Args:
+            key (str): The key
+        """
+        remaining = self.watchers[key] - 1
+        if remaining:
+            self.watchers[key] = remaining
+        else:
+            del self.watchers[key]
+            del self.versions[key]
+
+    def version(self, key: str) -> int:
+        """
+        Returns the version of a watched key
+        """
+        return self.versions[key]
+
+    def keys(self) -> List[str]:
+        """
+        Returns every key that is not logically expired
+        """
+        now = now_ms()
+        return [key for key in self.data if self.expires.get(key, now + 1) > now]
+
+    def set_expire(self, key: str, when_ms: int):
+        """
+        Sets the absolute expire time of a key and indexes it in the expires heap.
+        A previous heap entry of the key goes stale and is skipped when it is popped.
+
+        Args:
+            key (str): The key
+            when_ms (int): The monotonic time in milliseconds at which the key expires
+        """
+        self.expires[key] = when_ms
+        if self.versions:
+            self.touch(key)
+        with self.expires_lock:
+            heapq.heappush(self.expires_heap, (when_ms, key))
+            if len(self.expires_heap) > 2 * len(self.expires) + 1024:
+                self.rebuild_expires_heap()
+
+    def remove_expire(self, key: str) -> bool:
+        """
+        Removes the expire of a key, making it persistent
+
+        Args:
+            key (str): The key
+
+        Returns:
+            bool: True if the key had an expire
+        """
+        if self.expires.pop(key, None) is None:
+            return False
+        if self.versions:
+            self.touch(key)
+        return True
+
+    def get_expire(self, key: str) -> int | None:
+        """
+        Returns the expire time of a key
+
+        Args:
+            key (str): The key
+
+        Returns:
+            int | None: The monotonic expire time in milliseconds, None if the key is persistent
+        """
+        return self.expires.get(key)
+
+    def rebuild_expires_heap(self):
+        """
+        Rebuilds the expires heap from the expires dictionary, dropping every stale entry.
+        Must be called with expires_lock held.
+        """
+        self.expires_heap[:] = [(when_ms, key) for key, when_ms in self.expires.items()]
+        heapq.heapify(self.expires_heap)
+
+    def expire_if_needed(self, key: str) -> bool:
+        """
+        Lazily deletes a key whose expire time is in the past
+
+        Args:
+            key (str): The key
+
+        Returns:
+            bool: True if the key was expired and deleted
+        """
+        when_ms = self.expires.get(key)
+        if when_ms is None or when_ms > now_ms():
+            return False
+        self.expire(key)
+        return True
+
+    def expire(self, key: str):
+        """
+        Deletes a key whose expire time passed, lazily or from the active expire cycle, and reports it to on_expire
+
+        Args:
+            key (str): The key
+        """
+        self.delete(key)
+        self.expired_keys += 1
+        if self.on_expire is not None:
+            self.on_expire(key)
+
+    def memory_usage(self, key: str, samples: int = MEMORY_USAGE_SAMPLES) -> int | None:
+        """
+        Estimates the bytes used by a key: the key and value objects, their dictionary entry
+        and, for keys with a TTL, the expire entry
+
+        Args:
+            key (str): The key
+            samples (int, optional): The number of elements sampled for aggregate values. Defaults to 5.
+
+        Returns:
+            int | None: The estimated size in bytes, None if the key does not exist
+        """
+        value = self.lookup(key)
+        if value is None:
+            return None
+        size = DICT_ENTRY_SIZE + sys.getsizeof(key)
+        if isinstance(value, (str, int)):
+            size += sys.getsizeof(value)
+        else:
+            size += value.memory_usage(samples)
+        if key in self.expires:
+            size += DICT_ENTRY_SIZE + sys.getsizeof(self.expires[key])
+        return size
+
+    def overhead(self) -> Dict[str, int]:
+        """
+        Returns the bytes used by the hash tables and the expires heap, the per-key overhead of the keyspace
+        """
+        return {
+            "keyspace_dict_bytes": sys.getsizeof(self.data),
+            "expires_dict_bytes": sys.getsizeof(self.expires),
+            "expires_heap_bytes": sys.getsizeof(self.expires_heap),
+        }
@@ -1,28 +1,59 @@
 import socket
 import threading
+from typing import List
 
-from app import redis_utils
+from app import aof, cluster, expiry, rdb, redis_utils, replication, workers
+from .connection import ConnContext
+from .event_loop import EventLoop
 from .redis_utils import redis_args_parse
-from .routes import accept_client_concurrently, perform_handshake_with_master
+from .routes import accept_client_concurrently, choose_argument_and_send_output, decode_command, replicate_from_master
 
 
 def main():
     """
     Main function for Redis Creating Server at the port 6379
+
+    With '--workers N' N processes are forked, each serving the port and one range of the hash slots,
+    otherwise this process serves every key
+    """
+    redis_args_parse()
+    cluster.setup()
+    if redis_utils.workers > 1:
+        workers.run_workers(serve, accept_client_concurrently)
+        return
+    serve()
+
+
+def serve():
+    """
     Create a server socket and bind to the port
     The 'reuse_port=True' option allows multiple connections to the same port
-    This is useful when multiple clients connect simultaneously
+    This is useful when multiple clients connect simultaneously, and lets every worker bind the same port
+
+    With '--io-model threaded' (the default) every client is served by its own thread,
+    '--io-model eventloop' multiplexes every client on a single selectors loop instead
+    With '--appendonly yes' the dataset is loaded before the port is bound, see load_append_only_file
     """
-    redis_args_parse()
+    redis_utils.keyspace.on_expire = replication.propagate_expired
+    if redis_utils.appendonly:
+        load_append_only_file()
+    elif redis_utils.dir or redis_utils.dbfilename:
+        rdb.start_loading_thread()
     if redis_utils.replicaof:
         replica = redis_utils.replicaof.split(" ")
-        master_socket = socket.create_connection((replica[0], int(replica[1])))
-        threading.Thread(target=perform_handshake_with_master, args=(master_socket, redis_utils.port),
+        threading.Thread(target=replicate_from_master, args=(replica[0], int(replica[1]), redis_utils.port),
                          daemon=True).start()
 
     with socket.create_server(("localhost", redis_utils.port), reuse_port=True) as server_socket:
         server_socket.listen()
 
+        if redis_utils.io_model == "eventloop":
+            loop = EventLoop()
+            loop.call_every(1 / redis_utils.hz, expiry.active_expire_cycle)
+            loop.run(server_socket)
+            return
+
+        expiry.start_active_expire_thread()
         while True:
             client_socket, address = server_socket.accept()
             client_thread = threading.Thread(
@@ -31,5 +62,23 @@ def main():
             client_thread.start()
 
 
+def load_append_only_file():
+    """
+    Loads the dataset of '--appendonly yes' and starts appending to the AOF: the RDB file, which the server never
+    rewrites, then every write command of the AOF on top of it. Both run before the port is bound, the commands
+    of the AOF go through the command table like the ones of a master, their replies dropped.
+    """
+    if redis_utils.dbfilename:
+        rdb.load_rdb()
+    client = ConnContext(-1, None, "append only file", from_master=True)
+
+    def apply(cmd: List[bytes]):
+        msg_arr = decode_command(cmd)
+        choose_argument_and_send_output(msg_arr, len(msg_arr), client)
+
+    aof.load(apply)
+    aof.start()
+
+
 if __name__ == "__main__":
     main()
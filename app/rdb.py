@@ -0,0 +1,865 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import BinaryIO, Iterator, Tuple
+
+from app import redis_utils, workers
+from .keyspace import Keyspace, RedisHash, RedisList, RedisSet, RedisZSet, now_ms
+from .stream import (STREAM_ID_SEQ_BITS, ConsumerGroup, RedisStream, StreamConsumer, StreamNACK, pack_stream_id,
+                     unpack_stream_id)
+
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_EXPIRETIME = 0xFD
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+RDB_32BITLEN = 0x80
+RDB_64BITLEN = 0x81
+RDB_ENCVAL = 0b11
+
+RDB_ENC_INT8 = 0
+RDB_ENC_INT16 = 1
+RDB_ENC_INT32 = 2
+RDB_ENC_LZF = 3
+
+RDB_TYPE_STRING = 0
+RDB_TYPE_LIST = 1
+RDB_TYPE_SET = 2
+RDB_TYPE_ZSET = 3
+RDB_TYPE_HASH = 4
+RDB_TYPE_ZSET_2 = 5
+RDB_TYPE_HASH_ZIPMAP = 9
+RDB_TYPE_LIST_ZIPLIST = 10
+RDB_TYPE_SET_INTSET = 11
+RDB_TYPE_ZSET_ZIPLIST = 12
+RDB_TYPE_HASH_ZIPLIST = 13
+RDB_TYPE_LIST_QUICKLIST = 14
+RDB_TYPE_HASH_LISTPACK = 16
+RDB_TYPE_ZSET_LISTPACK = 17
+RDB_TYPE_LIST_QUICKLIST_2 = 18
+RDB_TYPE_STREAM_LISTPACKS = 15
+RDB_TYPE_STREAM_LISTPACKS_2 = 19
+RDB_TYPE_SET_LISTPACK = 20
+RDB_TYPE_STREAM_LISTPACKS_3 = 21
+
+RDB_VERSION = 11
+RDB_LENGTH_INVALID = (1 << 64) - 1
+
+QUICKLIST_NODE_CONTAINER_PLAIN = 1
+
+ZIPLIST_HEADER_SIZE = 10
+ZIPLIST_INT_SIZES = {0xC0: 2, 0xD0: 4, 0xE0: 8, 0xF0: 3, 0xFE: 1}
+LISTPACK_HEADER_SIZE = 6
+LISTPACK_INT_SIZES = {0xF1: 2, 0xF2: 3, 0xF3: 4, 0xF4: 8}
+INTSET_HEADER_SIZE = 8
+INTSET_FORMATS = {2: "h", 4: "i", 8: "q"}
+
+STREAM_ITEM_FLAG_DELETED = 1
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+
+LOADING_PROGRESS_INTERVAL = 1024
+RDB_WRITE_BUFFER_SIZE = 64 * 1024
+
+
+class RdbReader:
+    """
+    Reads the primitives of the RDB format from a buffer without copying it
+
+    The buffer is usually a memory map of the file, lengths are decoded in place and strings are decoded
+    straight from memoryview slices, so the file is never read into one big bytes object and each key
+    and value is copied exactly once, into the str stored in the keyspace.
+
+    Args:
+        data (memoryview): The content of the RDB file
+    """
+
+    def __init__(self, data: memoryview):
+        self.data = data
+        self.pos = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def read_byte(self) -> int:
+        """
+        Returns the next byte
+        """
+        byte = self.data[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_uint(self, size: int, byteorder: str = "little") -> int:
+        """
+        Returns the next unsigned integer of the given size in bytes, little endian unless told otherwise
+        """
+        value = int.from_bytes(self.data[self.pos:self.pos + size], byteorder)
+        self.pos += size
+        return value
+
+    def read_length(self) -> int:
+        """
+        Reads a length encoded integer
+
+        Returns:
+            int: The length
+
+        Raises:
+            Exception: If the length uses an encoding that is not supported
+        """
+        first = self.read_byte()
+        start = first >> 6
+        if start == 0b00:
+            return first
+        if start == 0b01:
+            return ((first & 0b00111111) << 8) + self.read_byte()
+        if first == RDB_32BITLEN:
+            return self.read_uint(4, "big")
+        if first == RDB_64BITLEN:
+            return self.read_uint(8, "big")
+        raise Exception(f"Unknown db len type {start} @ {self.pos}")
+
+    def read_int(self, size: int) -> int:
+        """
+        Returns the next little endian signed integer of the given size in bytes
+        """
+        value = int.from_bytes(self.data[self.pos:self.pos + size], "little", signed=True)
+        self.pos += size
+        return value
+
+    def read_blob(self) -> bytes | memoryview:
+        """
+        Reads a string in any of its encodings: length prefixed, integer or LZF compressed
+
+        Returns:
+            bytes | memoryview: The raw bytes of the string, a view on the file unless it had to be decoded
+        """
+        first = self.data[self.pos]
+        if first >> 6 != RDB_ENCVAL:
+            length = self.read_length()
+            value = self.data[self.pos:self.pos + length]
+            self.pos += length
+            return value
+        self.pos += 1
+        encoding = first & 0b00111111
+        if encoding == RDB_ENC_INT8:
+            return b"%d" % self.read_int(1)
+        if encoding == RDB_ENC_INT16:
+            return b"%d" % self.read_int(2)
+        if encoding == RDB_ENC_INT32:
+            return b"%d" % self.read_int(4)
+        if encoding == RDB_ENC_LZF:
+            compressed_len = self.read_length()
+            value_len = self.read_length()
+            value = lzf_decompress(self.data[self.pos:self.pos + compressed_len], value_len)
+            self.pos += compressed_len
+            return value
+        raise Exception(f"Unknown string encoding {encoding} @ {self.pos}")
+
+    def read_string(self) -> str:
+        """
+        Reads a string, bytes that are not valid UTF-8 are kept with surrogateescape
+
+        Returns:
+            str: The string
+        """
+        return str(self.read_blob(), "utf-8", "surrogateescape")
+
+    def read_double(self) -> float:
+        """
+        Reads a score of the old sorted set encoding, a length prefixed ASCII number
+        with 253, 254 and 255 standing for nan, inf and -inf
+        """
+        length = self.read_byte()
+        if length == 253:
+            return float("nan")
+        if length == 254:
+            return float("inf")
+        if length == 255:
+            return float("-inf")
+        value = float(str(self.data[self.pos:self.pos + length], "ascii"))
+        self.pos += length
+        return value
+
+    def read_binary_double(self) -> float:
+        """
+        Reads a score of the RDB_TYPE_ZSET_2 encoding, a little endian IEEE 754 double
+        """
+        value = struct.unpack_from("<d", self.data, self.pos)[0]
+        self.pos += 8
+        return value
+
+    def read_raw_stream_id(self) -> int:
+        """
+        Reads a stream ID stored as 16 raw big endian bytes, the form used by the pending entries of streams
+        """
+        return pack_stream_id(self.read_uint(8, "big"), self.read_uint(8, "big"))
+
+
+def lzf_decompress(data: memoryview, expected_len: int) -> bytes:
+    """
+    Decompresses an LZF compressed string
+
+    Literal runs and back references that do not overlap the bytes they produce are copied with one slice,
+    overlapping references (runs of a repeated pattern) are expanded by repeating the pattern.
+
+    Args:
+        data (memoryview): The compressed bytes
+        expected_len (int): The length of the decompressed string
+
+    Raises:
+        Exception: If the data is corrupted
+
+    Returns:
+        bytes: The decompressed string
+    """
+    out = bytearray()
+    pos = 0
+    end = len(data)
+    while pos < end:
+        ctrl = data[pos]
+        pos += 1
+        if ctrl < 32:
+            ctrl += 1
+            out += data[pos:pos + ctrl]
+            pos += ctrl
+            continue
+        length = ctrl >> 5
+        if length == 7:
+            length += data[pos]
+            pos += 1
+        distance = ((ctrl & 0x1F) << 8) + data[pos] + 1
+        pos += 1
+        length += 2
+        ref = len(out) - distance
+        if ref < 0:
+            raise Exception("Invalid LZF back reference")
+        if distance >= length:
+            out += out[ref:ref + length]
+        else:
+            out += (out[ref:] * (length // distance + 1))[:length]
+    if len(out) != expected_len:
+        raise Exception(f"Invalid LZF compressed string, expected {expected_len} bytes got {len(out)}")
+    return bytes(out)
+
+
+def decode_element(data, start: int, length: int) -> str:
+    """
+    Decodes the string element of a ziplist, listpack or zipmap found at the given position
+    """
+    return str(data[start:start + length], "utf-8", "surrogateescape")
+
+
+def iter_ziplist(data) -> Iterator[str]:
+    """
+    Yields the elements of a ziplist, integers converted to their string form
+
+    Args:
+        data (bytes | memoryview): The ziplist
+    """
+    pos = ZIPLIST_HEADER_SIZE
+    while data[pos] != 0xFF:
+        pos += 5 if data[pos] == 0xFE else 1
+        encoding = data[pos]
+        kind = encoding >> 6
+        if kind == 0b00:
+            length = encoding & 0x3F
+            pos += 1
+        elif kind == 0b01:
+            length = ((encoding & 0x3F) << 8) | data[pos + 1]
+            pos += 2
+        elif kind == 0b10:
+            length = int.from_bytes(data[pos + 1:pos + 5], "big")
+            pos += 5
+        else:
+            pos += 1
+            size = ZIPLIST_INT_SIZES.get(encoding)
+            if size:
+                yield str(int.from_bytes(data[pos:pos + size], "little", signed=True))
+                pos += size
+            elif 0xF1 <= encoding <= 0xFD:
+                yield str((encoding & 0x0F) - 1)
+            else:
+                raise Exception(f"Unknown ziplist encoding {encoding:#x}")
+            continue
+        yield decode_element(data, pos, length)
+        pos += length
+
+
+def listpack_backlen_size(entry_len: int) -> int:
+    """
+    Returns the number of bytes of the backlen trailing a listpack entry of the given length
+    """
+    if entry_len <= 127:
+        return 1
+    if entry_len < 16383:
+        return 2
+    if entry_len < 2097151:
+        return 3
+    if entry_len < 268435455:
+        return 4
+    return 5
+
+
+def iter_listpack(data) -> Iterator[str]:
+    """
+    Yields the elements of a listpack, integers converted to their string form
+
+    Args:
+        data (bytes | memoryview): The listpack
+    """
+    pos = LISTPACK_HEADER_SIZE
+    while True:
+        encoding = data[pos]
+        if encoding < 0x80:
+            yield str(encoding)
+            entry_len = 1
+        elif encoding < 0xC0:
+            length = encoding & 0x3F
+            yield decode_element(data, pos + 1, length)
+            entry_len = 1 + length
+        elif encoding < 0xE0:
+            value = ((encoding & 0x1F) << 8) | data[pos + 1]
+            yield str(value - (1 << 13) if value >= 1 << 12 else value)
+            entry_len = 2
+        elif encoding < 0xF0:
+            length = ((encoding & 0x0F) << 8) | data[pos + 1]
+            yield decode_element(data, pos + 2, length)
+            entry_len = 2 + length
+        elif encoding == 0xF0:
+            length = int.from_bytes(data[pos + 1:pos + 5], "little")
+            yield decode_element(data, pos + 5, length)
+            entry_len = 5 + length
+        elif encoding == 0xFF:
+            return
+        else:
+            size = LISTPACK_INT_SIZES.get(encoding)
+            if not size:
+                raise Exception(f"Unknown listpack encoding {encoding:#x}")
+            yield str(int.from_bytes(data[pos + 1:pos + 1 + size], "little", signed=True))
+            entry_len = 1 + size
+        pos += entry_len + listpack_backlen_size(entry_len)
+
+
+def iter_intset(data) -> Iterator[str]:
+    """
+    Yields the members of an intset in their string form
+
+    Args:
+        data (bytes | memoryview): The intset
+    """
+    size, length = struct.unpack_from("<II", data)
+    for member in struct.unpack_from(f"<{length}{INTSET_FORMATS[size]}", data, INTSET_HEADER_SIZE):
+        yield str(member)
+
+
+def iter_zipmap(data) -> Iterator[str]:
+    """
+    Yields the fields and values of a zipmap, the hash encoding of RDB files older than Redis 2.6
+
+    Args:
+        data (bytes | memoryview): The zipmap
+    """
+    pos = 1
+    while data[pos] != 0xFF:
+        for is_value in (False, True):
+            length = data[pos]
+            if length < 254:
+                pos += 1
+            else:
+                length = int.from_bytes(data[pos + 1:pos + 5], "little")
+                pos += 5
+            free = 0
+            if is_value:
+                free = data[pos]
+                pos += 1
+            yield decode_element(data, pos, length)
+            pos += length + free
+
+
+def pairs(elements: Iterator[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Groups a flat iterator of elements into (field, value) pairs
+    """
+    return zip(elements, elements)
+
+
+def iter_rdb(reader: RdbReader) -> Iterator[Tuple[str, object, int | None]]:
+    """
+    Decodes the entries of an RDB file one by one, so the caller can insert them into the keyspace
+    and report progress while the file is being read
+
+    Args:
+        reader (RdbReader): The reader over the content of the file
+
+    Raises:
+        Exception: If the file is not an RDB file or holds a value type that is not supported
+
+    Yields:
+        Tuple[str, object, int | None]: The key, the value and the unix expire time in milliseconds
+    """
+    if bytes(reader.data[0:5]) != b"REDIS":
+        raise Exception("Incorrect RDB format")
+    reader.pos = 5 + 4
+    expire_ms = None
+    while reader.pos < len(reader):
+        op = reader.read_byte()
+        if op == RDB_OPCODE_AUX:
+            reader.read_string()
+            reader.read_string()
+        elif op == RDB_OPCODE_SELECTDB:
+            reader.read_length()
+        elif op == RDB_OPCODE_RESIZEDB:
+            reader.read_length()
+            reader.read_length()
+        elif op == RDB_OPCODE_EXPIRETIME:
+            expire_ms = reader.read_uint(4) * 1000
+        elif op == RDB_OPCODE_EXPIRETIME_MS:
+            expire_ms = reader.read_uint(8)
+        elif op == RDB_OPCODE_EOF:
+            break
+        else:
+            key = reader.read_string()
+            yield key, read_object(reader, op), expire_ms
+            expire_ms = None
+
+
+def read_object(reader: RdbReader, value_type: int):
+    """
+    Reads a value of the given RDB type
+
+    Args:
+        reader (RdbReader): The reader positioned on the value
+        value_type (int): The RDB type of the value
+
+    Raises:
+        Exception: If the value type is not supported
+
+    Returns:
+        str | RedisObject: The value
+    """
+    if value_type == RDB_TYPE_STRING:
+        return reader.read_string()
+    if value_type == RDB_TYPE_LIST:
+        return RedisList([reader.read_string() for _ in range(reader.read_length())])
+    if value_type == RDB_TYPE_SET:
+        return RedisSet({reader.read_string() for _ in range(reader.read_length())})
+    if value_type in (RDB_TYPE_ZSET, RDB_TYPE_ZSET_2):
+        read_score = reader.read_double if value_type == RDB_TYPE_ZSET else reader.read_binary_double
+        scores = {}
+        for _ in range(reader.read_length()):
+            member = reader.read_string()
+            scores[member] = read_score()
+        return RedisZSet(scores)
+    if value_type == RDB_TYPE_HASH:
+        fields = {}
+        for _ in range(reader.read_length()):
+            field = reader.read_string()
+            fields[field] = reader.read_string()
+        return RedisHash(fields)
+    if value_type == RDB_TYPE_HASH_ZIPMAP:
+        return RedisHash(dict(pairs(iter_zipmap(reader.read_blob()))))
+    if value_type == RDB_TYPE_LIST_ZIPLIST:
+        return RedisList(list(iter_ziplist(reader.read_blob())))
+    if value_type == RDB_TYPE_SET_INTSET:
+        return RedisSet(set(iter_intset(reader.read_blob())))
+    if value_type == RDB_TYPE_SET_LISTPACK:
+        return RedisSet(set(iter_listpack(reader.read_blob())))
+    if value_type in (RDB_TYPE_ZSET_ZIPLIST, RDB_TYPE_ZSET_LISTPACK):
+        elements = iter_ziplist if value_type == RDB_TYPE_ZSET_ZIPLIST else iter_listpack
+        return RedisZSet({member: float(score) for member, score in pairs(elements(reader.read_blob()))})
+    if value_type in (RDB_TYPE_HASH_ZIPLIST, RDB_TYPE_HASH_LISTPACK):
+        elements = iter_ziplist if value_type == RDB_TYPE_HASH_ZIPLIST else iter_listpack
+        return RedisHash(dict(pairs(elements(reader.read_blob()))))
+    if value_type == RDB_TYPE_LIST_QUICKLIST:
+        items = []
+        for _ in range(reader.read_length()):
+            items.extend(iter_ziplist(reader.read_blob()))
+        return RedisList(items)
+    if value_type == RDB_TYPE_LIST_QUICKLIST_2:
+        items = []
+        for _ in range(reader.read_length()):
+            container = reader.read_length()
+            if container == QUICKLIST_NODE_CONTAINER_PLAIN:
+                items.append(reader.read_string())
+            else:
+                items.extend(iter_listpack(reader.read_blob()))
+        return RedisList(items)
+    if value_type in (RDB_TYPE_STREAM_LISTPACKS, RDB_TYPE_STREAM_LISTPACKS_2, RDB_TYPE_STREAM_LISTPACKS_3):
+        return read_stream(reader, value_type)
+    raise Exception(f"Unsupported value type {value_type} at {reader.pos - 1}")
+
+
+def read_stream(reader: RdbReader, value_type: int) -> RedisStream:
+    """
+    Reads a stream: its listpacks, each made of a master entry holding the field names shared by the entries
+    flagged SAMEFIELDS and of entries whose IDs are deltas from the master ID, then its metadata and its
+    consumer groups with their pending entries
+
+    Args:
+        reader (RdbReader): The reader positioned on the value
+        value_type (int): One of the three stream types, the later ones store more metadata
+
+    Returns:
+        RedisStream: The stream
+    """
+    stream = RedisStream()
+    for _ in range(reader.read_length()):
+        node_key = reader.read_blob()
+        master_ms = int.from_bytes(node_key[:8], "big")
+        master_seq = int.from_bytes(node_key[8:16], "big")
+        elements = iter_listpack(reader.read_blob())
+        count = int(next(elements)) + int(next(elements))
+        master_fields = tuple(next(elements) for _ in range(int(next(elements))))
+        next(elements)
+        for _ in range(count):
+            flags = int(next(elements))
+            stream_id = pack_stream_id(master_ms + int(next(elements)), master_seq + int(next(elements)))
+            if flags & STREAM_ITEM_FLAG_SAMEFIELDS:
+                fields = master_fields
+                values = tuple(next(elements) for _ in range(len(master_fields)))
+            else:
+                flat = [next(elements) for _ in range(int(next(elements)) * 2)]
+                fields = tuple(flat[::2])
+                values = tuple(flat[1::2])
+            next(elements)
+            if not flags & STREAM_ITEM_FLAG_DELETED:
+                stream.append(stream_id, fields, values)
+    reader.read_length()
+    stream.last_id = pack_stream_id(reader.read_length(), reader.read_length())
+    if value_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+        for _ in range(5):
+            reader.read_length()
+    for _ in range(reader.read_length()):
+        name = reader.read_string()
+        group = ConsumerGroup(pack_stream_id(reader.read_length(), reader.read_length()))
+        if value_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+            reader.read_length()
+        for _ in range(reader.read_length()):
+            stream_id = reader.read_raw_stream_id()
+            delivery_time = reader.read_uint(8)
+            group.pending.add(stream_id, StreamNACK(None, delivery_time, reader.read_length()))
+        for _ in range(reader.read_length()):
+            consumer = StreamConsumer(reader.read_string(), reader.read_uint(8))
+            if value_type >= RDB_TYPE_STREAM_LISTPACKS_3:
+                reader.read_uint(8)
+            group.consumers[consumer.name] = consumer
+            for _ in range(reader.read_length()):
+                stream_id = reader.read_raw_stream_id()
+                nack = group.pending.get(stream_id)
+                nack.consumer = consumer
+                consumer.pending.add(stream_id, nack)
+        stream.groups[name] = group
+    return stream
+
+
+def load_rdb(db_path: str | None = None) -> int:
+    """
+    Loads an RDB file into the keyspace: the one of --dir and --dbfilename at startup, so commands never touch
+    the file afterwards, or the one a replica received from its master.
+
+    The file is memory mapped and decoded entry by entry, the loading fields of INFO persistence are
+    refreshed every few entries and commands without the loading flag get a LOADING error until it is done.
+    Expire times are converted from unix time to the monotonic clock and keys that already expired are skipped,
+    so are the keys owned by another worker with --workers.
+
+    Args:
+        db_path (str | None, optional): The path of the file. Defaults to the one of --dir and --dbfilename.
+
+    Returns:
+        int: The number of keys loaded
+    """
+    db_path = db_path or os.path.join(redis_utils.dir, redis_utils.dbfilename)
+    start = time.perf_counter()
+    redis_utils.loading_start_time = int(time.time())
+    redis_utils.loading_loaded_bytes = 0
+    loaded = 0
+    expired = 0
+    try:
+        with open(db_path, mode="rb") as db:
+            redis_utils.loading_total_bytes = os.fstat(db.fileno()).st_size
+            if not redis_utils.loading_total_bytes:
+                print(f"Empty RDB file {db_path}")
+                return 0
+            with mmap.mmap(db.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as data:
+                reader = RdbReader(data)
+                keyspace = redis_utils.keyspace
+                now_unix_ms = time.time_ns() // 1_000_000
+                now_monotonic_ms = now_ms()
+                try:
+                    for key, value, expire_ms in iter_rdb(reader):
+                        if expire_ms is not None and expire_ms <= now_unix_ms:
+                            expired += 1
+                            continue
+                        if not workers.owns_key(key):
+                            continue
+                        keyspace.set(key, value)
+                        if expire_ms is not None:
+                            keyspace.set_expire(key, now_monotonic_ms + expire_ms - now_unix_ms)
+                        loaded += 1
+                        if loaded % LOADING_PROGRESS_INTERVAL == 0:
+                            redis_utils.loading_loaded_bytes = reader.pos
+                finally:
+                    redis_utils.loading_loaded_bytes = reader.pos
+    except OSError as e:
+        print(f"Unable to open file {db_path}: {e}")
+        return 0
+    except Exception as e:
+        print(f"Error loading RDB file {db_path}: {e}")
+    finally:
+        redis_utils.rdb_last_load_keys_loaded = loaded
+        redis_utils.rdb_last_load_keys_expired = expired
+        redis_utils.rdb_last_load_time_ms = int((time.perf_counter() - start) * 1000)
+        redis_utils.loading = False
+    print(f"DB loaded from disk: {loaded} keys in {redis_utils.rdb_last_load_time_ms} ms")
+    return loaded
+
+
+def start_loading_thread():
+    """
+    Loads the RDB file on a background thread, the server accepts connections meanwhile
+    and answers LOADING to every command that cannot run on a partial dataset
+    """
+    redis_utils.loading = True
+    threading.Thread(target=load_rdb, daemon=True).start()
+
+
+class RdbWriter:
+    """
+    Writes the primitives of the RDB format to a binary file, the counterpart of RdbReader
+
+    Small writes are gathered in a buffer handed to the file every RDB_WRITE_BUFFER_SIZE bytes, so a dump
+    costs a few large writes and never holds more than that in memory.
+
+    Args:
+        out (BinaryIO): The file the dump is written to
+    """
+
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.buf = bytearray()
+
+    def write(self, data: bytes):
+        self.buf += data
+        if len(self.buf) >= RDB_WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.out.write(self.buf)
+        self.buf.clear()
+
+    def write_length(self, length: int):
+        if length < 1 << 6:
+            self.buf.append(length)
+        elif length < 1 << 14:
+            self.buf += bytes((0x40 | (length >> 8), length & 0xFF))
+        elif length < 1 << 32:
+            self.buf.append(RDB_32BITLEN)
+            self.buf += length.to_bytes(4, "big")
+        else:
+            self.buf.append(RDB_64BITLEN)
+            self.buf += length.to_bytes(8, "big")
+
+    def write_string(self, value):
+        """
+        Writes a string, with the integer encoding when it holds a canonical 32 bit integer like Redis does
+
+        Args:
+            value (str | int | bytes): The string, ints being strings stored in their int encoding
+        """
+        if isinstance(value, int):
+            if -(1 << 31) <= value < 1 << 31:
+                self.buf.append((RDB_ENCVAL << 6) | RDB_ENC_INT32)
+                self.buf += value.to_bytes(4, "little", signed=True)
+                return
+            value = b"%d" % value
+        elif isinstance(value, str):
+            value = value.encode("utf-8", "surrogateescape")
+        self.write_length(len(value))
+        self.write(value)
+
+    def write_raw_stream_id(self, stream_id: int):
+        ms, seq = unpack_stream_id(stream_id)
+        self.buf += ms.to_bytes(8, "big") + seq.to_bytes(8, "big")
+
+
+def listpack_entry(value) -> bytes:
+    """
+    Encodes one listpack entry with its backlen, integers with the smallest integer encoding
+
+    Args:
+        value (str | int): The element
+    """
+    if isinstance(value, int):
+        if 0 <= value < 128:
+            entry = bytes((value,))
+        elif -(1 << 12) <= value < 1 << 12:
+            value &= 0x1FFF
+            entry = bytes((0xC0 | (value >> 8), value & 0xFF))
+        else:
+            size, encoding = next((size, encoding) for encoding, size in LISTPACK_INT_SIZES.items()
+                                  if -(1 << (size * 8 - 1)) <= value < 1 << (size * 8 - 1))
+            entry = bytes((encoding,)) + value.to_bytes(size, "little", signed=True)
+    else:
+        data = value.encode("utf-8", "surrogateescape")
+        if len(data) < 1 << 6:
+            entry = bytes((0x80 | len(data),)) + data
+        elif len(data) < 1 << 12:
+            entry = bytes((0xE0 | (len(data) >> 8), len(data) & 0xFF)) + data
+        else:
+            entry = b"\xf0" + len(data).to_bytes(4, "little") + data
+    backlen = len(entry)
+    encoded = bytearray((backlen & 127,))
+    backlen >>= 7
+    while backlen:
+        encoded[0] |= 128
+        encoded.insert(0, backlen & 127)
+        backlen >>= 7
+    return entry + bytes(encoded)
+
+
+def build_listpack(elements) -> bytes:
+    """
+    Builds a listpack holding the given elements
+    """
+    entries = b"".join(listpack_entry(element) for element in elements)
+    count = len(elements) if len(elements) < 0xFFFF else 0xFFFF
+    return struct.pack("<IH", LISTPACK_HEADER_SIZE + len(entries) + 1, count) + entries + b"\xff"
+
+
+def write_stream(writer: RdbWriter, stream: RedisStream):
+    """
+    Writes a stream with the RDB_TYPE_STREAM_LISTPACKS_3 layout: one listpack per block whose master entry holds
+    the field names of the first entry, so entries sharing them are flagged SAMEFIELDS and store only their
+    values, then the metadata and the consumer groups
+    """
+    nodes = stream.nodes[stream.head:]
+    writer.write_length(len(nodes))
+    for node in nodes:
+        master_ms, master_seq = unpack_stream_id(node.ids[0])
+        master_fields = node.fields[0]
+        elements = [len(node.ids), 0, len(master_fields), *master_fields, 0]
+        for stream_id, fields, values in node.entries(0, len(node.ids)):
+            ms, seq = unpack_stream_id(stream_id)
+            if fields is master_fields:
+                elements += (STREAM_ITEM_FLAG_SAMEFIELDS, ms - master_ms, seq - master_seq, *values, len(values) + 3)
+            else:
+                elements += (0, ms - master_ms, seq - master_seq, len(fields))
+                for field, value in zip(fields, values):
+                    elements += (field, value)
+                elements.append(len(fields) * 2 + 4)
+        writer.write_string(node.ids[0].to_bytes(16, "big"))
+        writer.write_string(build_listpack(elements))
+    writer.write_length(stream.length)
+    for stream_id in (stream.last_id, stream.first_id, 0):
+        writer.write_length(stream_id >> STREAM_ID_SEQ_BITS)
+        writer.write_length(stream_id & ((1 << STREAM_ID_SEQ_BITS) - 1))
+    writer.write_length(stream.length)
+    writer.write_length(len(stream.groups))
+    for name, group in stream.groups.items():
+        writer.write_string(name)
+        writer.write_length(group.last_id >> STREAM_ID_SEQ_BITS)
+        writer.write_length(group.last_id & ((1 << STREAM_ID_SEQ_BITS) - 1))
+        writer.write_length(RDB_LENGTH_INVALID)
+        writer.write_length(len(group.pending))
+        for stream_id, nack in group.pending.range(0, (1 << 128) - 1):
+            writer.write_raw_stream_id(stream_id)
+            writer.write(struct.pack("<Q", nack.delivery_time))
+            writer.write_length(nack.delivery_count)
+        writer.write_length(len(group.consumers))
+        for consumer in group.consumers.values():
+            writer.write_string(consumer.name)
+            writer.write(struct.pack("<QQ", consumer.seen_time, consumer.seen_time))
+            writer.write_length(len(consumer.pending))
+            for stream_id, _ in consumer.pending.range(0, (1 << 128) - 1):
+                writer.write_raw_stream_id(stream_id)
+
+
+def write_object(writer: RdbWriter, key: str, value):
+    """
+    Writes a key with the type and the value that follow it
+
+    Args:
+        writer (RdbWriter): The writer
+        key (str): The key
+        value (str | int | RedisObject): The value
+    """
+    if isinstance(value, (str, int)):
+        writer.write(bytes((RDB_TYPE_STRING,)))
+        writer.write_string(key)
+        writer.write_string(value)
+    elif isinstance(value, RedisList):
+        writer.write(bytes((RDB_TYPE_LIST,)))
+        writer.write_string(key)
+        writer.write_length(len(value.items))
+        for item in value.items:
+            writer.write_string(item)
+    elif isinstance(value, RedisSet):
+        writer.write(bytes((RDB_TYPE_SET,)))
+        writer.write_string(key)
+        writer.write_length(len(value.members))
+        for member in value.members:
+            writer.write_string(member)
+    elif isinstance(value, RedisZSet):
+        writer.write(bytes((RDB_TYPE_ZSET_2,)))
+        writer.write_string(key)
+        writer.write_length(len(value.scores))
+        for member, score in value.scores.items():
+            writer.write_string(member)
+            writer.write(struct.pack("<d", score))
+    elif isinstance(value, RedisHash):
+        writer.write(bytes((RDB_TYPE_HASH,)))
+        writer.write_string(key)
+        writer.write_length(len(value.fields))
+        for field, field_value in value.fields.items():
+            writer.write_string(field)
+            writer.write_string(field_value)
+    elif isinstance(value, RedisStream):
+        writer.write(bytes((RDB_TYPE_STREAM_LISTPACKS_3,)))
+        writer.write_string(key)
+        write_stream(writer, value)
+    else:
+        raise Exception(f"Cannot save a value of type {type(value).__name__}")
+
+
+def save_rdb(out: BinaryIO, keyspace: Keyspace) -> int:
+    """
+    Writes a snapshot of the keyspace in the RDB format, expire times converted back to unix time.
+    The checksum is left to zero, which loaders take as "not computed".
+
+    Example:
+        with open("dump.rdb", "wb") as f:
+            save_rdb(f, redis_utils.keyspace)
+
+    Args:
+        out (BinaryIO): The file the snapshot is written to
+        keyspace (Keyspace): The keyspace
+
+    Returns:
+        int: The number of keys written
+    """
+    writer = RdbWriter(out)
+    writer.write(b"REDIS%04d" % RDB_VERSION)
+    for aux_key, aux_value in (("redis-ver", "7.2.0"), ("redis-bits", 64), ("ctime", int(time.time())),
+                               ("aof-base", 0)):
+        writer.write(bytes((RDB_OPCODE_AUX,)))
+        writer.write_string(aux_key)
+        writer.write_string(aux_value)
+    items = list(keyspace.data.items())
+    expires = dict(keyspace.expires)
+    writer.write(bytes((RDB_OPCODE_SELECTDB, 0, RDB_OPCODE_RESIZEDB)))
+    writer.write_length(len(items))
+    writer.write_length(len(expires))
+    unix_offset_ms = time.time_ns() // 1_000_000 - now_ms()
+    for key, value in items:
+        expire_ms = expires.get(key)
+        if expire_ms is not None:
+            writer.write(bytes((RDB_OPCODE_EXPIRETIME_MS,)))
+            writer.write(struct.pack("<Q", expire_ms + unix_offset_ms))
+        write_object(writer, key, value)
+    writer.write(bytes((RDB_OPCODE_EOF,)) + b"\0" * 8)
+    writer.flush()
+    return len(items)
@@ -1,779 +1,1622 @@
-import socket
+import fnmatch
+import itertools
+import resource
 import time
-from datetime import datetime, timedelta
 from typing import List, Tuple
 
-from app import redis_utils
-from .redis_utils import convert_to_resp
+from app import aof, blocking, cluster, expiry, redis_utils, replication
+from .connection import ConnContext
+from .keyspace import (MEMORY_USAGE_SAMPLES, RedisObject, monotonic_time_ms, now_ms, type_name_of,
+                       unix_time_ms)
+from .resp_encoder import (EMPTY_ARRAY, NULL_ARRAY, NULL_BULK, OK, PONG, encode_command, write_array,
+                           write_array_header, write_bulk_string, write_error, write_integer, write_simple_string)
+from .slots import HASH_SLOTS, key_hash_slot
+from .stream import (STREAM_ID_MAX, STREAM_ID_MIN, STREAM_ID_PART_MAX, ConsumerGroup, RedisStream, StreamConsumer,
+                     StreamNACK, format_stream_id, parse_stream_id)
 
+WRONGTYPE_ERR = "WRONGTYPE Operation against a key holding the wrong kind of value"
+SET_EXPIRE_UNITS_MS = {"ex": 1000, "px": 1, "exat": 1000, "pxat": 1}
+XPENDING_EMPTY_SUMMARY = b"*4\r\n:0\r\n" + NULL_BULK + NULL_BULK + NULL_ARRAY
 
-def set_command_helper(
-        message_arr: List[str],
-        n_args: int,
-        client_socket: socket,
-        addr: str = "",
-        from_master: bool = False,
-        is_multi_command: bool = False
-):
+
+def ping_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the PING command, replies PONG or echoes the optional message
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    if n_args > 1:
+        client.write(write_bulk_string(bytearray(), message_arr[1]))
+    else:
+        client.write(PONG)
+
+
+def echo_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the ECHO command and sends the message back to the client
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    client.write(write_bulk_string(bytearray(), message_arr[1]))
+
+
+def set_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
     Handles the SET command and sets the key-value pair in the Redis dictionary.
-    If a time-to-live (TTL) is provided, the key-value pair will expire after the specified time.
+    If a time-to-live (TTL) is provided with EX or PX, or an expire time with EXAT or PXAT (unix time), the key-value
+    pair will expire then, otherwise any previous TTL of the key is discarded unless KEEPTTL is given. With NX the key
+    is only set if it does not exist, with XX only if it does, the check and the write happen under the lock stripe
+    of the key. An expire is propagated as PXAT, so replicas and the AOF keep the original expire time.
 
     Example:
-        set_command_helper(["SET", "mykey", "myvalue"], 3, client_socket)
-        set_command_helper(["SET", "mykey", "myvalue", "PX", "1000"], 4, client_socket)
+        set_command_helper(["SET", "mykey", "myvalue"], 3, client)
+        set_command_helper(["SET", "mykey", "myvalue", "PX", "1000"], 5, client)
+        set_command_helper(["SET", "lock", "token", "NX", "PX", "30000"], 6, client)
 
     Args:
-        message_arr (List[str]): _description_
-        n_args (int): _description_
-        client_socket (socket): _description_
+        message_arr (List[str]): The parsed message array.
+        n_args (int): The number of arguments in the message array.
+        client (ConnContext): The client connection to write responses to.
     """
 
     if n_args >= 3:
-        index_px = next(
-            (i for i, item in enumerate(message_arr) if item.lower() == "px"), -1
-        )
-        if index_px != -1:
-            time_to_expire = datetime.now() + timedelta(
-                milliseconds=int(message_arr[index_px + 1])
-            )
-            redis_utils.redis_dict.update(
-                {message_arr[1]: (message_arr[2], time_to_expire)}
-            )
-        else:
-            redis_utils.redis_dict.update({message_arr[1]: message_arr[2]})
-        redis_utils.num_write_operations += 1
-        for sock_addr, socket in redis_utils.replica_sockets.items():
-            msg: str = " ".join(message_arr)
-            resp_msg = redis_utils.convert_to_resp(msg)
-
-            socket.send(resp_msg.encode())
-        if is_multi_command:
-            redis_utils.queue_commands_response.get(addr).append("+OK\r\n")
+        when_ms = None
+        keep_ttl = False
+        condition = None
+        i = 3
+        while i < n_args:
+            option = message_arr[i].lower()
+            if option in SET_EXPIRE_UNITS_MS and i + 1 < n_args and when_ms is None and not keep_ttl:
+                try:
+                    amount = int(message_arr[i + 1])
+                except ValueError:
+                    client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
+                    return
+                if amount <= 0:
+                    client.write(write_error(bytearray(), "ERR invalid expire time in 'set' command"))
+                    return
+                amount *= SET_EXPIRE_UNITS_MS[option]
+                when_ms = monotonic_time_ms(amount) if option.endswith("at") else now_ms() + amount
+                i += 2
+            elif option == "keepttl" and when_ms is None:
+                keep_ttl = True
+                i += 1
+            elif option in ("nx", "xx") and condition in (None, option):
+                condition = option
+                i += 1
+            else:
+                client.write(write_error(bytearray(), "ERR syntax error"))
+                return
+        key = message_arr[1]
+        keyspace = redis_utils.keyspace
+        if condition is not None and (keyspace.lookup(key) is None) != (condition == "nx"):
+            client.write(NULL_BULK)
+            return
+        if when_ms is not None and when_ms <= now_ms():
+            if keyspace.delete(key):
+                replication.propagate(["DEL", key], client)
+            client.write(OK)
             return
-        if not from_master:
-            client_socket.send(b"+OK\r\n")
+        keyspace.set(key, message_arr[2])
+        if when_ms is not None:
+            keyspace.set_expire(key, when_ms)
+            replication.propagate(["SET", key, message_arr[2], "PXAT", str(unix_time_ms(when_ms))], client)
+        else:
+            if not keep_ttl:
+                keyspace.remove_expire(key)
+            replication.propagate(message_arr, client)
+        client.write(OK)
 
     else:
-        client_socket.send(b"-ERR wrong number of arguments for 'SET'\r\n")
+        client.write(write_error(bytearray(), "ERR wrong number of arguments for 'SET'"))
 
 
-def get_command_helper(message_arr: List[str], n_args: int, client_socket: socket, addr: str,
-                       is_multi_command: bool = False):
+def get_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
     Handles the GET command and retrieves the value associated with the given key from the Redis dictionary.
 
     Example:
-        get_command_helper(["GET", "mykey"], 2, client_socket)
+        get_command_helper(["GET", "mykey"], 2, client)
 
     Args:
-        message_arr (List[str]): _description_
-        n_args (int): _description_
-        client_socket (socket): _description_
+        message_arr (List[str]): The parsed message array.
+        n_args (int): The number of arguments in the message array.
+        client (ConnContext): The client connection to write responses to.
     """
-    now = datetime.now()
-    result = redis_utils.redis_dict.get(message_arr[1])
-    if not result:
-        if is_multi_command:
-            redis_utils.queue_commands_response.get(addr).append("$-1\r\n")
-            return
-        client_socket.send(b"$-1\r\n")
-    elif isinstance(result, str):
-        resp = convert_to_resp(redis_utils.redis_dict.get(message_arr[1]))
-        if is_multi_command:
-            redis_utils.queue_commands_response.get(addr).append(resp)
-            return
-        client_socket.send(resp.encode())
-    elif isinstance(result, Tuple):
-        if result[1] < now:
-            redis_utils.redis_dict.pop(message_arr[1])
-            if is_multi_command:
-                redis_utils.queue_commands_response.get(addr).append("$-1\r\n")
-                return
-            client_socket.send(b"$-1\r\n")
-        else:
-            resp = convert_to_resp(result[0])
-            if is_multi_command:
-                redis_utils.queue_commands_response.get(addr).append(resp)
-                return
-            client_socket.send(resp.encode())
+    result = redis_utils.keyspace.lookup(message_arr[1])
+    if result is None:
+        client.write(NULL_BULK)
+    elif isinstance(result, RedisObject):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+    else:
+        client.write(write_bulk_string(bytearray(), result))
 
 
 def config_get_command_helper(
-        message_arr: List[str], n_args: int, client_socket: socket
+        message_arr: List[str], n_args: int, client: ConnContext
 ):
     """
     Handles the CONFIG GET command and retrieves the value associated with the given configuration option from Redis.
+    An unknown option gets an empty array.
 
     Example:
-        config_get_command_helper(["CONFIG", "GET", "dir"], 3, client_socket)
-        config_get_command_helper(["CONFIG", "GET", "dbfilename"], 3, client_socket)
+        config_get_command_helper(["CONFIG", "GET", "dir"], 3, client)
+        config_get_command_helper(["CONFIG", "GET", "dbfilename"], 3, client)
 
     Args:
-        message_arr (List[str]): _description_
-        n_args (int): _description_
-        client_socket (socket): _description_
+        message_arr (List[str]): The parsed message array.
+        n_args (int): The number of arguments in the message array.
+        client (ConnContext): The client connection to write responses to.
     """
-    if message_arr[1].lower() == "get":
-        if message_arr[2].lower() == "dir":
-            resp = convert_to_resp(f"dir {redis_utils.dir}")
-            client_socket.send(resp.encode())
-        elif message_arr[2].lower() == "dbfilename":
-            resp = convert_to_resp(f"dbfilename {redis_utils.dbfilename}")
-            client_socket.send(resp.encode())
+    if message_arr[1].lower() != "get":
+        client.write(write_error(bytearray(), f"ERR unknown subcommand '{message_arr[1]}'. Try CONFIG HELP."))
+        return
+    parameter = message_arr[2].lower()
+    if parameter == "dir":
+        client.write(write_array(bytearray(), ["dir", redis_utils.dir]))
+    elif parameter == "dbfilename":
+        client.write(write_array(bytearray(), ["dbfilename", redis_utils.dbfilename]))
+    elif parameter == "client-output-buffer-limit":
+        normal = " ".join(str(n) for n in redis_utils.client_output_buffer_limit)
+        replica = " ".join(str(n) for n in redis_utils.replica_output_buffer_limit)
+        client.write(write_array(bytearray(), ["client-output-buffer-limit", f"normal {normal} slave {replica}"]))
+    else:
+        client.write(EMPTY_ARRAY)
 
 
-def keys_get_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+def keys_get_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the KEYS command and retrieves all keys in the Redis dictionary.
+    Handles the KEYS command and retrieves all keys matching a glob-style pattern from the keyspace.
+
+    Example:
+        keys_get_command_helper(["KEYS", "*"], 2, client)
+        keys_get_command_helper(["KEYS", "user:*"], 2, client)
 
     Args:
-        message_arr (List[str]): _description_
-        n_args (int): _description_
-        client_socket (socket): _description_
+        message_arr (List[str]): The parsed message array.
+        n_args (int): The number of arguments in the message array.
+        client (ConnContext): The client connection to write responses to.
     """
-    if message_arr[1].lower() == "*":
-        rdb_content = redis_utils.parse_rdb()
-        keys = list(rdb_content.keys())
-        resp = ""
-        if len(keys) == 1:
-            resp = client_socket.send(
-                "*1\r\n${}\r\n{}\r\n".format(len(keys[0]), keys[0]).encode()
-            )
-        else:
-            resp = convert_to_resp(" ".join(keys))
-        client_socket.send(resp.encode())
+    pattern = message_arr[1]
+    keys = redis_utils.keyspace.keys()
+    if pattern != "*":
+        keys = [key for key in keys if fnmatch.fnmatchcase(key, pattern)]
+    client.write(write_array(bytearray(), keys))
 
 
-def rdb_get_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+def info_replication() -> List[str]:
+    """
+    Returns the lines of the replication section of INFO
+    """
+    lines = ["role:slave" if redis_utils.replicaof else "role:master"]
+    if redis_utils.replicaof:
+        host, _, port = redis_utils.replicaof.partition(" ")
+        lines += [f"master_host:{host}", f"master_port:{port}",
+                  f"master_link_status:{'up' if replication.master_link_up else 'down'}"]
+    else:
+        lines.append(f"connected_slaves:{len(redis_utils.replica_sockets)}")
+        lines += replication.replica_info_lines()
+    backlog = replication.backlog
+    lines += [
+        f"master_replid:{replication.replid}",
+        f"master_repl_offset:{replication.master_repl_offset()}",
+        f"repl_backlog_active:{int(backlog is not None)}",
+        f"repl_backlog_size:{redis_utils.repl_backlog_size}",
+        f"repl_backlog_first_byte_offset:{backlog.first_byte_offset if backlog else 0}",
+        f"repl_backlog_histlen:{backlog.histlen if backlog else 0}",
+    ]
+    return lines
+
+
+def info_persistence() -> List[str]:
     """
-    Handles the RDB GET command and retrieves the value associated with the given key from the Redis RDB file.
+    Returns the lines of the persistence section of INFO, aof_commands, aof_writes and aof_fsyncs show how many
+    commands each write and each fsync of the AOF covered
+    """
+    lines = [f"loading:{int(redis_utils.loading)}"]
+    if redis_utils.loading:
+        total = redis_utils.loading_total_bytes
+        loaded = redis_utils.loading_loaded_bytes
+        elapsed = max(time.time() - redis_utils.loading_start_time, 0)
+        lines += [
+            f"loading_start_time:{redis_utils.loading_start_time}",
+            f"loading_total_bytes:{total}",
+            f"loading_loaded_bytes:{loaded}",
+            f"loading_loaded_perc:{loaded * 100 / total if total else 0:.2f}",
+            f"loading_eta_seconds:{int(elapsed * (total - loaded) / loaded) if loaded else 1}",
+        ]
+    lines += [
+        f"rdb_last_load_keys_loaded:{redis_utils.rdb_last_load_keys_loaded}",
+        f"rdb_last_load_keys_expired:{redis_utils.rdb_last_load_keys_expired}",
+        f"rdb_last_load_time_ms:{redis_utils.rdb_last_load_time_ms}",
+        f"aof_enabled:{int(aof.writer is not None)}",
+    ]
+    if aof.writer is not None:
+        lines += [
+            f"aof_current_size:{aof.writer.offset}",
+            f"aof_buffer_length:{len(aof.writer.buf)}",
+            f"aof_commands:{aof.writer.commands}",
+            f"aof_writes:{aof.writer.writes}",
+            f"aof_fsyncs:{aof.writer.fsyncs}",
+        ]
+    return lines
+
+
+def info_stats() -> List[str]:
+    """
+    Returns the lines of the stats section of INFO
+    """
+    locks = redis_utils.keyspace.locks
+    return [
+        f"expired_keys:{redis_utils.keyspace.expired_keys}",
+        f"expired_time_cap_reached_count:{expiry.expired_time_cap_reached_count}",
+        f"keyspace_lock_stripes:{len(locks.locks)}",
+        f"keyspace_lock_acquisitions:{sum(locks.acquisitions)}",
+        f"keyspace_lock_contentions:{sum(locks.contentions)}",
+    ]
 
-    Example:
-        rdb_get_command_helper(["RDB", "mykey"], 2, client_socket)
 
-    Args:
-        message_arr (List[str]): _description_
-        n_args (int): _description_
-        client_socket (socket): _description_
+def info_keyspace() -> List[str]:
     """
-    if message_arr[1]:
-        rdb_content = redis_utils.parse_rdb()
-        value = rdb_content.get(message_arr[1])
-        if value:
-            if value[1]:
-                curr = time.time_ns()
-                if curr > value[1]:
-                    client_socket.send("$-1\r\n".encode())
-                    return
-            resp = convert_to_resp(value[0])
-            client_socket.send(resp.encode())
-        else:
-            client_socket.send("*0\r\n".encode())
+    Returns the lines of the keyspace section of INFO
+    """
+    keyspace = redis_utils.keyspace
+    if not len(keyspace):
+        return []
+    return [f"db0:keys={len(keyspace)},expires={len(keyspace.expires)},avg_ttl=0"]
+
+
+def info_clients() -> List[str]:
+    """
+    Returns the lines of the clients section of INFO
+    """
+    return [f"blocked_clients:{blocking.blocked_clients()}"]
+
 
+def info_memory() -> List[str]:
+    """
+    Returns the lines of the memory section of INFO, the resident set size of the process and the
+    bytes spent on the hash tables of the keyspace, whose per-key share is the overhead of a key
+    """
+    keyspace = redis_utils.keyspace
+    overhead = keyspace.overhead()
+    overhead_total = sum(overhead.values())
+    lines = [
+        f"used_memory_rss:{used_memory_rss()}",
+        f"used_memory_peak:{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}",
+        f"used_memory_overhead:{overhead_total}",
+    ]
+    lines += [f"{name}:{size}" for name, size in overhead.items()]
+    lines += [
+        f"keys:{len(keyspace)}",
+        f"keys_with_expire:{len(keyspace.expires)}",
+        f"overhead_per_key:{overhead_total // len(keyspace) if len(keyspace) else 0}",
+    ]
+    return lines
+
+
+def info_cluster() -> List[str]:
+    """
+    Returns the lines of the cluster section of INFO
+    """
+    return [f"cluster_enabled:{int(cluster.enabled)}"]
 
-def info_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+
+def used_memory_rss() -> int:
+    """
+    Returns the resident set size of the server process in bytes, read from /proc where available
+
+    Returns:
+        int: The resident set size in bytes, the peak one on platforms without /proc
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+INFO_SECTIONS = {
+    "clients": info_clients,
+    "memory": info_memory,
+    "persistence": info_persistence,
+    "stats": info_stats,
+    "replication": info_replication,
+    "keyspace": info_keyspace,
+    "cluster": info_cluster,
+}
+
+
+def info_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
     Handles the INFO command and retrieves information about the Redis server.
+    Without arguments, or with "all", "default" or "everything", every section is returned.
 
     Example:
-        info_command_helper(["INFO", "replication"], 2, client_socket)
+        info_command_helper(["INFO", "replication"], 2, client)
 
     Args:
         message_arr (List[str]): The parsed message array.
         n_args (int): The number of arguments in the message array.
-        client_socket (socket): The socket representing the client connection.
+        client (ConnContext): The client connection to write responses to.
     """
-    if message_arr[1].lower() == "replication":
-        data = "role:master"
-        if redis_utils.replicaof:
-            data = "role:slave"
-        data += (
-            "master_replid:8371b4fb1155b71f4a04d3e1bc3e18c4a990aeebmaster_repl_offset:0"
-        )
-        resp_msg = redis_utils.convert_to_resp(data)
-        client_socket.send(resp_msg.encode())
+    requested = {section.lower() for section in message_arr[1:]}
+    every_section = not requested or bool(requested & {"all", "default", "everything"})
+    sections = []
+    for name, section_lines in INFO_SECTIONS.items():
+        if every_section or name in requested:
+            lines = [f"# {name.capitalize()}"] + section_lines()
+            sections.append("\r\n".join(lines) + "\r\n")
+    client.write(write_bulk_string(bytearray(), "\r\n".join(sections)))
 
 
-def wait_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+def wait_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the WAIT command and waits for a specified number of replicas to acknowledge a write operation.
+    Handles the WAIT command: waits until the given number of replicas acknowledged the offset of the last write
+    of the client, or until the timeout in milliseconds expires (0 waits forever), and returns the number of
+    replicas that did. Replicas are asked for an acknowledgment with REPLCONF GETACK and every REPLCONF ACK
+    wakes the waiter, so WAIT returns as soon as the replicas caught up.
+
+    Example:
+        wait_command_helper(["WAIT", "1", "500"], 3, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
+        client (ConnContext): The client connection to write responses to.
     """
-    num_replicas = int(message_arr[1])
-    wait_time = float(message_arr[2]) / 1000
-    if num_replicas == 0:
-        client_socket.send(f":0\r\n".encode())
+    try:
+        num_replicas = int(message_arr[1])
+        timeout_ms = int(message_arr[2])
+    except ValueError:
+        client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
+        return
+    if timeout_ms < 0:
+        client.write(write_error(bytearray(), "ERR timeout is negative"))
+        return
+    if redis_utils.replicaof:
+        client.write(write_error(bytearray(), "ERR WAIT cannot be used with replica instances."))
         return
-    for sock_addr, socket in redis_utils.replica_sockets.items():
-        getack_msg = "REPLCONF GETACK *"
-        socket.send(redis_utils.convert_to_resp(getack_msg).encode())
+    if client.deny_blocking:
+        with replication.lock:
+            acked = replication.count_acked_replicas(client.woff)
+    else:
+        acked = replication.wait_for_replicas(client.woff, num_replicas, timeout_ms)
+    client.write(write_integer(bytearray(), acked))
+
 
-    if wait_time:
-        time.sleep(wait_time)
-    if redis_utils.num_write_operations == 0:
-        client_socket.send(f":{len(redis_utils.replica_sockets)}\r\n".encode())
+def replconf_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the REPLCONF command sent by replicas during the handshake and to acknowledge offsets.
+    Options come in option/value pairs, GETACK and ACK get no reply like in Redis.
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    option = message_arr[1].lower()
+    if n_args % 2 == 0:
+        client.write(write_error(bytearray(), "ERR syntax error"))
+    elif option == "listening-port":
+        try:
+            replication.replica_of(client).listening_port = int(message_arr[2])
+        except ValueError:
+            client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
+            return
+        client.write(OK)
+    elif option == "capa":
+        client.write(OK)
+    elif option == "getack":
+        if client.from_master:
+            client.write(encode_command(["REPLCONF", "ACK", replication.master_repl_offset()]), force=True)
+    elif option == "ack":
+        try:
+            replication.record_ack(client, int(message_arr[2]))
+        except ValueError:
+            pass
     else:
-        ans = 0
-        if redis_utils.num_replicas_ack == (
-                redis_utils.num_write_operations * len(redis_utils.replica_sockets)
-        ):
-            ans = len(redis_utils.replica_sockets)
+        client.write(write_error(bytearray(), f"ERR Unrecognized REPLCONF option: {message_arr[1]}"))
+
+
+def psync_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the PSYNC command and registers the replica. PSYNC <replid> <offset> with the replication ID of this
+    master and an offset still held by the backlog is answered +CONTINUE followed by the bytes the replica missed,
+    anything else gets a full resynchronization: +FULLRESYNC followed by a snapshot of the keyspace.
+
+    Example:
+        psync_command_helper(["PSYNC", "?", "-1"], 3, client)
+        psync_command_helper(["PSYNC", "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb", "1093"], 3, client)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    backlog = replication.create_backlog()
+    with replication.lock:
+        missed = None
+        if message_arr[1] == replication.replid:
+            try:
+                missed = backlog.read_from(int(message_arr[2]))
+            except ValueError:
+                pass
+        if missed is not None:
+            client.write(write_simple_string(bytearray(), f"CONTINUE {replication.replid}"))
+            client.write(missed)
+            replication.add_replica(client)
         else:
-            ans = redis_utils.num_replicas_ack % len(redis_utils.replica_sockets)
-        client_socket.send(f":{ans}\r\n".encode())
-    redis_utils.num_replicas_ack = 0
+            client.write(write_simple_string(bytearray(), f"FULLRESYNC {replication.replid} {backlog.offset}"))
+            replication.start_full_sync(client)
 
 
-def type_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+def type_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
     Handles the TYPE command and returns the type of the value associated with the given key.
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
+        client (ConnContext): The client connection to write responses to.
 
     Returns:
         None
     """
 
-    key = message_arr[1]
-    if redis_utils.redis_streams_dict.get(key):
-        client_socket.send("+stream\r\n".encode())
-        return
-    value = redis_utils.redis_dict.get(key, None)
-    if value:
-        type_of_value = ""
-        if isinstance(value, str):
-            type_of_value = "string"
-        type_value_resp = redis_utils.convert_to_resp(type_of_value)
-        client_socket.send(type_value_resp.encode())
+    value = redis_utils.keyspace.lookup(message_arr[1])
+    if value is None:
+        client.write(write_simple_string(bytearray(), "none"))
     else:
-        client_socket.send("+none\r\n".encode())
+        client.write(write_simple_string(bytearray(), type_name_of(value)))
 
 
-def xadd_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+def xadd_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the XADD command and appends a new item to the Redis stream with the given key and ID.
+    Handles the XADD command: XADD key [NOMKSTREAM] [MAXLEN|MINID [=|~] threshold [LIMIT count]] id field value
+    [field value ...]
+
+    The ID is validated against the last ID of the stream itself, "*" and "<ms>-*" generate it. The stream is
+    trimmed right after the append, "~" trims whole blocks only which keeps the cost O(1) amortized per append.
+
+    Example:
+        xadd_command_helper(["XADD", "mystream", "*", "temperature", "36"], 5, client)
+        xadd_command_helper(["XADD", "mystream", "MAXLEN", "~", "1000", "*", "temperature", "36"], 8, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
+        client (ConnContext): The client connection to write responses to.
 
     Returns:
         None
     """
     stream_key = message_arr[1]
-    stream_key_id = message_arr[2]
-    if stream_key_id == "*":
-        xadd_auto_gen_time_seqnum(message_arr, n_args, client_socket, stream_key, stream_key_id)
+    nomkstream = False
+    trim = None
+    i = 2
+    try:
+        while i < n_args:
+            option = message_arr[i].lower()
+            if option == "nomkstream":
+                nomkstream = True
+                i += 1
+            elif option in ("maxlen", "minid"):
+                trim, i = parse_trim_args(message_arr, i)
+            else:
+                break
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
         return
-    if redis_utils.wait_until_new_add_stream:
-        redis_utils.wait_until_new_add_stream = False
-    stream_time, stream_seq_num = stream_key_id.split("-")
-    if stream_time == "0" and stream_seq_num == "0":
-        client_socket.send(b"-ERR The ID specified in XADD must be greater than 0-0\r\n")
+    fields = message_arr[i + 1:]
+    if not fields or len(fields) % 2:
+        client.write(write_error(bytearray(), "ERR wrong number of arguments for 'xadd' command"))
         return
 
-    if stream_seq_num == "*":
-        xadd_auto_gen_seq_num(message_arr, n_args, client_socket, stream_key, stream_key_id, stream_time,
-                              stream_seq_num)
+    stream = redis_utils.keyspace.lookup(stream_key)
+    created = stream is None
+    if created:
+        if nomkstream:
+            client.write(NULL_BULK)
+            return
+        stream = RedisStream()
+    elif not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
         return
-    else:
-        xadd_default(message_arr, n_args, client_socket, stream_key, stream_key_id, stream_time, stream_seq_num)
+    try:
+        stream_id = stream.next_id(message_arr[i], int(time.time() * 1000))
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
         return
+    if created:
+        redis_utils.keyspace.set(stream_key, stream)
+    stream.append(stream_id, tuple(fields[::2]), tuple(fields[1::2]))
+    args = ["XADD", stream_key, format_stream_id(stream_id), *fields]
+    if trim is not None:
+        trim_stream(stream, *trim)
+        args[2:2] = exact_trim_args(stream, trim[0])
+    redis_utils.keyspace.touch(stream_key)
+    replication.propagate(args, client)
+    blocking.signal_key_as_ready(stream_key)
+    client.write(write_bulk_string(bytearray(), format_stream_id(stream_id)))
+
+
+def parse_trim_args(message_arr: List[str], i: int) -> Tuple[Tuple[str, int, bool, int | None], int]:
+    """
+    Parses the trimming arguments shared by XADD and XTRIM: MAXLEN|MINID [=|~] threshold [LIMIT count]
 
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        i (int): The index of the MAXLEN or MINID argument
+
+    Raises:
+        ValueError: If the arguments are not valid, with the error to reply
+
+    Returns:
+        Tuple[Tuple[str, int, bool, int | None], int]: The (strategy, threshold, approx, limit) of the trimming and
+        the index of the first argument after it
+    """
+    strategy = message_arr[i].lower()
+    i += 1
+    approx = False
+    if i < len(message_arr) and message_arr[i] in ("=", "~"):
+        approx = message_arr[i] == "~"
+        i += 1
+    if i >= len(message_arr):
+        raise ValueError("ERR syntax error")
+    if strategy == "maxlen":
+        try:
+            threshold = int(message_arr[i])
+        except ValueError:
+            raise ValueError("ERR value is not an integer or out of range")
+        if threshold < 0:
+            raise ValueError("ERR The MAXLEN argument must be >= 0.")
+    else:
+        threshold = parse_stream_id(message_arr[i])
+    i += 1
+    limit = None
+    if i + 1 < len(message_arr) and message_arr[i].lower() == "limit":
+        try:
+            limit = int(message_arr[i + 1])
+        except ValueError:
+            raise ValueError("ERR value is not an integer or out of range")
+        if limit < 0:
+            raise ValueError("ERR The LIMIT argument must be >= 0.")
+        if not approx:
+            raise ValueError("ERR syntax error, LIMIT cannot be used without the special ~ option")
+        i += 2
+    return (strategy, threshold, approx, limit or None), i
+
+
+def trim_stream(stream: RedisStream, strategy: str, threshold: int, approx: bool, limit: int | None) -> int:
+    """
+    Trims a stream with the arguments parsed by parse_trim_args
 
-def xadd_auto_gen_seq_num(message_arr: List[str], n_args: int, client_socket: socket, stream_key: str,
-                          stream_key_id: str, stream_time: str, stream_seq_num: str):
+    Returns:
+        int: The number of entries removed
     """
-    Handles the XADD command with auto-generated sequence numbers for the Redis stream.
+    if strategy == "maxlen":
+        return stream.trim_maxlen(threshold, approx, limit)
+    return stream.trim_minid(threshold, approx, limit)
 
-    This function is invoked when the sequence number part of the stream ID is specified as "*",
-    indicating that the server should auto-generate the sequence number. It updates the Redis stream
-    with the new entry and sends the generated stream ID back to the client.
+
+def exact_trim_args(stream: RedisStream, strategy: str) -> List[str]:
+    """
+    Returns the trimming arguments that reproduce a trim exactly on a replica, "~" trims whole blocks whose
+    boundaries the replica does not share
+
+    Args:
+        stream (RedisStream): The trimmed stream
+        strategy (str): "maxlen" or "minid"
+    """
+    if strategy == "maxlen":
+        return ["MAXLEN", "=", str(stream.length)]
+    return ["MINID", "=", format_stream_id(stream.first_id)]
+
+
+def xtrim_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the XTRIM command: XTRIM key MAXLEN|MINID [=|~] threshold [LIMIT count], replies the number of
+    entries removed
+
+    Example:
+        xtrim_command_helper(["XTRIM", "mystream", "MAXLEN", "~", "1000"], 5, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        stream_key (str): The stream key to which the message is being added.
-        stream_key_id (str): The stream ID specified in the command.
-        stream_time (str): The timestamp part of the stream ID.
-        stream_seq_num (str): The sequence number part of the stream ID.
+        client (ConnContext): The client connection to write responses to.
 
     Returns:
         None
     """
-    if len(redis_utils.redis_streams_dict) == 0:
-        if stream_time == "0":
-            new_stream_key_id = "0-1"
-            if redis_utils.redis_streams_dict.get(stream_key):
-                redis_utils.redis_streams_dict.get(stream_key).append(
-                    {"id": new_stream_key_id, message_arr[3]: message_arr[4]})
-            else:
-                redis_utils.redis_streams_dict.update(
-                    {stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-            client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
-            redis_utils.last_stream_id = stream_key_id
-
-        else:
-            new_stream_key_id = f"{stream_time}-0"
-            if redis_utils.redis_streams_dict.get(stream_key):
-                redis_utils.redis_streams_dict.get(stream_key).append(
-                    {"id": new_stream_key_id, message_arr[3]: message_arr[4]})
-            else:
-                redis_utils.redis_streams_dict.update(
-                    {stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-            redis_utils.last_stream_id = new_stream_key_id
-            client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
+    if message_arr[2].lower() not in ("maxlen", "minid"):
+        client.write(write_error(bytearray(), "ERR syntax error"))
+        return
+    try:
+        trim, i = parse_trim_args(message_arr, 2)
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    if i != n_args:
+        client.write(write_error(bytearray(), "ERR syntax error"))
         return
+    stream = redis_utils.keyspace.lookup(message_arr[1])
+    if stream is None:
+        client.write(write_integer(bytearray(), 0))
+    elif not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
     else:
-        last_stream_id: str = redis_utils.last_stream_id
-        last_stream_time, last_stream_seq_num = last_stream_id.split("-")
-        if int(stream_time) == int(last_stream_time):
-            new_stream_key_id = f"{stream_time}-{int(last_stream_seq_num) + 1}"
-            if redis_utils.redis_streams_dict.get(stream_key):
-                redis_utils.redis_streams_dict.get(stream_key).append(
-                    {"id": new_stream_key_id, message_arr[3]: message_arr[4]})
-            else:
-                redis_utils.redis_streams_dict.update(
-                    {stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-            redis_utils.last_stream_id = new_stream_key_id
-            client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
-        elif int(stream_time) < int(last_stream_time):
-            client_socket.send(b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n")
-        else:
-            new_stream_key_id = f"{stream_time}-0"
-            if redis_utils.redis_streams_dict.get(stream_key):
-                redis_utils.redis_streams_dict.get(stream_key).append(
-                    {"id": new_stream_key_id, message_arr[3]: message_arr[4]})
-            else:
-                redis_utils.redis_streams_dict.update(
-                    {stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-            redis_utils.last_stream_id = new_stream_key_id
-            client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
+        removed = trim_stream(stream, *trim)
+        if removed:
+            redis_utils.keyspace.touch(message_arr[1])
+            replication.propagate(["XTRIM", message_arr[1], *exact_trim_args(stream, trim[0])], client)
+        client.write(write_integer(bytearray(), removed))
+
+
+def xlen_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the XLEN command, the length is kept by the stream so this is O(1)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    stream = redis_utils.keyspace.lookup(message_arr[1])
+    if stream is None:
+        client.write(write_integer(bytearray(), 0))
+    elif not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+    else:
+        client.write(write_integer(bytearray(), stream.length))
 
 
-def xadd_default(message_arr: List[str], n_args: int, client_socket: socket, stream_key: str, stream_key_id: str,
-                 stream_time: str, stream_seq_num: str):
+def xrange_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the XADD command with auto-generated timestamps and sequence numbers for the Redis stream.
+    Handles the XRANGE command and retrieves the entries of a stream whose IDs are between start and end.
+
+    "-" and "+" stand for the smallest and the greatest possible IDs, an ID without sequence number means the first
+    sequence number of that millisecond for start and the last one for end, and a "(" prefix excludes the bound.
+    The first entry is found by bisecting the stream, so only the returned entries are walked.
 
-    This function is invoked when the timestamp and sequence number parts of the stream ID are both specified as "*",
-    indicating that the server should auto-generate both the timestamp and sequence number. It updates the Redis stream
-    with the new entry and sends the generated stream ID back to the client.
+    Example:
+        xrange_command_helper(["XRANGE", "mystream", "-", "+"], 4, client)
+        xrange_command_helper(["XRANGE", "mystream", "1526985054069", "+", "COUNT", "10"], 6, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        stream_key (str): The stream key to which the message is being added.
-        stream_key_id (str): The stream ID specified in the command.
-        stream_time (str): The timestamp part of the stream ID.
-        stream_seq_num (str): The sequence number part of the stream ID.
+        client (ConnContext): The client connection to write responses to.
 
     Returns:
         None
     """
-    if len(redis_utils.redis_streams_dict) == 0:
-        redis_utils.redis_streams_dict.update({stream_key: [{"id": stream_key_id, message_arr[3]: message_arr[4]}]})
-        client_socket.send(redis_utils.convert_to_resp(stream_key_id).encode())
-        redis_utils.last_stream_id = stream_key_id
-    else:
-        last_stream_id: str = redis_utils.last_stream_id
-        last_stream_time, last_stream_seq_num = last_stream_id.split("-")
-        if int(stream_time) == int(last_stream_time):
-            if int(stream_seq_num) <= int(last_stream_seq_num):
-                client_socket.send(
-                    b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n")
-                return
-        elif int(stream_time) < int(last_stream_time):
-            client_socket.send(b"-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n")
+    count = None
+    if n_args == 6 and message_arr[4].lower() == "count":
+        try:
+            count = max(int(message_arr[5]), 0)
+        except ValueError:
+            client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
             return
+    elif n_args != 4:
+        client.write(write_error(bytearray(), "ERR syntax error"))
+        return
+    try:
+        start = parse_range_id(message_arr[2], False)
+        end = parse_range_id(message_arr[3], True)
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    stream = redis_utils.keyspace.lookup(message_arr[1])
+    if stream is None:
+        client.write(EMPTY_ARRAY)
+    elif not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+    else:
+        client.write(redis_utils.write_stream_entries(bytearray(), stream.range(start, end, count)))
 
-        if redis_utils.redis_streams_dict.get(stream_key):
-            redis_utils.redis_streams_dict.get(stream_key).append({"id": stream_key_id, message_arr[3]: message_arr[4]})
-        else:
-            redis_utils.redis_streams_dict.update({stream_key: [{"id": stream_key_id, message_arr[3]: message_arr[4]}]})
-        client_socket.send(redis_utils.convert_to_resp(stream_key_id).encode())
-        redis_utils.last_stream_id = stream_key_id
 
+def parse_range_id(value: str, is_end: bool) -> int:
+    """
+    Parses a bound of XRANGE, supporting the "(" prefix of exclusive bounds
+
+    Args:
+        value (str): The bound as given by the client
+        is_end (bool): Whether the bound is the end of the range
 
-def xadd_auto_gen_time_seqnum(message_arr: List[str], n_args: int, client_socket: socket, stream_key: str,
-                              stream_key_id: str):
+    Raises:
+        ValueError: If the bound is not a valid ID
+
+    Returns:
+        int: The packed ID of the inclusive bound
     """
-    Handles the XADD command with auto-generated timestamps and sequence numbers for the Redis stream.
+    if not value.startswith("("):
+        return parse_stream_id(value, STREAM_ID_PART_MAX if is_end else 0)
+    stream_id = parse_stream_id(value[1:], STREAM_ID_PART_MAX if is_end else 0)
+    if value[1:] in ("-", "+") or stream_id == (STREAM_ID_MIN if is_end else STREAM_ID_MAX):
+        raise ValueError(f"ERR invalid {'end' if is_end else 'start'} ID for the interval")
+    return stream_id - 1 if is_end else stream_id + 1
 
-    This function is invoked when the timestamp and sequence number parts of the stream ID are both specified as "*",
-    indicating that the server should auto-generate both the timestamp and sequence number. It updates the Redis stream
-    with the new entry and sends the generated stream ID back to the client.
+
+def parse_xread_args(message_arr: List[str], start: int = 1,
+                     group: bool = False) -> Tuple[int | None, int | None, bool, List[str], List[str]]:
+    """
+    Parses the arguments of XREAD: [COUNT count] [BLOCK milliseconds] STREAMS key [key ...] id [id ...],
+    and of XREADGROUP after GROUP group consumer, which also accepts NOACK
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        start (int, optional): The index of the first option. Defaults to 1.
+        group (bool, optional): Whether the command is XREADGROUP. Defaults to False.
+
+    Raises:
+        ValueError: If the arguments are not valid, with the error to reply
+
+    Returns:
+        Tuple[int | None, int | None, bool, List[str], List[str]]: The count, the block timeout in milliseconds,
+        the NOACK option, the keys and the IDs
+    """
+    count = None
+    block_ms = None
+    noack = False
+    i = start
+    while i < len(message_arr):
+        option = message_arr[i].lower()
+        if option == "streams":
+            break
+        if group and option == "noack":
+            noack = True
+            i += 1
+            continue
+        if option not in ("count", "block") or i + 1 >= len(message_arr):
+            raise ValueError("ERR syntax error")
+        try:
+            value = int(message_arr[i + 1])
+        except ValueError:
+            raise ValueError("ERR timeout is not an integer or out of range" if option == "block"
+                             else "ERR value is not an integer or out of range")
+        if option == "count":
+            count = value if value > 0 else None
+        else:
+            if value < 0:
+                raise ValueError("ERR timeout is negative")
+            block_ms = value
+        i += 2
+    streams = message_arr[i + 1:]
+    if i >= len(message_arr) or not streams or len(streams) % 2:
+        raise ValueError(f"ERR Unbalanced '{'xreadgroup' if group else 'xread'}' list of streams: for each stream "
+                         f"key an ID or '{'>' if group else '$'}' must be specified.")
+    half = len(streams) // 2
+    return count, block_ms, noack, streams[:half], streams[half:]
+
+
+def xread_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the XREAD command. The "$" ID stands for the last ID of the stream when the command was received.
+
+    With BLOCK and no new entry yet, the client is blocked on the stream keys: XADD to one of them serves it
+    with the entries added after the requested IDs, a timer replies null once the timeout expires.
+
+    Example:
+        xread_command_helper(["XREAD", "COUNT", "2", "STREAMS", "mystream", "0-0"], 6, client)
+        xread_command_helper(["XREAD", "BLOCK", "1000", "STREAMS", "mystream", "$"], 6, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        stream_key (str): The stream key to which the message is being added.
-        stream_key_id (str): The stream ID specified in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    try:
+        count, block_ms, _, keys, ids = parse_xread_args(message_arr)
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    from_ids = []
+    for key, stream_id in zip(keys, ids):
+        stream = redis_utils.keyspace.lookup(key)
+        if stream is not None and not isinstance(stream, RedisStream):
+            client.write(write_error(bytearray(), WRONGTYPE_ERR))
+            return
+        try:
+            from_ids.append((stream.last_id if stream else STREAM_ID_MIN) if stream_id == "$"
+                            else parse_stream_id(stream_id))
+        except ValueError as e:
+            client.write(write_error(bytearray(), str(e)))
+            return
+
+    def serve() -> bool:
+        return xread_streams_helper(client, keys, from_ids, count)
+
+    if serve():
+        return
+    if block_ms is None:
+        client.write(NULL_BULK)
+        return
+    blocking.block_for_keys(client, keys, block_ms, serve, lambda: client.write(NULL_BULK))
+
+
+def xread_streams_helper(client: ConnContext, keys: List[str], from_ids: List[int], count: int | None = None) -> bool:
+    """
+    Replies the entries added to every stream after the given ID, streams without new entries are left out.
+    Nothing is written when none of them has any.
+
+    Args:
+        client (ConnContext): The client connection to write responses to.
+        keys (List[str]): The stream keys.
+        from_ids (List[int]): The packed ID to read after, for every key.
+        count (int | None, optional): The maximum number of entries per stream. Defaults to None.
 
     Returns:
-        None
+        bool: True if a reply was written
+    """
+    stream_list_with_key = []
+    for key, from_id in zip(keys, from_ids):
+        stream = redis_utils.keyspace.lookup(key)
+        if isinstance(stream, RedisStream):
+            entries = stream.range_after(from_id, count)
+            if entries:
+                stream_list_with_key.append((key, entries))
+    if not stream_list_with_key:
+        return False
+    client.write(redis_utils.write_xread_streams(bytearray(), stream_list_with_key))
+    return True
+
+
+def lookup_stream_group(client: ConnContext, key: str, group_name: str,
+                        nogroup_err: str) -> Tuple[RedisStream | None, ConsumerGroup | None]:
+    """
+    Looks up a stream and one of its consumer groups, replying an error when either is missing
+
+    Args:
+        client (ConnContext): The client connection to write responses to.
+        key (str): The stream key.
+        group_name (str): The name of the consumer group.
+        nogroup_err (str): The error to reply when the key or the group does not exist.
+
+    Returns:
+        Tuple[RedisStream | None, ConsumerGroup | None]: The stream and the group, (None, None) if an error was
+        replied
+    """
+    stream = redis_utils.keyspace.lookup(key)
+    if stream is not None and not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+        return None, None
+    group = stream.groups.get(group_name) if stream is not None else None
+    if group is None:
+        client.write(write_error(bytearray(), nogroup_err))
+        return None, None
+    return stream, group
+
+
+def xgroup_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the XGROUP command and its CREATE, SETID, DESTROY, CREATECONSUMER and DELCONSUMER subcommands
+
+    Example:
+        xgroup_command_helper(["XGROUP", "CREATE", "mystream", "workers", "$", "MKSTREAM"], 6, client)
+        xgroup_command_helper(["XGROUP", "DELCONSUMER", "mystream", "workers", "alice"], 5, client)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
     """
-    time_now = int(time.time() * 1000)
-    if len(redis_utils.redis_streams_dict) == 0:
-        new_stream_key_id = f"{time_now}-0"
-        redis_utils.redis_streams_dict.update({stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-        client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
-        redis_utils.last_stream_id = new_stream_key_id
+    subcommand = message_arr[1].lower()
+    arity = {"create": (5, 8), "setid": (5, 7), "destroy": (4, 4), "createconsumer": (5, 5),
+             "delconsumer": (5, 5)}.get(subcommand)
+    if arity is None:
+        client.write(write_error(bytearray(), f"ERR unknown subcommand '{message_arr[1]}'. Try XGROUP HELP."))
         return
-    else:
-        last_stream_id: str = redis_utils.last_stream_id
-        last_stream_time, last_stream_seq_num = last_stream_id.split("-")
-        if int(time_now) == int(last_stream_time):
-            new_stream_key_id = f"{time_now}-{int(last_stream_seq_num) + 1}"
-            if redis_utils.redis_streams_dict.get(stream_key):
-                redis_utils.redis_streams_dict.get(stream_key).append(
-                    {"id": new_stream_key_id, message_arr[3]: message_arr[4]})
+    if not arity[0] <= n_args <= arity[1]:
+        client.write(write_error(bytearray(),
+                                 f"ERR wrong number of arguments for 'xgroup|{subcommand}' command"))
+        return
+    key, group_name = message_arr[2], message_arr[3]
+    mkstream = False
+    if subcommand in ("create", "setid"):
+        i = 5
+        while i < n_args:
+            option = message_arr[i].lower()
+            if option == "mkstream" and subcommand == "create":
+                mkstream = True
+                i += 1
+            elif option == "entriesread" and i + 1 < n_args:
+                i += 2
             else:
-                redis_utils.redis_streams_dict.update(
-                    {stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-            client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
-            redis_utils.last_stream_id = new_stream_key_id
+                client.write(write_error(bytearray(), "ERR syntax error"))
+                return
+
+    stream = redis_utils.keyspace.lookup(key)
+    if stream is not None and not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+        return
+    if stream is None and not mkstream:
+        client.write(write_error(bytearray(), "ERR The XGROUP subcommand requires the key to exist. Note that for "
+                                              "CREATE you may want to use the MKSTREAM option to create an empty "
+                                              "stream automatically."))
+        return
+    if subcommand in ("create", "setid"):
+        try:
+            last_id = (stream.last_id if stream is not None else STREAM_ID_MIN) if message_arr[4] == "$" \
+                else parse_stream_id(message_arr[4])
+        except ValueError as e:
+            client.write(write_error(bytearray(), str(e)))
             return
-        else:
-            new_stream_key_id = f"{time_now}-0"
-            if redis_utils.redis_streams_dict.get(stream_key):
-                redis_utils.redis_streams_dict.get(stream_key).append(
-                    {"id": new_stream_key_id, message_arr[3]: message_arr[4]})
-            else:
-                redis_utils.redis_streams_dict.update(
-                    {stream_key: [{"id": new_stream_key_id, message_arr[3]: message_arr[4]}]})
-            client_socket.send(redis_utils.convert_to_resp(new_stream_key_id).encode())
-            redis_utils.last_stream_id = new_stream_key_id
+    if subcommand == "create":
+        if stream is None:
+            stream = RedisStream()
+            redis_utils.keyspace.set(key, stream)
+        if group_name in stream.groups:
+            client.write(write_error(bytearray(), "BUSYGROUP Consumer Group name already exists"))
             return
+        stream.groups[group_name] = ConsumerGroup(last_id)
+        redis_utils.keyspace.touch(key)
+        replication.propagate(message_arr, client)
+        client.write(OK)
+        return
+    group = stream.groups.get(group_name)
+    if subcommand == "destroy":
+        if group is not None:
+            del stream.groups[group_name]
+            redis_utils.keyspace.touch(key)
+            replication.propagate(message_arr, client)
+            blocking.signal_key_as_ready(key)
+        client.write(write_integer(bytearray(), int(group is not None)))
+        return
+    if group is None:
+        client.write(write_error(bytearray(), f"NOGROUP No such consumer group '{group_name}' for key name '{key}'"))
+        return
+    if subcommand == "setid":
+        group.last_id = last_id
+        redis_utils.keyspace.touch(key)
+        replication.propagate(message_arr, client)
+        client.write(OK)
+    elif subcommand == "createconsumer":
+        created = message_arr[4] not in group.consumers
+        group.consumer(message_arr[4], int(time.time() * 1000))
+        if created:
+            redis_utils.keyspace.touch(key)
+            replication.propagate(message_arr, client)
+        client.write(write_integer(bytearray(), int(created)))
+    else:
+        deleted = group.delete_consumer(message_arr[4])
+        redis_utils.keyspace.touch(key)
+        replication.propagate(message_arr, client)
+        client.write(write_integer(bytearray(), deleted))
+
+
+def propagate_delivery(client: ConnContext, key: str, group_name: str, consumer: StreamConsumer, stream_id: int,
+                       nack: StreamNACK | None):
+    """
+    Propagates a change of a pending entry made by XREADGROUP, XCLAIM or XAUTOCLAIM, whose outcome depends on
+    the clock of the master: as an XCLAIM forcing its consumer, delivery time and delivery count, or as an
+    XACK when the entry is not pending anymore
+
+    Args:
+        client (ConnContext): The client that ran the command
+        key (str): The stream key
+        group_name (str): The name of the consumer group
+        consumer (StreamConsumer): The consumer the entry belongs to
+        stream_id (int): The packed ID of the entry
+        nack (StreamNACK | None): The pending entry, None if it was removed
+    """
+    if replication.backlog is None and aof.writer is None:
+        return
+    if nack is None:
+        replication.propagate(["XACK", key, group_name, format_stream_id(stream_id)], client)
+        return
+    replication.propagate(["XCLAIM", key, group_name, consumer.name, "0", format_stream_id(stream_id),
+                           "TIME", str(nack.delivery_time), "RETRYCOUNT", str(nack.delivery_count), "FORCE",
+                           "JUSTID"], client)
 
 
-def xrange_command_helper(message_arr: List[str], n_args: int, client_socket: socket):
+def xreadgroup_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the XRANGE command and retrieves a range of entries from the given Redis stream.
+    Handles the XREADGROUP command: XREADGROUP GROUP group consumer [COUNT count] [BLOCK milliseconds] [NOACK]
+    STREAMS key [key ...] id [id ...]
 
-    The XRANGE command can be used to retrieve a range of entries from a Redis stream in a variety of ways. The
-    command takes two arguments, the first specifying the start of the range and the second specifying the end of the
-    range. The start and end arguments can be specified in one of the following ways:
+    The ">" ID delivers the entries the group did not deliver yet and adds them to the pending entries of the
+    consumer unless NOACK is given, any other ID reads the history of the consumer: its pending entries after
+    that ID. Only ">" reads block, and like XREAD the client is then woken by XADD.
 
-    * If the start and end arguments are both specified as "-", the command will return all entries from the start of the
-      stream to the end of the stream.
-    * If the start argument is specified as "-" and the end argument is specified as "+", the command will return all
-      entries from the start of the stream to the last entry in the stream.
-    * If the start argument is specified as "+" and the end argument is specified as "+", the command will return all
-      entries from the last entry in the stream to the end of the stream.
-    * If the start argument is specified as "+" and the end argument is specified as "-", the command will return all
-      entries from the start of the stream to the last entry in the stream.
-    * If the start and end arguments are both specified as integers, the command will return all entries in the stream
-      with IDs greater than or equal to the start ID and less than or equal to the end ID.
+    Example:
+        xreadgroup_command_helper(["XREADGROUP", "GROUP", "workers", "alice", "COUNT", "10", "STREAMS", "mystream",
+                                   ">"], 9, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
+        client (ConnContext): The client connection to write responses to.
+    """
+    if message_arr[1].lower() != "group":
+        client.write(write_error(bytearray(), "ERR syntax error"))
+        return
+    group_name, consumer_name = message_arr[2], message_arr[3]
+    try:
+        count, block_ms, noack, keys, ids = parse_xread_args(message_arr, 4, True)
+        if "$" in ids:
+            raise ValueError("ERR The $ ID is meaningless in the context of XREADGROUP: you want to read the "
+                             "history of this consumer by specifying a proper ID, or use the > ID to get new "
+                             "messages. The $ ID would just return an empty result set.")
+        from_ids = [None if stream_id == ">" else parse_stream_id(stream_id) for stream_id in ids]
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    for key in keys:
+        stream, _ = lookup_stream_group(client, key, group_name, f"NOGROUP No such key '{key}' or consumer group "
+                                                                 f"'{group_name}' in XREADGROUP with GROUP option")
+        if stream is None:
+            return
 
-    Returns:
-        None
+    def serve() -> bool:
+        now = int(time.time() * 1000)
+        stream_list_with_key = []
+        for key, from_id in zip(keys, from_ids):
+            stream = redis_utils.keyspace.lookup(key)
+            group = stream.groups.get(group_name) if isinstance(stream, RedisStream) else None
+            if group is None:
+                client.write(write_error(bytearray(), "NOGROUP the consumer group this client was blocked on no "
+                                                      "longer exists"))
+                return True
+            if consumer_name not in group.consumers:
+                redis_utils.keyspace.touch(key)
+                replication.propagate(["XGROUP", "CREATECONSUMER", key, group_name, consumer_name], client)
+            consumer = group.consumer(consumer_name, now)
+            if from_id is not None:
+                entries = []
+                # Like Redis, reading the history counts as a new delivery of every entry it returns
+                for stream_id, nack in list(consumer.pending.range(from_id + 1, STREAM_ID_MAX, count)):
+                    nack.delivery_time = now
+                    nack.delivery_count += 1
+                    redis_utils.keyspace.touch(key)
+                    propagate_delivery(client, key, group_name, consumer, stream_id, nack)
+                    entry = stream.get(stream_id)
+                    entries.append((stream_id, *entry) if entry else (stream_id, None, None))
+                stream_list_with_key.append((key, entries))
+                continue
+            entries = stream.range_after(group.last_id, count)
+            if entries:
+                group.last_id = entries[-1][0]
+                redis_utils.keyspace.touch(key)
+                replication.propagate(["XGROUP", "SETID", key, group_name, format_stream_id(group.last_id)],
+                                      client)
+                if not noack:
+                    for stream_id, _, _ in entries:
+                        group.deliver(stream_id, consumer, now)
+                        propagate_delivery(client, key, group_name, consumer, stream_id,
+                                           group.pending.get(stream_id))
+                stream_list_with_key.append((key, entries))
+        if not stream_list_with_key:
+            return False
+        client.write(redis_utils.write_xread_streams(bytearray(), stream_list_with_key))
+        return True
+
+    if serve():
+        return
+    if block_ms is None:
+        client.write(NULL_BULK)
+        return
+    blocking.block_for_keys(client, keys, block_ms, serve, lambda: client.write(NULL_BULK))
+
+
+def xack_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    stream_key = message_arr[1]
-    from_id = message_arr[2]
-    to_id = message_arr[3]
-    stream_list = redis_utils.redis_streams_dict.get(stream_key, None)
-    if from_id == "-":
-        to_stream_time, to_seq_num = redis_utils.find_time_and_seq(to_id)
-        xrange_start_command_helper(message_arr, n_args, client_socket, stream_list, to_stream_time, to_seq_num)
-    elif to_id == "+":
-        from_stream_time, from_seq_num = redis_utils.find_time_and_seq(from_id)
-        xrange_end_command_helper(message_arr, n_args, client_socket, stream_list, from_stream_time, from_seq_num)
-    else:
-        from_stream_time, from_seq_num = redis_utils.find_time_and_seq(from_id)
-        to_stream_time, to_seq_num = redis_utils.find_time_and_seq(to_id)
-        xrange_both_command_helper(message_arr, n_args, client_socket, stream_list, from_stream_time, from_seq_num,
-                                   to_stream_time, to_seq_num)
+    Handles the XACK command and removes the given IDs from the pending entries of a group, replies how many
+    were pending
+
+    Example:
+        xack_command_helper(["XACK", "mystream", "workers", "1526569495631-0"], 4, client)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    try:
+        ids = [parse_stream_id(stream_id) for stream_id in message_arr[3:]]
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    stream = redis_utils.keyspace.lookup(message_arr[1])
+    if stream is not None and not isinstance(stream, RedisStream):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+        return
+    group = stream.groups.get(message_arr[2]) if stream is not None else None
+    acked = sum(group.ack(stream_id) for stream_id in ids) if group is not None else 0
+    if acked:
+        redis_utils.keyspace.touch(message_arr[1])
+        replication.propagate(message_arr, client)
+    client.write(write_integer(bytearray(), acked))
 
 
-def xrange_both_command_helper(message_arr: List[str], n_args: int, client_socket: socket, stream_list,
-                               from_stream_time, from_seq_num, to_stream_time, to_seq_num):
+def xpending_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the XRANGE command when both start and end IDs are specified as integers.
+    Handles the XPENDING command: XPENDING key group [[IDLE min-idle-time] start end count [consumer]]
 
-    This function retrieves entries from the specified Redis stream that have IDs within the given range. The range is
-    defined by the `from_stream_time`, `from_seq_num` (start of the range), and `to_stream_time`, `to_seq_num` (end of the range).
-    It collects all valid entries that fall within this range and sends them to the client.
+    Without a range it replies the summary of the pending entries of the group: their number, the smallest and
+    the greatest ID and the number of entries of every consumer. With a range it replies the ID, the consumer,
+    the idle time and the delivery count of every pending entry in it.
+
+    Example:
+        xpending_command_helper(["XPENDING", "mystream", "workers"], 3, client)
+        xpending_command_helper(["XPENDING", "mystream", "workers", "IDLE", "60000", "-", "+", "10"], 8, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        stream_list: The list of entries in the specified Redis stream.
-        from_stream_time: The timestamp part of the start ID.
-        from_seq_num: The sequence number part of the start ID.
-        to_stream_time: The timestamp part of the end ID.
-        to_seq_num: The sequence number part of the end ID.
+        client (ConnContext): The client connection to write responses to.
+    """
+    key, group_name = message_arr[1], message_arr[2]
+    min_idle = 0
+    i = 3
+    if n_args > 3:
+        if message_arr[3].lower() == "idle":
+            if n_args < 7:
+                client.write(write_error(bytearray(), "ERR syntax error"))
+                return
+            try:
+                min_idle = int(message_arr[4])
+            except ValueError:
+                client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
+                return
+            i = 5
+        if n_args - i not in (3, 4):
+            client.write(write_error(bytearray(), "ERR syntax error"))
+            return
+        try:
+            start = parse_range_id(message_arr[i], False)
+            end = parse_range_id(message_arr[i + 1], True)
+            count = max(int(message_arr[i + 2]), 0)
+        except ValueError as e:
+            client.write(write_error(bytearray(), str(e) if str(e).startswith("ERR")
+                                     else "ERR value is not an integer or out of range"))
+            return
+    stream, group = lookup_stream_group(client, key, group_name,
+                                        f"NOGROUP No such key '{key}' or consumer group '{group_name}'")
+    if group is None:
+        return
+
+    if n_args == 3:
+        if not group.pending:
+            client.write(XPENDING_EMPTY_SUMMARY)
+            return
+        consumers = [[consumer.name, str(len(consumer.pending))]
+                     for consumer in sorted(group.consumers.values(), key=lambda consumer: consumer.name)
+                     if consumer.pending]
+        client.write(write_array(bytearray(), [len(group.pending), format_stream_id(group.pending.first_id()),
+                                               format_stream_id(group.pending.last_id()), consumers]))
+        return
+
+    pending = group.pending
+    if n_args - i == 4:
+        consumer = group.consumers.get(message_arr[i + 3])
+        if consumer is None:
+            client.write(EMPTY_ARRAY)
+            return
+        pending = consumer.pending
+    now = int(time.time() * 1000)
+    reply = []
+    for stream_id, nack in pending.range(start, end):
+        if len(reply) >= count:
+            break
+        idle = now - nack.delivery_time
+        if idle >= min_idle:
+            reply.append([format_stream_id(stream_id), nack.consumer.name, idle, nack.delivery_count])
+    client.write(write_array(bytearray(), reply))
+
+
+def parse_xclaim_time_arg(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("ERR Invalid min-idle-time argument for XCLAIM")
+
+
+def claim_pending_entry(stream: RedisStream, group: ConsumerGroup, consumer: StreamConsumer, stream_id: int,
+                        delivery_time: int, justid: bool, retry_count: int | None = None) -> tuple | None:
+    """
+    Moves a pending entry to a consumer for XCLAIM and XAUTOCLAIM. An entry deleted from the stream is removed
+    from the pending entries instead.
+
+    Args:
+        stream (RedisStream): The stream.
+        group (ConsumerGroup): The consumer group.
+        consumer (StreamConsumer): The consumer claiming the entry.
+        stream_id (int): The packed ID of the pending entry.
+        delivery_time (int): The new delivery time in unix milliseconds.
+        justid (bool): Whether JUSTID was given, the delivery count is then left unchanged.
+        retry_count (int | None, optional): The new delivery count. Defaults to None.
 
     Returns:
-        None
+        tuple | None: The (packed ID, field names, values) of the claimed entry, None if it was deleted
     """
-    if stream_list:
-        valid_list = []
-        for item in stream_list:
-            stream_id = item.get("id")
-            stream_time, stream_seq_num = stream_id.split("-")
-            if int(stream_time) < int(from_stream_time) or int(stream_time) > int(to_stream_time):
-                continue
+    entry = stream.get(stream_id)
+    if entry is None:
+        group.ack(stream_id)
+        return None
+    group.claim(stream_id, consumer)
+    nack = group.pending.get(stream_id)
+    nack.delivery_time = delivery_time
+    if retry_count is not None:
+        nack.delivery_count = retry_count
+    elif not justid:
+        nack.delivery_count += 1
+    return (stream_id, *entry)
+
+
+def xclaim_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the XCLAIM command: XCLAIM key group consumer min-idle-time id [id ...] [IDLE ms] [TIME unix-time-ms]
+    [RETRYCOUNT count] [FORCE] [JUSTID] [LASTID lastid]
+
+    Pending entries idle for at least min-idle-time are moved to the consumer, every ID is found in O(1) in the
+    pending entries of the group.
+
+    Example:
+        xclaim_command_helper(["XCLAIM", "mystream", "workers", "bob", "3600000", "1526569498055-0"], 6, client)
 
-            if int(stream_time) == int(from_stream_time):
-                if not from_seq_num or int(stream_seq_num) >= int(from_seq_num):
-                    if int(stream_time) == int(to_stream_time):
-                        if not to_seq_num or int(stream_seq_num) <= int(to_seq_num):
-                            valid_list.append(item)
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    key, group_name = message_arr[1], message_arr[2]
+    now = int(time.time() * 1000)
+    delivery_time = now
+    retry_count = None
+    force = justid = False
+    last_id = None
+    ids = []
+    try:
+        min_idle = parse_xclaim_time_arg(message_arr[4])
+        i = 5
+        while i < n_args:
+            try:
+                ids.append(parse_stream_id(message_arr[i]))
+                i += 1
+            except ValueError:
+                break
+        while i < n_args:
+            option = message_arr[i].lower()
+            if option in ("force", "justid"):
+                force = force or option == "force"
+                justid = justid or option == "justid"
+                i += 1
+                continue
+            if option not in ("idle", "time", "retrycount", "lastid") or i + 1 >= n_args:
+                raise ValueError(f"ERR Unrecognized XCLAIM option '{message_arr[i]}'")
+            if option == "lastid":
+                last_id = parse_stream_id(message_arr[i + 1])
             else:
-                valid_list.append(item)
-
-        response = f"*{len(valid_list)}\r\n"
-        for valid_item in valid_list:
-            len_dict = len(valid_item) - 1
-            response += f"*{len_dict}\r\n"
-            for key, value in valid_item.items():
-                if key == "id":
-                    response += redis_utils.convert_to_resp(valid_item.get("id"))
+                try:
+                    value = int(message_arr[i + 1])
+                except ValueError:
+                    raise ValueError(f"ERR Invalid {option.upper()} option argument for XCLAIM")
+                if option == "idle":
+                    delivery_time = now - value
+                elif option == "time":
+                    delivery_time = value
                 else:
-                    response += f"*{len_dict * 2}\r\n"
-                    response += redis_utils.convert_to_resp(key)
-                    response += redis_utils.convert_to_resp(value)
-
-        client_socket.send(response.encode())
-    if stream_list:
-        valid_list = []
-        for item in stream_list:
-            stream_id = item.get("id")
-            stream_time, stream_seq_num = stream_id.split("-")
-            if int(stream_time) < int(from_stream_time) or int(stream_time) > int(to_stream_time):
+                    retry_count = value
+            i += 2
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    stream, group = lookup_stream_group(client, key, group_name,
+                                        f"NOGROUP No such key '{key}' or consumer group '{group_name}'")
+    if group is None:
+        return
+
+    if last_id is not None and last_id > group.last_id:
+        group.last_id = last_id
+        redis_utils.keyspace.touch(key)
+        replication.propagate(["XGROUP", "SETID", key, group_name, format_stream_id(last_id)], client)
+    if message_arr[3] not in group.consumers:
+        redis_utils.keyspace.touch(key)
+        replication.propagate(["XGROUP", "CREATECONSUMER", key, group_name, message_arr[3]], client)
+    consumer = group.consumer(message_arr[3], now)
+    claimed = []
+    for stream_id in ids:
+        nack = group.pending.get(stream_id)
+        if nack is None:
+            if not force or stream.get(stream_id) is None:
                 continue
+            nack = StreamNACK(consumer, now, 0)
+            group.pending.add(stream_id, nack)
+            consumer.pending.add(stream_id, nack)
+        elif min_idle and now - nack.delivery_time < min_idle:
+            continue
+        entry = claim_pending_entry(stream, group, consumer, stream_id, delivery_time, justid, retry_count)
+        redis_utils.keyspace.touch(key)
+        propagate_delivery(client, key, group_name, consumer, stream_id, group.pending.get(stream_id))
+        if entry is not None:
+            claimed.append(entry)
+    if justid:
+        client.write(write_array(bytearray(), [format_stream_id(stream_id) for stream_id, _, _ in claimed]))
+    else:
+        client.write(redis_utils.write_stream_entries(bytearray(), claimed))
 
-            if int(stream_time) == int(from_stream_time):
-                if not from_seq_num or int(stream_seq_num) >= int(from_seq_num):
-                    if int(stream_time) == int(to_stream_time):
-                        if not to_seq_num or int(stream_seq_num) <= int(to_seq_num):
-                            valid_list.append(item)
+
+def xautoclaim_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the XAUTOCLAIM command: XAUTOCLAIM key group consumer min-idle-time start [COUNT count] [JUSTID]
+
+    Scans the pending entries of the group from start, bisecting to it, and claims the ones idle for at least
+    min-idle-time, up to count of them after looking at no more than ten times count entries. Replies the ID to
+    continue the scan from (0-0 once it is complete), the claimed entries and the IDs of the pending entries whose
+    stream entry was deleted, which are removed from the pending entries.
+
+    Example:
+        xautoclaim_command_helper(["XAUTOCLAIM", "mystream", "workers", "bob", "3600000", "0-0", "COUNT", "25"], 8,
+                                  client)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    key, group_name = message_arr[1], message_arr[2]
+    count = 100
+    justid = False
+    try:
+        min_idle = parse_xclaim_time_arg(message_arr[4])
+        start = parse_range_id(message_arr[5], False)
+        i = 6
+        while i < n_args:
+            option = message_arr[i].lower()
+            if option == "justid":
+                justid = True
+                i += 1
+            elif option == "count" and i + 1 < n_args:
+                try:
+                    count = int(message_arr[i + 1])
+                except ValueError:
+                    raise ValueError("ERR value is not an integer or out of range")
+                if count < 1:
+                    raise ValueError("ERR COUNT must be > 0")
+                i += 2
             else:
-                valid_list.append(item)
-
-        response = f"*{len(valid_list)}\r\n"
-        for valid_item in valid_list:
-            len_dict = len(valid_item) - 1
-            response += f"*{len_dict}\r\n"
-            for key, value in valid_item.items():
-                if key == "id":
-                    response += redis_utils.convert_to_resp(valid_item.get("id"))
-                else:
-                    response += f"*{len_dict * 2}\r\n"
-                    response += redis_utils.convert_to_resp(key)
-                    response += redis_utils.convert_to_resp(value)
+                raise ValueError("ERR syntax error")
+    except ValueError as e:
+        client.write(write_error(bytearray(), str(e)))
+        return
+    stream, group = lookup_stream_group(client, key, group_name,
+                                        f"NOGROUP No such key '{key}' or consumer group '{group_name}'")
+    if group is None:
+        return
 
-        client_socket.send(response.encode())
+    now = int(time.time() * 1000)
+    if message_arr[3] not in group.consumers:
+        redis_utils.keyspace.touch(key)
+        replication.propagate(["XGROUP", "CREATECONSUMER", key, group_name, message_arr[3]], client)
+    consumer = group.consumer(message_arr[3], now)
+    scanned = list(group.pending.range(start, STREAM_ID_MAX, count * 10 + 1))
+    next_id = STREAM_ID_MIN
+    if len(scanned) > count * 10:
+        next_id = scanned.pop()[0]
+    claimed = []
+    deleted = []
+    for stream_id, nack in scanned:
+        if len(claimed) >= count:
+            next_id = stream_id
+            break
+        if now - nack.delivery_time < min_idle:
+            continue
+        entry = claim_pending_entry(stream, group, consumer, stream_id, now, justid)
+        redis_utils.keyspace.touch(key)
+        propagate_delivery(client, key, group_name, consumer, stream_id, group.pending.get(stream_id))
+        if entry is None:
+            deleted.append(format_stream_id(stream_id))
+        else:
+            claimed.append(entry)
+    out = write_array_header(bytearray(), 3)
+    write_bulk_string(out, format_stream_id(next_id))
+    if justid:
+        write_array(out, [format_stream_id(stream_id) for stream_id, _, _ in claimed])
+    else:
+        redis_utils.write_stream_entries(out, claimed)
+    client.write(write_array(out, deleted))
 
 
-def xrange_start_command_helper(message_arr: List[str], n_args: int, client_socket: socket, stream_list, to_stream_time,
-                                to_seq_num):
+def expire_generic_command_helper(message_arr: List[str], n_args: int, client: ConnContext, unit_ms: int,
+                                  absolute: bool = False):
     """
-    Handles the XRANGE command and retrieves a range of items from the stream, from the start of the stream to the specified end.
+    Handles the EXPIRE, PEXPIRE, EXPIREAT and PEXPIREAT commands and sets the expire time of a key, honouring the
+    NX, XX, GT and LT options. An expire time that is already in the past deletes the key. The change is
+    propagated as PEXPIREAT, or as DEL when the key was deleted, so replicas and the AOF keep the expire time.
+
+    Example:
+        expire_generic_command_helper(["EXPIRE", "mykey", "10"], 3, client, 1000)
+        expire_generic_command_helper(["PEXPIRE", "mykey", "1500", "GT"], 4, client, 1)
+        expire_generic_command_helper(["PEXPIREAT", "mykey", "1700000000000"], 3, client, 1, absolute=True)
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        stream_list: The list of stream items.
-        to_stream_time (str): The upper bound of the time range.
-        to_seq_num (str): The upper bound of the sequence number range.
-    """
-    if stream_list:
-        valid_list = []
-        for item in stream_list:
-            stream_id = item.get("id")
-            stream_time, stream_seq_num = stream_id.split("-")
-            if int(stream_time) > int(to_stream_time):
-                continue
-
-            if int(stream_time) == int(to_stream_time):
-                if not to_seq_num or int(stream_seq_num) <= int(to_seq_num):
-                    valid_list.append(item)
-            else:
-                valid_list.append(item)
-
-        response = f"*{len(valid_list)}\r\n"
-        for valid_item in valid_list:
-            len_dict = len(valid_item) - 1
-            response += f"*{len_dict}\r\n"
-            for key, value in valid_item.items():
-                if key == "id":
-                    response += redis_utils.convert_to_resp(valid_item.get("id"))
-                else:
-                    response += f"*{len_dict * 2}\r\n"
-                    response += redis_utils.convert_to_resp(key)
-                    response += redis_utils.convert_to_resp(value)
+        client (ConnContext): The client connection to write responses to.
+        unit_ms (int): The number of milliseconds in one unit of the time argument.
+        absolute (bool, optional): Whether the time argument is a unix time instead of a time to live.
+            Defaults to False.
+    """
+    key = message_arr[1]
+    try:
+        amount = int(message_arr[2])
+    except ValueError:
+        client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
+        return
+    options = {option.lower() for option in message_arr[3:]}
+    if not options <= {"nx", "xx", "gt", "lt"}:
+        client.write(write_error(bytearray(), f"ERR Unsupported option {message_arr[3]}"))
+        return
+    if "nx" in options and len(options) > 1:
+        client.write(write_error(bytearray(), "ERR NX and XX, GT or LT options at the same time are not compatible"))
+        return
+    if {"gt", "lt"} <= options:
+        client.write(write_error(bytearray(), "ERR GT and LT options at the same time are not compatible"))
+        return
 
-        client_socket.send(response.encode())
+    keyspace = redis_utils.keyspace
+    if key not in keyspace:
+        client.write(write_integer(bytearray(), 0))
+        return
+    now = now_ms()
+    when_ms = monotonic_time_ms(amount * unit_ms) if absolute else now + amount * unit_ms
+    current = keyspace.get_expire(key)
+    if (("nx" in options and current is not None)
+            or ("xx" in options and current is None)
+            or ("gt" in options and (current is None or when_ms <= current))
+            or ("lt" in options and current is not None and when_ms >= current)):
+        client.write(write_integer(bytearray(), 0))
+        return
+    if when_ms <= now:
+        keyspace.delete(key)
+        replication.propagate(["DEL", key], client)
+    else:
+        keyspace.set_expire(key, when_ms)
+        replication.propagate(["PEXPIREAT", key, str(unix_time_ms(when_ms))], client)
+    client.write(write_integer(bytearray(), 1))
 
 
-def xrange_end_command_helper(message_arr: List[str], n_args: int, client_socket: socket, stream_list, from_stream_time,
-                              from_seq_num):
+def expire_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the XRANGE command with a specified end time and sequence number.
+    Handles the EXPIRE command, the time to live is given in seconds.
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        stream_list: The list of stream items.
-        from_stream_time (str): The upper bound of the time range.
-        from_seq_num (str): The upper bound of the sequence number range.
-    """
-    if stream_list:
-        valid_list = []
-        for item in stream_list:
-            stream_id = item.get("id")
-            stream_time, stream_seq_num = stream_id.split("-")
-            if int(stream_time) < int(from_stream_time):
-                continue
+        client (ConnContext): The client connection to write responses to.
+    """
+    expire_generic_command_helper(message_arr, n_args, client, 1000)
 
-            if int(stream_time) == int(from_stream_time):
-                if not from_seq_num or int(stream_seq_num) >= int(from_seq_num):
-                    valid_list.append(item)
-            else:
-                valid_list.append(item)
-
-        response = f"*{len(valid_list)}\r\n"
-        for valid_item in valid_list:
-            len_dict = len(valid_item) - 1
-            response += f"*{len_dict}\r\n"
-            for key, value in valid_item.items():
-                if key == "id":
-                    response += redis_utils.convert_to_resp(valid_item.get("id"))
-                else:
-                    response += f"*{len_dict * 2}\r\n"
-                    response += redis_utils.convert_to_resp(key)
-                    response += redis_utils.convert_to_resp(value)
 
-        client_socket.send(response.encode())
+def pexpire_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the PEXPIRE command, the time to live is given in milliseconds.
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    expire_generic_command_helper(message_arr, n_args, client, 1)
 
 
-def xread_command_helper(message_arr: List[str], n_args: int, client_socket: socket, redis_streams_dict,
-                         only_new_values=None):
+def expireat_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the XREAD command and retrieves a range of items from the stream, from the last received item to the specified end.
+    Handles the EXPIREAT command, the expire time is given as a unix time in seconds.
 
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        redis_streams_dict (dict): The dictionary of Redis streams.
-        only_new_values (list): The list of new values to retrieve, if provided.
+        client (ConnContext): The client connection to write responses to.
     """
-    if message_arr[1].lower() == "streams":
-        if only_new_values == []:
-            client_socket.send("$-1\r\n".encode())
-            return
-        if only_new_values:
-            stream_list_with_key = [(message_arr[2], only_new_values)]
-            response = redis_utils.convert_xread_streams_to_resp(stream_list_with_key)
-            client_socket.send(response.encode())
-            return
-        len_of_keys = int((len(message_arr) - 2) / 2)
-        keys_list = message_arr[2:2 + len_of_keys]
-        from_id_list = message_arr[2 + len_of_keys:]
-        stream_list_with_key = []
-        for idx, key in enumerate(keys_list):
-            from_time, from_seq = redis_utils.find_time_and_seq(from_id_list[idx])
-            list_values = redis_streams_dict.get(key)
-
-            valid_values = []
-            for item in list_values:
-                stream_id = item["id"]
-                stream_time, stream_seq_num = redis_utils.find_time_and_seq(stream_id)
-                if int(stream_time) < int(from_time):
-                    continue
-                elif int(stream_time) == int(from_time):
-                    if not from_seq or int(stream_seq_num) > int(from_seq):
-                        valid_values.append(item)
-                else:
-                    valid_values.append(item)
-            if not valid_values:
-                client_socket.send("$-1\r\n".encode())
-                return
-            stream_list_with_key.append((key, valid_values))
+    expire_generic_command_helper(message_arr, n_args, client, 1000, absolute=True)
 
-        response = redis_utils.convert_xread_streams_to_resp(stream_list_with_key)
-        client_socket.send(response.encode())
 
+def pexpireat_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the PEXPIREAT command, the expire time is given as a unix time in milliseconds.
 
-def handle_blocking_in_xread(message_arr: List[str]):
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
     """
-    Handles the BLOCK argument in the XRDB command and waits until a new entry is added to a Redis stream.
-    If the blocking time is 0, it waits until a new entry is added in a loop.
-    If the blocking time is greater than 0, it waits for the specified amount of time before returning.
+    expire_generic_command_helper(message_arr, n_args, client, 1, absolute=True)
+
+
+def del_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the DEL command, deletes the given keys and replies with the number of keys that existed.
+    Also propagated for every key that expires, see replication.propagate_expired.
+
+    Example:
+        del_command_helper(["DEL", "key1", "key2"], 3, client)
 
     Args:
         message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    keyspace = redis_utils.keyspace
+    deleted = sum(key in keyspace and keyspace.delete(key) for key in message_arr[1:])
+    if deleted:
+        replication.propagate(message_arr, client)
+    client.write(write_integer(bytearray(), deleted))
 
-    Returns:
-        None
+
+def ttl_generic_command_helper(message_arr: List[str], n_args: int, client: ConnContext, output_ms: bool):
     """
-    if message_arr[1].lower() == "block":
-        block_time = float(message_arr[2]) / 1000
-        if block_time == 0:
-            redis_utils.wait_until_new_add_stream = True
-            while redis_utils.wait_until_new_add_stream:
-                time.sleep(0.1)
-        else:
-            time.sleep(block_time)
-            redis_utils.can_add_redis_stream = False
-        del message_arr[1:3]
+    Handles the TTL and PTTL commands and returns the remaining time to live of a key,
+    -2 if the key does not exist and -1 if it has no expire.
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+        output_ms (bool): Whether to reply in milliseconds instead of seconds.
+    """
+    key = message_arr[1]
+    if key not in redis_utils.keyspace:
+        client.write(write_integer(bytearray(), -2))
+        return
+    when_ms = redis_utils.keyspace.get_expire(key)
+    if when_ms is None:
+        client.write(write_integer(bytearray(), -1))
+        return
+    ttl = max(when_ms - now_ms(), 0)
+    client.write(write_integer(bytearray(), ttl if output_ms else (ttl + 500) // 1000))
 
 
-def handle_dollar_in_xread(client_socket, n_args, message_arr: List[str], prev_copy_redis_streams_dict,
-                           new_copy_redis_streams_dict):
+def ttl_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the $ argument in the XRDB command and checks if there are any new entries in the Redis stream.
-    If there are no new entries, it sends a -1 response.
-    If there are new entries, it sends the new entries in the XRDB stream format.
+    Handles the TTL command, the remaining time to live is returned in seconds.
 
     Args:
-        client_socket (socket): The client socket to send responses to.
+        message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    ttl_generic_command_helper(message_arr, n_args, client, False)
+
+
+def pttl_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the PTTL command, the remaining time to live is returned in milliseconds.
+
+    Args:
         message_arr (List[str]): The list of command arguments.
-        prev_copy_redis_streams_dict (dict): The previous copy of the Redis streams dictionary.
-        new_copy_redis_streams_dict (dict): The new copy of the Redis streams dictionary.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    ttl_generic_command_helper(message_arr, n_args, client, True)
 
-    Returns:
-        None
+
+def persist_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    if message_arr[-1] == "$":
-        if prev_copy_redis_streams_dict == new_copy_redis_streams_dict:
-            client_socket.send("$-1\r\n".encode())
-            return
-        else:
-            list1 = prev_copy_redis_streams_dict.get(message_arr[2])
-            list2 = new_copy_redis_streams_dict.get(message_arr[2])
+    Handles the PERSIST command and removes the expire of a key.
 
-            diff2 = [item for item in list2 if item not in list1]
-            xread_command_helper(message_arr, n_args, client_socket, new_copy_redis_streams_dict, diff2)
-            return
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    key = message_arr[1]
+    keyspace = redis_utils.keyspace
+    removed = key in keyspace and keyspace.remove_expire(key)
+    if removed:
+        replication.propagate(message_arr, client)
+    client.write(write_integer(bytearray(), 1 if removed else 0))
 
 
-def incr_command_helper(message_arr: List[str], n_args: int, client_socket: socket, addr: str,
-                        is_multi_command: bool = False):
+def incr_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
     Handles the INCR command and increments the value associated with the given key in the Redis dictionary.
     If the value is not an integer, it sends an error response.
@@ -781,33 +1624,233 @@ def incr_command_helper(message_arr: List[str], n_args: int, client_socket: sock
     Args:
         message_arr (List[str]): The list of command arguments.
         n_args (int): The number of arguments in the command.
-        client_socket (socket): The client socket to send responses to.
-        addr (str): The address of the client for IP sockets.
-        is_multi_command (bool): Whether the command is part of a transaction block (MULTI/EXEC).
+        client (ConnContext): The client connection to write responses to.
 
     Returns:
         None
     """
     key = message_arr[1]
-    value = redis_utils.redis_dict.get(key, None)
-    if value:
+    keyspace = redis_utils.keyspace
+    value = keyspace.lookup(key)
+    if isinstance(value, RedisObject):
+        client.write(write_error(bytearray(), WRONGTYPE_ERR))
+    elif value is not None:
         try:
             value_int = int(value) + 1
-            redis_utils.redis_dict.update({key: str(value_int)})
-            if is_multi_command:
-                redis_utils.queue_commands_response.get(addr).append(f":{value_int}\r\n")
-                return
-            client_socket.send(f":{value_int}\r\n".encode())
+            keyspace.set(key, value_int)
+            replication.propagate(message_arr, client)
+            resp = write_integer(bytearray(), value_int)
+            client.write(resp)
         except ValueError as e:
-            if is_multi_command:
-                redis_utils.queue_commands_response.get(addr).append("-ERR value is not an integer or out of range\r\n")
-                return
-            client_socket.send("-ERR value is not an integer or out of range\r\n".encode())
+            resp = write_error(bytearray(), "ERR value is not an integer or out of range")
+            client.write(resp)
         except Exception as e:
             print(f"Exception found : {e}")
     else:
-        redis_utils.redis_dict.update({key: "1"})
-        if is_multi_command:
-            redis_utils.queue_commands_response.get(addr).append(":1\r\n")
+        keyspace.set(key, 1)
+        replication.propagate(message_arr, client)
+        resp = write_integer(bytearray(), 1)
+        client.write(resp)
+
+
+def memory_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the MEMORY USAGE command and returns the estimated number of bytes used by a key and its value,
+    aggregate values are estimated from SAMPLES elements (5 by default, 0 for all of them).
+
+    Example:
+        memory_command_helper(["MEMORY", "USAGE", "mykey"], 3, client)
+        memory_command_helper(["MEMORY", "USAGE", "mystream", "SAMPLES", "0"], 5, client)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    subcommand = message_arr[1].lower()
+    if subcommand != "usage":
+        client.write(write_error(bytearray(), f"ERR unknown subcommand '{message_arr[1]}'. Try MEMORY HELP."))
+        return
+    if n_args not in (3, 5) or (n_args == 5 and message_arr[3].lower() != "samples"):
+        client.write(write_error(bytearray(), "ERR syntax error"))
+        return
+    samples = MEMORY_USAGE_SAMPLES
+    if n_args == 5:
+        try:
+            samples = int(message_arr[4])
+        except ValueError:
+            client.write(write_error(bytearray(), "ERR value is not an integer or out of range"))
             return
-        client_socket.send(":1\r\n".encode())
+    usage = redis_utils.keyspace.memory_usage(message_arr[2], samples)
+    if usage is None:
+        client.write(NULL_BULK)
+    else:
+        client.write(write_integer(bytearray(), usage))
+
+
+def parse_slot(value: str) -> int | None:
+    """
+    Parses a hash slot argument, None if it is not a number between 0 and 16383
+    """
+    try:
+        slot = int(value)
+    except ValueError:
+        return None
+    return slot if 0 <= slot < HASH_SLOTS else None
+
+
+def cluster_nodes_lines() -> List[str]:
+    """
+    Returns the CLUSTER NODES line of every node: its ID, address, flags, slots, and for this node the slots
+    being migrated ("[slot->-target]") or imported ("[slot-<-source]")
+    """
+    lines = []
+    for node in cluster.nodes:
+        flags = "myself,master" if node is cluster.myself else "master"
+        fields = [node.id, f"{node.address}@{node.port + 10000}", flags, "-", "0", "0", "0", "connected"]
+        fields += [str(first) if first == last else f"{first}-{last}" for first, last in cluster.slot_ranges_of(node)]
+        if node is cluster.myself:
+            fields += [f"[{slot}->-{target.id}]" for slot, target in sorted(cluster.migrating.items())]
+            fields += [f"[{slot}-<-{source.id}]" for slot, source in sorted(cluster.importing.items())]
+        lines.append(" ".join(fields))
+    return lines
+
+
+def cluster_setslot(message_arr: List[str], n_args: int) -> str | None:
+    """
+    Runs CLUSTER SETSLOT <slot> IMPORTING|MIGRATING|NODE <node-id> and CLUSTER SETSLOT <slot> STABLE, the steps
+    of a slot migration: the target imports the slot, the source migrates it, the client copies the keys
+    (GETKEYSINSLOT, then ASKING and a write on the target), then both nodes are told the new owner with NODE.
+    Having no MIGRATE, a source handing the slot over drops the keys it still holds in it, propagated as DEL
+    like expired keys so its replicas drop them too.
+
+    Args:
+        message_arr (List[str]): The list of command arguments
+        n_args (int): The number of arguments in the command
+
+    Returns:
+        str | None: The error to reply, None on success
+    """
+    slot = parse_slot(message_arr[2])
+    if slot is None:
+        return "ERR Invalid or out of range slot"
+    action = message_arr[3].lower()
+    if action == "stable" and n_args == 4:
+        cluster.migrating.pop(slot, None)
+        cluster.importing.pop(slot, None)
+        return None
+    if action not in ("importing", "migrating", "node") or n_args != 5:
+        return "ERR Invalid CLUSTER SETSLOT action or number of arguments. Try CLUSTER HELP"
+    node = cluster.node_by_id(message_arr[4])
+    if node is None:
+        return f"ERR I don't know about node {message_arr[4]}"
+    owner = cluster.slot_owners[slot]
+    if action == "importing":
+        if owner is cluster.myself:
+            return f"ERR I'm already the owner of hash slot {slot}"
+        cluster.importing[slot] = node
+    elif action == "migrating":
+        if owner is not cluster.myself:
+            return f"ERR I'm not the owner of hash slot {slot}"
+        cluster.migrating[slot] = node
+    else:
+        if owner is cluster.myself and node is not cluster.myself:
+            for key in list(redis_utils.keyspace.slot_keys[slot]):
+                redis_utils.keyspace.delete(key)
+                replication.propagate(["DEL", key])
+        cluster.slot_owners[slot] = node
+        if node is not cluster.myself:
+            cluster.migrating.pop(slot, None)
+        else:
+            cluster.importing.pop(slot, None)
+    return None
+
+
+def cluster_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the CLUSTER command: SLOTS and SHARDS describe which node serves which slots, for the clients to
+    route their commands, NODES, INFO and MYID describe the cluster, KEYSLOT, COUNTKEYSINSLOT and GETKEYSINSLOT
+    inspect the slots and SETSLOT migrates one (see cluster_setslot)
+
+    Example:
+        cluster_command_helper(["CLUSTER", "KEYSLOT", "foo"], 3, client)
+        cluster_command_helper(["CLUSTER", "GETKEYSINSLOT", "12182", "10"], 4, client)
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    subcommand = message_arr[1].lower()
+    if not cluster.enabled:
+        client.write(write_error(bytearray(), "ERR This instance has cluster support disabled"))
+        return
+    out = bytearray()
+    if subcommand == "slots" and n_args == 2:
+        ranges = sorted((first, last, node) for node in cluster.nodes for first, last in cluster.slot_ranges_of(node))
+        write_array(out, [[first, last, [node.host, node.port, node.id, []]] for first, last, node in ranges])
+    elif subcommand == "shards" and n_args == 2:
+        offset = replication.master_repl_offset()
+        write_array(out, [[
+            "slots", [slot for slot_range in cluster.slot_ranges_of(node) for slot in slot_range],
+            "nodes", [["id", node.id, "port", node.port, "ip", node.host, "endpoint", node.host, "role", "master",
+                       "replication-offset", offset if node is cluster.myself else 0, "health", "online"]],
+        ] for node in cluster.nodes])
+    elif subcommand == "nodes" and n_args == 2:
+        write_bulk_string(out, "".join(line + "\n" for line in cluster_nodes_lines()))
+    elif subcommand == "info" and n_args == 2:
+        assigned = sum(owner is not None for owner in cluster.slot_owners)
+        lines = [
+            f"cluster_state:{'ok' if assigned == HASH_SLOTS else 'fail'}",
+            f"cluster_slots_assigned:{assigned}",
+            f"cluster_slots_ok:{assigned}",
+            f"cluster_known_nodes:{len(cluster.nodes)}",
+            f"cluster_size:{sum(bool(cluster.slot_ranges_of(node)) for node in cluster.nodes)}",
+        ]
+        write_bulk_string(out, "\r\n".join(lines) + "\r\n")
+    elif subcommand == "myid" and n_args == 2:
+        write_bulk_string(out, cluster.myself.id)
+    elif subcommand == "keyslot" and n_args == 3:
+        write_integer(out, key_hash_slot(message_arr[2]))
+    elif subcommand == "countkeysinslot" and n_args == 3:
+        slot = parse_slot(message_arr[2])
+        if slot is None:
+            write_error(out, "ERR Invalid slot")
+        else:
+            write_integer(out, len(redis_utils.keyspace.slot_keys[slot]))
+    elif subcommand == "getkeysinslot" and n_args == 4:
+        slot = parse_slot(message_arr[2])
+        count = int(message_arr[3]) if message_arr[3].isdigit() else -1
+        if slot is None:
+            write_error(out, "ERR Invalid slot")
+        elif count < 0:
+            write_error(out, "ERR Invalid number of keys")
+        else:
+            write_array(out, list(itertools.islice(redis_utils.keyspace.slot_keys[slot], count)))
+    elif subcommand == "setslot" and n_args >= 4:
+        error = cluster_setslot(message_arr, n_args)
+        if error is None:
+            out += OK
+        else:
+            write_error(out, error)
+    else:
+        write_error(out, f"ERR unknown subcommand or wrong number of arguments for '{message_arr[1]}'. "
+                         f"Try CLUSTER HELP.")
+    client.write(out)
+
+
+def asking_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the ASKING command, sent before a command redirected by an ASK error: the next command (or
+    transaction) may access the keys of a slot this node is importing
+
+    Args:
+        message_arr (List[str]): The list of command arguments.
+        n_args (int): The number of arguments in the command.
+        client (ConnContext): The client connection to write responses to.
+    """
+    if not cluster.enabled:
+        client.write(write_error(bytearray(), "ERR This instance has cluster support disabled"))
+        return
+    client.asking = True
+    client.write(OK)
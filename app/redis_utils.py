@@ -1,47 +1,35 @@
 import argparse
 from typing import List
 
-redis_dict = {}
-redis_streams_dict = {}
-last_stream_id = ""
+from .keyspace import KeyLocks, Keyspace
+from .resp_encoder import NULL_ARRAY, write_array_header, write_bulk_string
+from .stream import format_stream_id
+
+keyspace = Keyspace()
 dir = ""
 dbfilename = ""
 port: int = 6379
 replicaof = ""
+io_model = "threaded"
+client_output_buffer_limit = (0, 0, 0)
+replica_output_buffer_limit = (256 * 1024 * 1024, 64 * 1024 * 1024, 60)
+hz = 10
+repl_backlog_size = 1024 * 1024
+workers = 1
+cluster_enabled = False
+cluster_nodes = []
+appendonly = False
+appendfilename = "appendonly.aof"
+appendfsync = "everysec"
 replica_sockets = {}
-num_replicas_ack = 0
-num_write_operations = 0
 replica_ack_offset = 0
-wait_until_new_add_stream = False
-multi_queue_commands = {}
-queue_commands_response = {}
-
-
-def convert_to_resp(msg: str, is_arr: bool = False) -> str:
-    """
-    Converts a string to RESP (Redis Protocol) format
-
-    Example:
-        convert_to_resp("Hello World") -> "*2\r\n$5\r\nHello\r\n$5\r\nWorld\r\n"
-
-    Args:
-        is_arr: bool = False
-            Whether the response is an array. If False, the response will be a string
-        msg (str): The input string to be converted
-
-    Returns:
-        str: _description_
-    """
-    msg_arr: List[str] = msg.split(" ")
-    resp: str = f"*{len(msg_arr)}\r\n" if len(msg_arr) > 1 else ""
-    if resp == "" and is_arr:
-        resp = "*1\r\n"
-    for s in msg_arr:
-        if s:
-            resp += f"${len(s)}\r\n{s}\r\n"
-        else:
-            resp += "$-1\r\n"
-    return resp
+rdb_last_load_keys_loaded = 0
+rdb_last_load_keys_expired = 0
+rdb_last_load_time_ms = 0
+loading = False
+loading_start_time = 0
+loading_total_bytes = 0
+loading_loaded_bytes = 0
 
 
 def redis_args_parse():
@@ -56,8 +44,20 @@ def redis_args_parse():
     parser.add_argument("--dbfilename", type=str)
     parser.add_argument("--port", type=int)
     parser.add_argument("--replicaof", type=str)
+    parser.add_argument("--io-model", type=str, choices=["eventloop", "threaded"])
+    parser.add_argument("--client-output-buffer-limit", type=str, action="append")
+    parser.add_argument("--hz", type=int)
+    parser.add_argument("--repl-backlog-size", type=str)
+    parser.add_argument("--keyspace-lock-stripes", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--cluster-enabled", type=str, choices=["yes", "no"])
+    parser.add_argument("--cluster-node", type=str, action="append")
+    parser.add_argument("--appendonly", type=str, choices=["yes", "no"])
+    parser.add_argument("--appendfilename", type=str)
+    parser.add_argument("--appendfsync", type=str, choices=["always", "everysec", "no"])
     args = parser.parse_args()
-    global dir, dbfilename, port, replicaof
+    global dir, dbfilename, port, replicaof, io_model, client_output_buffer_limit, replica_output_buffer_limit, hz
+    global repl_backlog_size, workers, cluster_enabled, cluster_nodes, appendonly, appendfilename, appendfsync
     if args.dir:
         dir = args.dir
     if args.dbfilename:
@@ -66,172 +66,136 @@ def redis_args_parse():
         port = int(args.port)
     if args.replicaof:
         replicaof = args.replicaof
-
-
-def parse_rdb() -> dict[bytes, tuple[bytes, int | None]]:
-    """
-    Parses a Redis RDB file and returns a dictionary of keys and values
-
-    Returns:
-        dict[bytes, tuple[bytes, int | None]]: _description_
-    """
-    store: dict[bytes, tuple[bytes, int | None]] = {}
-    db_path: str = dir + "/" + dbfilename
-    try:
-        with open(db_path, mode="rb") as db:
-            data = db.read()
-    except Exception as e:
-        print(f"Unable to open file {db_path}: {e}")
-        return store
-    if data[0:5] != b"REDIS":
-        print("Incorrect RDB format")
-    pos = 5 + 4
-    while pos < len(data):
-        op = data[pos]
-        pos += 1
-        if op == 0xFA:
-            key, pos = parse_db_string(data, pos)
-            val, pos = parse_db_string(data, pos)
-        elif op == 0xFE:
-            db_num, pos = parse_db_len(data, pos)
-        elif op == 0xFB:
-            _, pos = parse_db_len(data, pos)
-            _, pos = parse_db_len(data, pos)
-        elif op == 0xFD:
-            exp = int.from_bytes(data[pos: pos + 4], "little") * 1_000
-            exp = int.from_bytes(data[pos: pos + 4], "little") * 1_000_000_000
-            pos += 4
-            key, val, pos = parse_keyvalue(data, pos)
-            store[key.decode()] = (val.decode(), exp)
-        elif op == 0xFC:
-            exp = int.from_bytes(data[pos: pos + 8], "little")
-            exp = int.from_bytes(data[pos: pos + 8], "little") * 1_000_000
-            pos += 8
-            key, val, pos = parse_keyvalue(data, pos)
-            store[key.decode()] = (val.decode(), exp)
-        elif op == 0xFF:
-            break
+    if args.io_model:
+        io_model = args.io_model
+    for limit in args.client_output_buffer_limit or []:
+        client_class, limits = parse_output_buffer_limit(limit)
+        if client_class == "normal":
+            client_output_buffer_limit = limits
         else:
-            key, val, pos = parse_keyvalue(data, pos - 1)
-            store[key.decode()] = (val.decode(), None)
-    return store
-
+            replica_output_buffer_limit = limits
+    if args.hz:
+        hz = min(max(args.hz, 1), 500)
+    if args.repl_backlog_size:
+        repl_backlog_size = max(parse_memory_size(args.repl_backlog_size), 16 * 1024)
+    if args.keyspace_lock_stripes:
+        keyspace.locks = KeyLocks(min(max(args.keyspace_lock_stripes, 1), 1024))
+    if args.workers:
+        workers = min(max(args.workers, 1), 1024)
+        if workers > 1 and replicaof:
+            parser.error("--workers cannot be combined with --replicaof")
+    if args.cluster_enabled:
+        cluster_enabled = args.cluster_enabled == "yes"
+        if cluster_enabled and workers > 1:
+            parser.error("--workers cannot be combined with --cluster-enabled yes")
+    if args.cluster_node:
+        cluster_nodes = args.cluster_node
+    if args.appendonly:
+        appendonly = args.appendonly == "yes"
+        if appendonly and workers > 1:
+            parser.error("--workers cannot be combined with --appendonly yes")
+        if appendonly and replicaof:
+            parser.error("--replicaof cannot be combined with --appendonly yes")
+    if args.appendfilename:
+        appendfilename = args.appendfilename
+    if args.appendfsync:
+        appendfsync = args.appendfsync
+
+
+def parse_memory_size(size: str) -> int:
+    """
+    Parses a memory size with an optional unit the way redis.conf does
 
-def parse_db_len(data: bytes, pos: int) -> tuple[int, int]:
-    """
-    Parse the length of the database
+    Example:
+        parse_memory_size("256mb") -> 268435456
+        parse_memory_size("64k") -> 64000
 
     Args:
-        data (bytes): The data to parse
-        pos (int): The current position in the data
+        size (str): The size, a number optionally followed by k, kb, m, mb, g or gb
 
     Returns:
-        tuple[int, int]: The length of the database and the new position in the data
-
-    """
-    first = data[pos]
-    pos += 1
-    start = first >> 6
-    if start == 0b00:
-        len = first
-    elif start == 0b01:
-        first = first & 0b00111111
-        second = data[pos]
-        pos += 1
-        len = (first << 8) + second
-    elif start == 0b10:
-        len = int.from_bytes(data[pos: pos + 4], "little")
-        pos += 4
-    elif start == 0b11:
-        first = first & 0b00111111
-        len = 2 ** first
-    else:
-        raise Exception(f"Unknown db len type {start} @ {pos}")
-    return (len, pos)
-
-
-def parse_db_string(data: bytes, pos: int) -> tuple[bytes, int]:
+        int: The size in bytes
     """
-    Parses a string from the Redis RDB data
+    units = {"k": 1000, "kb": 1024, "m": 1000 ** 2, "mb": 1024 ** 2, "g": 1000 ** 3, "gb": 1024 ** 3}
+    size = size.strip().lower()
+    for unit in sorted(units, key=len, reverse=True):
+        if size.endswith(unit):
+            return int(size.removesuffix(unit)) * units[unit]
+    return int(size)
 
-    Args:
-        data (bytes): The data from which to parse the string
-        pos (int): The current position in the data
 
-    Returns:
-        tuple[bytes, int]: The parsed string and the new position in the data
+def parse_output_buffer_limit(limit: str) -> tuple[str, tuple[int, int, int]]:
     """
-    len, pos = parse_db_len(data, pos)
-    vstr = data[pos: pos + len]
-    pos += len
-    return (vstr, pos)
+    Parses a client output buffer limit of the form "[<class>] <hard limit> <soft limit> <soft seconds>",
+    the class being normal (the default) or replica
 
+    A client is disconnected as soon as its pending output exceeds the hard limit, or when it stays above
+    the soft limit for more than the soft seconds. A limit of 0 disables the check.
 
-def parse_keyvalue(data: bytes, pos: int) -> tuple[bytes, bytes, int]:
-    """
-    Parses a key-value pair from the Redis RDB data
+    Example:
+        parse_output_buffer_limit("256mb 64mb 60") -> ("normal", (268435456, 67108864, 60))
+        parse_output_buffer_limit("replica 1mb 0 0") -> ("replica", (1048576, 0, 0))
 
     Args:
-        data (bytes): The data from which to parse the key-value pair
-        pos (int): The current position in the data
-
-    Raises:
-        Exception: If the value type is unsupported
+        limit (str): The limit as passed to --client-output-buffer-limit
 
     Returns:
-        tuple[bytes, bytes, int]: The parsed key-value pair and the new position in the data
+        tuple[str, tuple[int, int, int]]: The class and its hard limit, soft limit and soft seconds
+
+    Raises:
+        ValueError: If the class is unknown
     """
-    vtype = data[pos]
-    if not (vtype == 0 or 9 < vtype < 14):
-        raise Exception(f"Unsupported value type {vtype} at {pos}")
-    pos += 1
-    key, pos = parse_db_string(data, pos)
-    val, pos = parse_db_string(data, pos)
-    return (key, val, pos)
+    parts = limit.split()
+    client_class = "normal"
+    if len(parts) == 4:
+        client_class = parts.pop(0).lower()
+        if client_class == "slave":
+            client_class = "replica"
+        if client_class not in ("normal", "replica"):
+            raise ValueError(f"Invalid client class {client_class}")
+    hard, soft, soft_seconds = parts
+    return client_class, (parse_memory_size(hard), parse_memory_size(soft), int(soft_seconds))
 
 
-def find_time_and_seq(stream_id: str):
+def write_stream_entries(out: bytearray, entries: List[tuple]) -> bytearray:
     """
-    Find the time and sequence number from the stream id
-
+    summary: Appends a list of stream entries in the XRANGE reply format, every entry being an array of its ID
+    and the flat array of its field/value pairs.
     Args:
-        stream_id (str): The stream id in the format "time-sequence"
+        out (bytearray): The buffer the reply is written to.
+        entries (List[tuple]): The stream entries, (packed ID, field names, values) tuples. The field names and
+            values of an entry deleted while pending in a consumer group are None.
 
     Returns:
-        tuple[str, str | None]: A tuple containing the time and sequence number. If the sequence number is not present, it returns None.
+        bytearray: The same buffer, for chaining.
     """
-    stream_list = stream_id.split("-")
-    if len(stream_list) == 2:
-        return (stream_list[0], stream_list[1])
-    else:
-        return (stream_list[0], None)
+    write_array_header(out, len(entries))
+    for stream_id, fields, values in entries:
+        write_array_header(out, 2)
+        write_bulk_string(out, format_stream_id(stream_id))
+        if fields is None:
+            out += NULL_ARRAY
+            continue
+        write_array_header(out, len(fields) * 2)
+        for field, value in zip(fields, values):
+            write_bulk_string(out, field)
+            write_bulk_string(out, value)
+    return out
 
 
-def convert_xread_streams_to_resp(stream_list_with_key: List[tuple]) -> str:
+def write_xread_streams(out: bytearray, stream_list_with_key: List[tuple]) -> bytearray:
     """
-    summary: Converts a list of tuples containing stream keys and valid stream entries to a RESP-formatted response.
+    summary: Appends a list of tuples containing stream keys and valid stream entries in the XREAD reply format.
     Args:
+        out (bytearray): The buffer the reply is written to.
         stream_list_with_key (List[tuple]): A list of tuples, where each tuple contains a stream key and a list of valid stream entries.
 
     Returns:
-        str: The RESP-formatted response representing the stream entries.
-    """
-    response = f"*{len(stream_list_with_key)}\r\n"
-    print(f'Response start {response}')
-    if stream_list_with_key:
-        for key, valid_values in stream_list_with_key:
-            response += "*2\r\n"
-            response += convert_to_resp(key)
-            response += "*1\r\n"
-            for list_item in valid_values:
-                temp_str = ""
-                for k, v in list_item.items():
-                    if k.lower() == "id":
-                        response += "*2\r\n"
-                        response += convert_to_resp(v)
-                    else:
-                        temp_str += f"{k} {v} "
-                temp_str = temp_str.strip()
-                response += convert_to_resp(temp_str)
-
-    return response
+        bytearray: The same buffer, for chaining.
+    """
+    write_array_header(out, len(stream_list_with_key))
+    for key, valid_values in stream_list_with_key:
+        write_array_header(out, 2)
+        write_bulk_string(out, key)
+        write_stream_entries(out, valid_values)
+    return out
@@ -0,0 +1,435 @@
+import os
+import secrets
+import socket
+import tempfile
+import threading
+import time
+from typing import List
+
+from app import aof, rdb, redis_utils
+from .connection import READ_BUFFER_SIZE
+from .resp_encoder import encode_command
+
+RDB_TRANSFER_CHUNK_SIZE = 64 * 1024
+
+lock = threading.RLock()
+acks_changed = threading.Condition(lock)
+replid = secrets.token_hex(20)
+backlog: "ReplicationBacklog | None" = None
+master_link_up = False
+master_link_known = False
+
+
+class ReplicationBacklog:
+    """
+    Fixed size ring buffer holding the tail of the replication stream, the counterpart of Redis' repl_backlog
+
+    Every propagated command is appended once, `offset` counts every byte ever appended (master_repl_offset)
+    and the last `histlen` of them stay readable, so a replica that reconnects after a short network blip
+    gets the bytes it missed with +CONTINUE instead of a full resynchronization.
+
+    Args:
+        size (int): The capacity of the ring buffer in bytes
+    """
+    __slots__ = ("buf", "size", "idx", "histlen", "offset")
+
+    def __init__(self, size: int):
+        self.buf = bytearray(size)
+        self.size = size
+        self.idx = 0
+        self.histlen = 0
+        self.offset = 0
+
+    @property
+    def first_byte_offset(self) -> int:
+        """
+        Returns the replication offset of the oldest byte still held, offsets of the stream start at 1
+        """
+        return self.offset - self.histlen + 1
+
+    def feed(self, data: bytes):
+        """
+        Appends bytes of the replication stream, overwriting the oldest ones once the buffer is full
+
+        Args:
+            data (bytes): The encoded commands
+        """
+        self.offset += len(data)
+        view = memoryview(data)[-self.size:]
+        first = min(len(view), self.size - self.idx)
+        self.buf[self.idx:self.idx + first] = view[:first]
+        self.buf[:len(view) - first] = view[first:]
+        self.idx = (self.idx + len(view)) % self.size
+        self.histlen = min(self.histlen + len(view), self.size)
+
+    def read_from(self, psync_offset: int) -> bytes | None:
+        """
+        Returns the bytes of the replication stream from an offset on, the reply to PSYNC <replid> <offset>
+
+        Args:
+            psync_offset (int): The offset of the first byte the replica misses, its own offset plus one
+
+        Returns:
+            bytes | None: The bytes from that offset to the end of the stream, None if the backlog does not
+            hold them anymore and a full resynchronization is needed
+        """
+        if not self.first_byte_offset <= psync_offset <= self.offset + 1:
+            return None
+        skip = psync_offset - self.first_byte_offset
+        length = self.histlen - skip
+        start = (self.idx - self.histlen + skip) % self.size
+        if start + length <= self.size:
+            return bytes(self.buf[start:start + length])
+        return bytes(self.buf[start:]) + bytes(self.buf[:start + length - self.size])
+
+
+class Replica:
+    """
+    Replication state of a replica connection, kept on its ConnContext
+
+    Args:
+        listening_port (int): The port the replica listens on, from REPLCONF listening-port
+    """
+    __slots__ = ("listening_port", "held", "ack_offset", "ack_time")
+
+    def __init__(self, listening_port: int = 0):
+        self.listening_port = listening_port
+        self.held: bytearray | None = None
+        self.ack_offset = 0
+        self.ack_time = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        """
+        Returns send_bulk while the snapshot is transferred, online once the replica gets the stream
+        """
+        return "send_bulk" if self.held is not None else "online"
+
+
+def replica_of(client) -> Replica:
+    """
+    Returns the replication state of a connection, flagging it as a replica the first time
+
+    Args:
+        client (ConnContext): The connection of the replica
+    """
+    if client.replica is None:
+        client.replica = Replica()
+    return client.replica
+
+
+def create_backlog() -> ReplicationBacklog:
+    """
+    Creates the backlog when the first replica connects, sized by --repl-backlog-size.
+    Nothing is kept, and master_repl_offset does not move, as long as no replica ever connected.
+
+    Returns:
+        ReplicationBacklog: The backlog
+    """
+    global backlog
+    with lock:
+        if backlog is None:
+            backlog = ReplicationBacklog(redis_utils.repl_backlog_size)
+        return backlog
+
+
+def master_repl_offset() -> int:
+    """
+    Returns the offset of the replication stream: the bytes propagated by a master, the bytes applied by a replica
+    """
+    if redis_utils.replicaof:
+        return redis_utils.replica_ack_offset
+    return backlog.offset if backlog is not None else 0
+
+
+def propagate(args: List, client=None) -> int:
+    """
+    Appends a command to the replication stream: encodes it once, feeds it to the backlog and appends it to the
+    output buffer of every replica. The lock keeps the order of the stream the same for the backlog and for
+    every replica.
+
+    With --appendonly the command is appended to the AOF as well (see aof.AofWriter), REPLCONF GETACK excepted.
+    Inside EXEC the commands are buffered on the client instead, see propagate_transaction.
+
+    Nothing is sent from here: each replica connection sends its buffer in the background, in one send
+    for every command appended since the previous one, so a slow replica never stalls the writing client.
+    A replica that stops reading is disconnected once its buffer overcomes the replica output buffer limit.
+
+    Write commands propagate themselves once they succeeded, rewritten into a deterministic form when they
+    depend on the clock or on the layout of the master (the ID generated by XADD, approximate trimming,
+    consumer group deliveries) so every replica ends up with the same dataset.
+
+    Example:
+        propagate(["SET", "mykey", "myvalue"], client)
+
+    Args:
+        args (List): The command name and its arguments
+        client (ConnContext, optional): The client that ran the command, the offset is remembered as the one its
+            WAIT waits for. Defaults to None.
+
+    Returns:
+        int: The offset of the replication stream after the command
+    """
+    if client is not None and client.propagated is not None:
+        client.propagated.append(args)
+        return 0
+    if backlog is None and aof.writer is None:
+        return 0
+    return feed(encode_command(args), args[0] != "REPLCONF", client)
+
+
+def propagate_transaction(commands: List[List], client) -> int:
+    """
+    Appends the commands a transaction propagated while EXEC ran (see ConnContext.propagated) to the replication
+    stream as one unit wrapped in MULTI/EXEC, so neither the replicas nor the AOF ever see the writes of another
+    client in the middle of it
+
+    Args:
+        commands (List[List]): The command name and arguments of each propagated command, in order
+        client (ConnContext): The client that ran EXEC
+
+    Returns:
+        int: The offset of the replication stream after the transaction
+    """
+    if not commands or (backlog is None and aof.writer is None):
+        return 0
+    return feed(b"".join(encode_command(args) for args in (["MULTI"], *commands, ["EXEC"])), True, client)
+
+
+def feed(data: bytes, to_aof: bool, client=None) -> int:
+    """
+    Appends encoded commands to the AOF, the backlog and the output buffer of every replica, under the lock so
+    the order of the stream is the same for all of them
+
+    Args:
+        data (bytes): The encoded commands
+        to_aof (bool): Whether to append them to the AOF too
+        client (ConnContext, optional): The client that ran the commands. Defaults to None.
+
+    Returns:
+        int: The offset of the replication stream after the commands
+    """
+    with lock:
+        if aof.writer is not None and to_aof:
+            aof_offset = aof.writer.feed(data)
+            if client is not None:
+                client.aof_off = aof_offset
+        if backlog is None:
+            return 0
+        backlog.feed(data)
+        offset = backlog.offset
+        if client is not None:
+            client.woff = offset
+        for replica_client in list(redis_utils.replica_sockets.values()):
+            if replica_client.replica.held is not None:
+                replica_client.replica.held += data
+                continue
+            replica_client.write(data)
+            replica_client.schedule_flush()
+    return offset
+
+
+def propagate_expired(key: str):
+    """
+    Propagates the deletion of a key that expired as a DEL, so replicas and the AOF drop it even when their own
+    clock did not reach its expire time yet, installed as the on_expire hook of the keyspace
+
+    Args:
+        key (str): The key
+    """
+    propagate(["DEL", key])
+
+
+def add_replica(client):
+    """
+    Registers a replica that gets the replication stream. Must be called with the lock held.
+
+    Args:
+        client (ConnContext): The connection of the replica
+    """
+    replica_of(client).ack_time = time.monotonic()
+    redis_utils.replica_sockets[client.addr] = client
+
+
+def record_ack(client, offset: int):
+    """
+    Records the offset a replica acknowledged with REPLCONF ACK
+
+    Args:
+        client (ConnContext): The connection of the replica
+        offset (int): The offset of the last byte the replica applied
+    """
+    replica = replica_of(client)
+    with acks_changed:
+        replica.ack_offset = max(replica.ack_offset, offset)
+        replica.ack_time = time.monotonic()
+        acks_changed.notify_all()
+
+
+def count_acked_replicas(offset: int) -> int:
+    """
+    Returns the number of replicas that acknowledged the given offset. Must be called with the lock held.
+
+    Args:
+        offset (int): The offset of the replication stream
+    """
+    return sum(1 for client in redis_utils.replica_sockets.values() if client.replica.ack_offset >= offset)
+
+
+def wait_for_replicas(offset: int, num_replicas: int, timeout_ms: int) -> int:
+    """
+    Blocks until at least num_replicas replicas acknowledged the given offset or the timeout expires.
+    Replicas get a REPLCONF GETACK unless enough of them already acknowledged the offset, and every
+    REPLCONF ACK wakes the waiter to count again, so the wait lasts as long as the replication lag.
+
+    Args:
+        offset (int): The offset to wait for, the one after the last write of the client
+        num_replicas (int): The number of replicas to wait for
+        timeout_ms (int): The timeout in milliseconds, 0 to wait forever
+
+    Returns:
+        int: The number of replicas that acknowledged the offset
+    """
+    deadline = time.monotonic() + timeout_ms / 1000 if timeout_ms else None
+    with acks_changed:
+        acked = count_acked_replicas(offset)
+        if acked >= num_replicas:
+            return acked
+        propagate(["REPLCONF", "GETACK", "*"])
+        while acked < num_replicas:
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            acks_changed.wait(remaining)
+            acked = count_acked_replicas(offset)
+    return acked
+
+
+def replica_info_lines() -> List[str]:
+    """
+    Returns one line per replica for INFO replication: its address and state, the offset it last
+    acknowledged, the seconds since that acknowledgment (lag) and the bytes of stream waiting in its
+    output buffer, which grows when the replica does not keep up
+    """
+    lines = []
+    now = time.monotonic()
+    with lock:
+        clients = list(redis_utils.replica_sockets.values())
+    for i, client in enumerate(clients):
+        replica = client.replica
+        ip = client.addr[0] if isinstance(client.addr, tuple) else client.addr
+        pending = len(client.out_buf) + (len(replica.held) if replica.held is not None else 0)
+        lines.append(f"slave{i}:ip={ip},port={replica.listening_port},state={replica.state},"
+                     f"offset={replica.ack_offset},lag={int(now - replica.ack_time)},output_buffer={pending}")
+    return lines
+
+
+def remove_replica(client):
+    """
+    Forgets a replica whose connection was closed
+
+    Args:
+        client (ConnContext): The connection of the replica
+    """
+    with lock:
+        if redis_utils.replica_sockets.get(client.addr) is client:
+            del redis_utils.replica_sockets[client.addr]
+
+
+def start_full_sync(client):
+    """
+    Registers a replica that gets a full resynchronization and starts sending it a snapshot of the keyspace.
+    Must be called with the lock held, right after +FULLRESYNC was written, so the snapshot matches the
+    offset announced to the replica.
+
+    Python cannot fork a copy-on-write child like BGSAVE does, so the snapshot is written synchronously to a
+    temporary file, which costs one pass over the keyspace, and a thread streams it in chunks of
+    RDB_TRANSFER_CHUNK_SIZE bytes, waiting for each one to drain so neither the output buffer of the replica
+    nor the memory of the server grows with the dataset. Commands propagated meanwhile are held and sent once
+    the snapshot is through.
+
+    Args:
+        client (ConnContext): The connection of the replica
+    """
+    snapshot = tempfile.TemporaryFile()
+    try:
+        keys = rdb.save_rdb(snapshot, redis_utils.keyspace)
+    except Exception:
+        snapshot.close()
+        raise
+    print(f"Full resync snapshot of {keys} keys, {snapshot.tell()} bytes")
+    add_replica(client)
+    client.replica.held = bytearray()
+    threading.Thread(target=send_snapshot, args=(client, snapshot), daemon=True).start()
+
+
+def send_snapshot(client, snapshot):
+    """
+    Sends the snapshot as a bulk string without trailing CRLF, then the commands held during the transfer
+
+    Args:
+        client (ConnContext): The connection of the replica
+        snapshot (BinaryIO): The temporary file holding the snapshot, closed when done
+    """
+    try:
+        with snapshot:
+            size = snapshot.tell()
+            snapshot.seek(0)
+            client.write(b"$%d\r\n" % size)
+            while chunk := snapshot.read(RDB_TRANSFER_CHUNK_SIZE):
+                client.write(chunk)
+                client.wait_drained(RDB_TRANSFER_CHUNK_SIZE)
+                if client.closing or client.conn.fileno() == -1:
+                    return
+        with lock:
+            held, client.replica.held = client.replica.held, None
+            if redis_utils.replica_sockets.get(client.addr) is not client:
+                return
+            client.write(held)
+            client.schedule_flush()
+    except OSError as e:
+        print(f"Snapshot transfer to {client.addr} failed: {e}")
+
+
+def load_snapshot_from_master(m_conn: socket.socket, buf: bytes) -> bytes:
+    """
+    Receives the snapshot that follows +FULLRESYNC and replaces the keyspace with it. The snapshot is
+    streamed into a temporary file as it arrives instead of being buffered in memory, then loaded with
+    the LOADING flag set like the RDB file at startup.
+
+    Args:
+        m_conn (socket.socket): The connection to the master
+        buf (bytes): The bytes already received after +FULLRESYNC
+
+    Returns:
+        bytes: The bytes received after the snapshot, the start of the replication stream
+    """
+    while b"\r\n" not in buf:
+        data = m_conn.recv(READ_BUFFER_SIZE)
+        if not data:
+            raise ConnectionError("Connection lost while waiting for the snapshot")
+        buf += data
+    header, buf = buf.split(b"\r\n", 1)
+    if header[:1] != b"$":
+        raise ConnectionError(f"Expected the snapshot bulk string, got {header[:32]!r}")
+    size = int(header[1:])
+    body, buf = buf[:size], buf[size:]
+    remaining = size - len(body)
+    with tempfile.NamedTemporaryFile(prefix="temp-replica-", suffix=".rdb", delete=False) as snapshot:
+        snapshot.write(body)
+    try:
+        with open(snapshot.name, "ab") as out:
+            while remaining:
+                data = m_conn.recv(min(READ_BUFFER_SIZE, remaining))
+                if not data:
+                    raise ConnectionError("Connection lost while receiving the snapshot")
+                out.write(data)
+                remaining -= len(data)
+        print(f"Received the snapshot of the master, {size} bytes")
+        redis_utils.loading = True
+        with redis_utils.keyspace.locks.hold():
+            redis_utils.keyspace.clear()
+        rdb.load_rdb(snapshot.name)
+    finally:
+        os.unlink(snapshot.name)
+    return buf
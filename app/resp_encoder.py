@@ -0,0 +1,179 @@
+from typing import Iterable
+
+OBJ_SHARED_INTEGERS = 10000
+OBJ_SHARED_HDR_LEN = 1024
+
+CRLF = b"\r\n"
+OK = b"+OK\r\n"
+PONG = b"+PONG\r\n"
+QUEUED = b"+QUEUED\r\n"
+NULL_BULK = b"$-1\r\n"
+NULL_ARRAY = b"*-1\r\n"
+EMPTY_ARRAY = b"*0\r\n"
+
+SHARED_INTEGERS = [b":%d\r\n" % i for i in range(OBJ_SHARED_INTEGERS)]
+SHARED_BULK_HDR = [b"$%d\r\n" % i for i in range(OBJ_SHARED_HDR_LEN)]
+SHARED_ARRAY_HDR = [b"*%d\r\n" % i for i in range(OBJ_SHARED_HDR_LEN)]
+
+
+def to_bytes(value) -> bytes:
+    """
+    Converts a value stored by the server to the bytes sent on the wire.
+    Strings holding non UTF-8 bytes (decoded with surrogateescape) get their original bytes back.
+
+    Example:
+        to_bytes("hello") -> b'hello'
+        to_bytes(42) -> b'42'
+
+    Args:
+        value (str | bytes | int): The value to convert
+
+    Returns:
+        bytes: The encoded value
+    """
+    if isinstance(value, str):
+        return value.encode("utf-8", "surrogateescape")
+    if isinstance(value, int):
+        return b"%d" % value
+    return bytes(value)
+
+
+def write_bulk_string(out: bytearray, value) -> bytearray:
+    """
+    Appends a bulk string, or a null bulk string when the value is None
+
+    Example:
+        write_bulk_string(bytearray(), "hey") -> bytearray(b'$3\r\nhey\r\n')
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        value (str | bytes | int | None): The value to encode
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    if value is None:
+        out += NULL_BULK
+        return out
+    data = to_bytes(value)
+    size = len(data)
+    out += SHARED_BULK_HDR[size] if size < OBJ_SHARED_HDR_LEN else b"$%d\r\n" % size
+    out += data
+    out += CRLF
+    return out
+
+
+def write_array_header(out: bytearray, length: int) -> bytearray:
+    """
+    Appends the header of an array of the given length, the elements are written by the caller
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        length (int): The number of elements of the array
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    out += SHARED_ARRAY_HDR[length] if 0 <= length < OBJ_SHARED_HDR_LEN else b"*%d\r\n" % length
+    return out
+
+
+def write_array(out: bytearray, items: Iterable) -> bytearray:
+    """
+    Appends an array, strings become bulk strings, ints become integers, None becomes a null bulk string
+    and nested lists or tuples become nested arrays
+
+    Example:
+        write_array(bytearray(), ["SET", "key", "value"]) -> bytearray(b'*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nvalue\r\n')
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        items (Iterable): The elements of the array
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    if not isinstance(items, (list, tuple)):
+        items = list(items)
+    write_array_header(out, len(items))
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            write_array(out, item)
+        elif isinstance(item, int):
+            write_integer(out, item)
+        else:
+            write_bulk_string(out, item)
+    return out
+
+
+def write_integer(out: bytearray, value: int) -> bytearray:
+    """
+    Appends an integer reply, small non-negative integers come from a preencoded table
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        value (int): The integer to encode
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    out += SHARED_INTEGERS[value] if 0 <= value < OBJ_SHARED_INTEGERS else b":%d\r\n" % value
+    return out
+
+
+def write_simple_string(out: bytearray, value: str) -> bytearray:
+    """
+    Appends a simple string reply, the value must not contain CR or LF
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        value (str): The string to encode
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    out += b"+"
+    out += to_bytes(value)
+    out += CRLF
+    return out
+
+
+def write_error(out: bytearray, message: str) -> bytearray:
+    """
+    Appends an error reply, the message starts with the error code (ERR, WRONGTYPE, ...)
+
+    Example:
+        write_error(bytearray(), "ERR syntax error") -> bytearray(b'-ERR syntax error\r\n')
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        message (str): The error code followed by the error message
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    out += b"-"
+    out += to_bytes(message)
+    out += CRLF
+    return out
+
+
+def encode_command(args: Iterable) -> bytes:
+    """
+    Encodes a command as an array of bulk strings, the form used to talk to masters and replicas
+
+    Example:
+        encode_command(["REPLCONF", "GETACK", "*"]) -> b'*3\r\n$8\r\nREPLCONF\r\n$6\r\nGETACK\r\n$1\r\n*\r\n'
+
+    Args:
+        args (Iterable): The command name followed by its arguments
+
+    Returns:
+        bytes: The encoded command
+    """
+    out = bytearray()
+    items = list(args)
+    write_array_header(out, len(items))
+    for item in items:
+        write_bulk_string(out, item)
+    return bytes(out)
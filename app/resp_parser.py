@@ -0,0 +1,150 @@
+from typing import Iterator, List, Optional
+
+MAX_INLINE_SIZE = 64 * 1024
+MAX_BULK_LEN = 512 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when the client sends bytes that are not valid RESP2"""
+
+
+class RespParser:
+    """
+    Incremental, binary safe RESP2 request parser, one instance per connection
+
+    Bytes are appended with `feed` as they arrive and `commands` yields every complete command found in
+    the buffer. A command split across reads is not re-parsed from scratch, the parser remembers how many
+    arguments are still missing and the length of the bulk string it is waiting for, so a single 64 KiB
+    read can drive dozens of pipelined commands and a 10 MiB value costs one copy.
+
+    Example:
+        parser = RespParser()
+        parser.feed(b"*1\r\n$4\r\nPING\r\n*2\r\n$4\r\nECHO\r\n$2\r\nhi")
+        list(parser.commands()) -> [[b'PING']]
+        parser.feed(b"\r\n")
+        list(parser.commands()) -> [[b'ECHO', b'hi']]
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.compacted = 0
+        self._args: List[bytes] = []
+        self._multibulk_len = 0
+        self._bulk_len = -1
+
+    def feed(self, data: bytes):
+        """
+        Appends freshly received bytes to the parse buffer
+
+        Args:
+            data (bytes): The bytes read from the socket
+        """
+        self.buf += data
+
+    def consumed(self) -> int:
+        """
+        Returns the number of bytes consumed since the parser was created. Right after a command was yielded
+        these are exactly the bytes of every command parsed so far, the replication offset of a replica.
+        """
+        return self.compacted + self.pos
+
+    def pending(self) -> int:
+        """
+        Returns the number of buffered bytes not consumed by a complete command yet
+        """
+        return len(self.buf) - self.pos
+
+    def commands(self) -> Iterator[List[bytes]]:
+        """
+        Yields every complete command available in the buffer
+
+        Raises:
+            ProtocolError: If the buffer holds malformed RESP
+
+        Yields:
+            List[bytes]: The arguments of the command, name first
+        """
+        try:
+            while True:
+                cmd = self._parse_command()
+                if cmd is None:
+                    break
+                if cmd:
+                    yield cmd
+        finally:
+            self._compact()
+
+    def _compact(self):
+        self.compacted += self.pos
+        if self.pos == len(self.buf):
+            self.buf.clear()
+            self.pos = 0
+        elif self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+
+    def _parse_command(self) -> Optional[List[bytes]]:
+        buf = self.buf
+        pos = self.pos
+        if self._multibulk_len == 0:
+            if pos >= len(buf):
+                return None
+            if buf[pos] != 0x2A:
+                return self._parse_inline()
+            end = buf.find(b"\r\n", pos)
+            if end == -1:
+                if len(buf) - pos > MAX_INLINE_SIZE:
+                    raise ProtocolError("too big mbulk count string")
+                return None
+            try:
+                multibulk_len = int(buf[pos + 1:end])
+            except ValueError:
+                raise ProtocolError("invalid multibulk length")
+            self.pos = pos = end + 2
+            if multibulk_len <= 0:
+                return []
+            self._multibulk_len = multibulk_len
+
+        while self._multibulk_len:
+            if self._bulk_len == -1:
+                if pos >= len(buf):
+                    break
+                if buf[pos] != 0x24:
+                    raise ProtocolError(f"expected '$', got '{chr(buf[pos])}'")
+                end = buf.find(b"\r\n", pos)
+                if end == -1:
+                    if len(buf) - pos > MAX_INLINE_SIZE:
+                        raise ProtocolError("too big bulk count string")
+                    break
+                try:
+                    bulk_len = int(buf[pos + 1:end])
+                except ValueError:
+                    raise ProtocolError("invalid bulk length")
+                if bulk_len < 0 or bulk_len > MAX_BULK_LEN:
+                    raise ProtocolError("invalid bulk length")
+                self._bulk_len = bulk_len
+                pos = end + 2
+            if len(buf) - pos < self._bulk_len + 2:
+                break
+            self._args.append(bytes(buf[pos:pos + self._bulk_len]))
+            pos += self._bulk_len + 2
+            self._bulk_len = -1
+            self._multibulk_len -= 1
+
+        self.pos = pos
+        if self._multibulk_len:
+            return None
+        args = self._args
+        self._args = []
+        return args
+
+    def _parse_inline(self) -> Optional[List[bytes]]:
+        end = self.buf.find(b"\n", self.pos)
+        if end == -1:
+            if len(self.buf) - self.pos > MAX_INLINE_SIZE:
+                raise ProtocolError("too big inline request")
+            return None
+        line = bytes(self.buf[self.pos:end])
+        self.pos = end + 1
+        return line.split()
@@ -1,10 +1,19 @@
-import copy
 import socket
+import time
 from dataclasses import dataclass
-from typing import List, NamedTuple, Tuple
+from typing import Callable, Dict, List, NamedTuple
 
+from app import cluster
 from app import redis_commands
 from app import redis_utils
+from app import replication
+from app import workers
+from .connection import READ_BUFFER_SIZE, ConnContext
+from .resp_encoder import (EMPTY_ARRAY, NULL_ARRAY, NULL_BULK, OK, QUEUED, encode_command, write_array_header,
+                           write_bulk_string, write_error, write_integer, write_simple_string)
+from .resp_parser import ProtocolError
+
+REPLICA_ACK_PERIOD = 1
 
 
 class Token(NamedTuple):
@@ -12,15 +21,31 @@ class Token(NamedTuple):
     data: bytes
 
 
-@dataclass
-class ConnContext:
-    id: int
-    conn: socket.socket
+def replicate_from_master(host: str, master_port: int, port: int):
+    """
+    Keeps the replica connected to its master: connects, performs the handshake and applies the replication
+    stream, then reconnects after a second when the link drops. The reconnection asks for a partial
+    resynchronization from the last offset applied.
+
+    Args:
+        host (str): The host of the master server
+        master_port (int): The port of the master server
+        port (int): The port this replica listens on
+    """
+    while True:
+        try:
+            perform_handshake_with_master(socket.create_connection((host, master_port)), port)
+        except (ConnectionError, OSError, AssertionError) as e:
+            print(f"Connection with master lost: {e}")
+        replication.master_link_up = False
+        time.sleep(1)
 
 
 def perform_handshake_with_master(m_conn, port: int):
     """
-    Performs the handshake with the master server
+    Performs the handshake with the master server. The first one sends PSYNC ? -1, later ones send the
+    replication ID of the master and the offset after the last byte applied, and the master either continues
+    the stream from there (+CONTINUE) or sends a full resynchronization.
 
     Args:
         m_conn (socket.socket): The connection to the master server
@@ -29,78 +54,87 @@ def perform_handshake_with_master(m_conn, port: int):
     buf = b""
 
     with m_conn:
-        m_conn.send("*1\r\n$4\r\nping\r\n".encode())
+        m_conn.send(encode_command(["PING"]))
         token, buf = get_token(m_conn, buf)
         if token != Token("+", b"PONG"):
             print("Sync err: didn't get PONG")
             return
-        m_conn.send(
-            redis_utils.convert_to_resp(f"replconf listening-port {port}").encode()
-        )
+        m_conn.send(encode_command(["REPLCONF", "listening-port", port]))
         token, buf = get_token(m_conn, buf)
         if token != Token("+", b"OK"):
             print("Sync err: didn't get OK for listening port")
             return
-        m_conn.send(redis_utils.convert_to_resp("replconf capa psync2").encode())
+        m_conn.send(encode_command(["REPLCONF", "capa", "psync2"]))
         token, buf = get_token(m_conn, buf)
         if token != Token("+", b"OK"):
             print("Sync err: didn't get OK for capa")
             return
-        m_conn.send(redis_utils.convert_to_resp("psync ? -1").encode())
+        if replication.master_link_known:
+            m_conn.send(encode_command(["PSYNC", replication.replid, redis_utils.replica_ack_offset + 1]))
+        else:
+            m_conn.send(encode_command(["PSYNC", "?", "-1"]))
         token, buf = get_token(m_conn, buf)
         resp_arr = token.data.split(b" ")
-        if resp_arr[0] != b"FULLRESYNC":
-            print("Sync err: didn't get FULLRESYNC for psync")
-            return
-
-        token, buf = get_token(m_conn, buf)
-
-        if token.type != "$":
-            print("Sync err: didn't get RDB for psync")
+        if resp_arr[0] == b"CONTINUE":
+            if len(resp_arr) > 1:
+                replication.replid = resp_arr[1].decode()
+            print(f"Partial resynchronization from offset {redis_utils.replica_ack_offset + 1}")
+        elif resp_arr[0] == b"FULLRESYNC":
+            buf = replication.load_snapshot_from_master(m_conn, buf)
+            replication.replid = resp_arr[1].decode()
+            redis_utils.replica_ack_offset = int(resp_arr[2])
+            replication.master_link_known = True
+        else:
+            print("Sync err: didn't get FULLRESYNC or CONTINUE for psync")
             return
-        client_loop(m_conn, True, buf)
+        replication.master_link_up = True
+        master_link_loop(m_conn, buf)
 
 
-def client_loop(conn: socket.socket, from_master: bool = False, prev_buf: bytes = b""):
+def master_link_loop(conn: socket.socket, prev_buf: bytes = b""):
     """
-    Main loop for the client
+    Applies the replication stream of the master. Every command goes through the command table like the
+    commands of a client, with its reply dropped (REPLCONF GETACK excepted). Each read is parsed at once and
+    every complete command in it is applied before the next read, so a replica keeps up with a pipelined stream.
+    The replication offset advances by the bytes of each command parsed, it is what REPLCONF ACK reports, on
+    REPLCONF GETACK and every REPLICA_ACK_PERIOD seconds so the master knows the lag of the replica.
 
     Args:
-        conn (socket.socket): The connection to the client
-        from_master (bool, optional): Whether the client is connected from the master server. Defaults to False.
-        prev_buf (bytes, optional): The previous buffer. Defaults to b"".
+        conn (socket.socket): The connection to the master server
+        prev_buf (bytes, optional): The bytes received with the end of the handshake. Defaults to b"".
     """
-    print(f"Client loop start {conn}")
-    cctx = ConnContext(conn.fileno(), conn)
+    print(f"Master link loop start {conn}")
+    client = ConnContext(conn.fileno(), conn, conn.getpeername(), from_master=True)
+    base_offset = redis_utils.replica_ack_offset
+    data = prev_buf
+    last_ack = time.monotonic()
+    conn.settimeout(REPLICA_ACK_PERIOD)
     with conn:
-        buf = prev_buf
         while True:
+            client.parser.feed(data)
             try:
-                cmd: list[bytes] = []
-                token, buf = get_token(conn, buf)
-                if token.type != "*":
-                    continue
-                arr_len = int(token.data)
-                if arr_len < 1:
-                    continue
-                for _ in range(arr_len):
-                    token, buf = get_token(conn, buf)
-                    cmd.append(token.data)
-                print(f"Got command: {cmd}")
-                cmd_str = [byte.decode('utf-8') for byte in cmd]
-                if cmd_str[0].lower() == "set":
-                    redis_commands.set_command_helper(cmd_str, len(cmd), conn, from_master=True)
-                elif cmd_str[0].lower() == "replconf" and cmd_str[1].lower() == "getack":
-                    msg = f"REPLCONF ACK {redis_utils.replica_ack_offset}"
-                    resp_msg = redis_utils.convert_to_resp(msg)
-                    resp_msg_bytes = resp_msg.encode()
-                    conn.send(resp_msg_bytes)
-
-                redis_utils.replica_ack_offset = redis_utils.replica_ack_offset + len(
-                    redis_utils.convert_to_resp(" ".join(cmd_str), True).encode())
-            except (ConnectionError, AssertionError):
+                for cmd in client.parser.commands():
+                    msg_arr = decode_command(cmd)
+                    try:
+                        choose_argument_and_send_output(msg_arr, len(msg_arr), client)
+                    except Exception as e:
+                        print(f"Error occurred while applying {msg_arr[0]} from the master: {e}")
+                    redis_utils.replica_ack_offset = base_offset + client.parser.consumed()
+            except ProtocolError as e:
+                print(f"Protocol error in the replication stream: {e}")
                 break
-    print(f"Client loop stop {conn}")
+            if time.monotonic() - last_ack >= REPLICA_ACK_PERIOD:
+                client.write(encode_command(["REPLCONF", "ACK", redis_utils.replica_ack_offset]), force=True)
+                last_ack = time.monotonic()
+            client.flush()
+            try:
+                data = conn.recv(READ_BUFFER_SIZE)
+            except socket.timeout:
+                data = b""
+                continue
+            if not data:
+                break
+    print(f"Master link loop stop {conn}")
 
 
 def get_token(
@@ -143,169 +177,596 @@ def get_token(
             raise ConnectionError
 
 
-def accept_client_concurrently(client_socket: socket, addr: str):
+def accept_client_concurrently(client_socket: socket, addr: str, from_worker: bool = False):
     """
     Accepts a client connection and handles it concurrently
 
     Args:
         client_socket (socket): Socket representing the connection
         addr (str): Address of the client for IP sockets
+        from_worker (bool, optional): Whether the connection comes from another worker. Defaults to False.
     """
+    client = ConnContext(client_socket.fileno(), client_socket, addr, from_worker=from_worker)
     try:
         print(f"Inside accept_client_concurrently with {addr}")
         while True:
-            data: bytes = client_socket.recv(1024)
+            data: bytes = client_socket.recv(READ_BUFFER_SIZE)
             if not data:
                 break
-            message: str = data.decode("utf-8")
-            msg_arr, number_of_args = parse_message(message)
-            choose_argument_and_send_output(msg_arr, number_of_args, client_socket, addr)
+            client.parser.feed(data)
+            for cmd in client.parser.commands():
+                msg_arr = decode_command(cmd)
+                choose_argument_and_send_output(msg_arr, len(msg_arr), client)
+                if client.closing:
+                    break
+            client.flush_forwarded()
+            client.flush()
+            if client.closing:
+                break
+    except ProtocolError as e:
+        client.write(write_error(bytearray(), f"ERR Protocol error: {e}"))
     except Exception as e:
         print(f"Error occurred while handling client: {e}")
     finally:
+        try:
+            client.flush()
+        except OSError:
+            pass
+        replication.remove_replica(client)
+        unwatch_all_keys(client)
         client_socket.close()
 
 
-def parse_message(message: str) -> Tuple[List[str], int]:
+def decode_command(cmd: List[bytes]) -> List[str]:
+    """
+    Decodes the raw arguments produced by the RESP parser into the strings the command helpers work on.
+    Bytes that are not valid UTF-8 are kept as surrogates so binary values survive the round trip.
+
+    Example:
+        decode_command([b"SET", b"mykey", b"myvalue"]) -> ['SET', 'mykey', 'myvalue']
+
+    Args:
+        cmd (List[bytes]): The raw command arguments
+
+    Returns:
+        List[str]: The decoded arguments
+    """
+    return [arg.decode("utf-8", "surrogateescape") for arg in cmd]
+
+
+ACL_CATEGORIES = {"write": "@write", "readonly": "@read", "admin": "@admin", "blocking": "@blocking", "fast": "@fast"}
+
+
+@dataclass(frozen=True)
+class RedisCommand:
+    """
+    Entry of the command table
+
+    Args:
+        name (str): The lowercase command name
+        handler (Callable): The helper running the command, called with (message_arr, n_args, client)
+        arity (int): The exact number of arguments including the name, or -N for at least N
+        flags (frozenset): Flags such as write, readonly, blocking, admin, fast
+        first_key (int): Index of the first key argument, 0 when the command takes no keys
+        last_key (int): Index of the last key argument, -1 for the last argument
+        step (int): Step between key arguments
+    """
+    name: str
+    handler: Callable
+    arity: int
+    flags: frozenset
+    first_key: int = 0
+    last_key: int = 0
+    step: int = 0
+
+    def check_arity(self, n_args: int) -> bool:
+        """
+        Checks the number of arguments against the arity of the command
+
+        Args:
+            n_args (int): The number of arguments including the command name
+
+        Returns:
+            bool: True if the command can run with that many arguments
+        """
+        if self.arity >= 0:
+            return n_args == self.arity
+        return n_args >= -self.arity
+
+
+def is_blocking_command(message_arr: List[str]) -> bool:
+    """
+    Checks whether a command blocks the thread running it while waiting for replicas or for another worker.
+    The event loop runs such commands off the loop thread so they never stall other connections,
+    commands blocking on keys (XREAD and XREADGROUP BLOCK) go through app.blocking instead and need no thread,
+    unless their keys belong to another worker.
+
+    Args:
+        message_arr (List[str]): The parsed message array
+
+    Returns:
+        bool: True for WAIT, and for XREAD and XREADGROUP forwarded to another worker
+    """
+    command = COMMAND_TABLE.get(message_arr[0].lower())
+    if command is None or "blocking" not in command.flags:
+        return False
+    if command.name not in ("xread", "xreadgroup"):
+        return True
+    keys = stream_keys(message_arr)
+    if redis_utils.workers <= 1 or not keys:
+        return False
+    try:
+        return workers.owner_of_keys(keys) != workers.index
+    except workers.CrossWorkerError:
+        return False
+
+
+def stream_keys(message_arr: List[str]) -> List[str]:
+    """
+    Returns the keys of XREAD and XREADGROUP, the first half of the arguments following STREAMS
+
+    Args:
+        message_arr (List[str]): The parsed message array
+
+    Returns:
+        List[str]: The keys, empty when STREAMS is missing
     """
-    Parses a Redis protocol message and extracts the arguments and number of arguments
+    for i, arg in enumerate(message_arr):
+        if arg.lower() == "streams":
+            return message_arr[i + 1:i + 1 + (len(message_arr) - i - 1) // 2]
+    return []
+
+
+def command_keys(command: RedisCommand, message_arr: List[str], client: ConnContext) -> List[str] | None:
+    """
+    Returns the keys a command accesses, read from the key specs of the command table, the command runs
+    holding the lock stripes of these keys only. The keys of XREAD and XREADGROUP follow STREAMS, EXEC
+    accesses the keys of its queued commands and the keys the client WATCHes. The other commands without
+    keys access the whole keyspace (KEYS, INFO, PSYNC...) except fast ones, WAIT and REPLCONF, which need no lock.
 
     Example:
-        parse_message("*3\r\n$3\r\nSET\r\n$5\r\nmykey\r\n$5\r\nmyvalue\r\n") -> (['SET', 'mykey', 'myvalue'], 3)
-        parse_message("*1\r\n$4\r\nPING\r\n") -> (['PING'], 1)
+        command_keys(COMMAND_TABLE["set"], ["SET", "a", "1"], client) -> ['a']
 
     Args:
-        message (str): The Redis protocol message
+        command (RedisCommand): The command table entry
+        message_arr (List[str]): The parsed message array
+        client (ConnContext): The client running the command
 
     Returns:
-        Tuple[List[str], int]: The arguments and the number of arguments
+        List[str] | None: The keys, None for the whole keyspace
+    """
+    if command.first_key:
+        last_key = command.last_key if command.last_key >= 0 else len(message_arr) + command.last_key
+        return message_arr[command.first_key:last_key + 1:command.step]
+    if command.name in ("xread", "xreadgroup"):
+        return stream_keys(message_arr)
+    if command.name == "exec":
+        keys = list(client.watched)
+        for queued_command, queued_message_arr in client.multi or ():
+            queued_keys = command_keys(queued_command, queued_message_arr, client)
+            if queued_keys is None:
+                return None
+            keys += queued_keys
+        return keys
+    if "fast" in command.flags or command.name in ("wait", "replconf"):
+        return []
+    return None
+
+
+def multi_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    msg_arr: List[str] = message.split("\r\n")
-    number_of_args: int = int(msg_arr.pop(0).removeprefix("*"))
-    msg_arr.remove(msg_arr[0])
-    args_arr = msg_arr[::2]
-    return (args_arr, number_of_args)
+    Handles the MULTI command, every following command of the client is validated and queued until EXEC or DISCARD
+
+    Args:
+        message_arr (List[str]): The parsed message array
+        n_args (int): The number of arguments in the message array
+        client (ConnContext): The client connection to write responses to
+    """
+    if client.multi is not None:
+        client.write(write_error(bytearray(), "ERR MULTI calls can not be nested"))
+        return
+    client.multi = []
+    client.multi_error = False
+    client.write(OK)
 
 
-def multi_command_helper(message_arr: List[str], n_args: int, client_socket: socket, addr: str):
+def exec_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
     """
-    Handles the MULTI and EXEC commands
+    Handles the EXEC command, runs every queued command and replies with all of their responses.
+
+    The transaction is aborted with EXECABORT when a command was rejected while queuing, and with a null
+    reply when one of the WATCHed keys changed since WATCH. Otherwise the queued commands run one after the
+    other holding the lock stripes of every key they and the WATCHed keys access (see command_keys), so no other
+    client sees or makes a change to these keys in between, and their
+    replies follow the array header in the output buffer, flushed with a single send. Commands that would
+    block reply as if they timed out. The commands the transaction propagates reach the replicas and the AOF
+    as one unit wrapped in MULTI/EXEC once they all ran (see replication.propagate_transaction).
 
     Args:
         message_arr (List[str]): The parsed message array
         n_args (int): The number of arguments in the message array
-        client_socket (socket): The socket representing the connection
-        addr (str): The address of the client for IP sockets
+        client (ConnContext): The client connection to write responses to
     """
-    client_socket.send("+OK\r\n".encode())
-    while True:
-        data: bytes = client_socket.recv(1024)
-        if not data:
-            break
-        message: str = data.decode("utf-8")
-        msg_arr: List[str] = message.split("\r\n")
-        args_arr = msg_arr[::2]
-        args_arr.remove(args_arr[0])
-        if (redis_utils.multi_queue_commands.get(addr, None) is None and redis_utils.queue_commands_response.get(addr,
-                                                                                                                 None) is None):
-            redis_utils.multi_queue_commands.update({addr: []})
-            redis_utils.queue_commands_response.update({addr: []})
-        if args_arr[0].lower() == "exec" and len(redis_utils.multi_queue_commands.get(addr)) == 0:
-            client_socket.send("*0\r\n".encode())
-            return
-        elif args_arr[0].lower() == "discard":
-            redis_utils.multi_queue_commands = []
-            client_socket.send("+OK\r\n".encode())
-            return
-        elif args_arr[0].lower() == "exec" and len(redis_utils.multi_queue_commands.get(addr)) > 0:
-            while len(redis_utils.multi_queue_commands.get(addr)) != 0:
-                commands = redis_utils.multi_queue_commands.get(addr).pop(0)
-                choose_argument_and_send_output(commands, len(commands), client_socket, addr, True)
-            num_response = len(redis_utils.queue_commands_response.get(addr))
-            response_string = "".join(redis_utils.queue_commands_response.get(addr))
-            response = f"*{num_response}\r\n{response_string}"
-            redis_utils.queue_commands_response.pop(addr)
-            client_socket.send(response.encode())
-        else:
-            redis_utils.multi_queue_commands.get(addr).append(args_arr)
-            client_socket.send("+QUEUED\r\n".encode())
+    if client.multi is None:
+        client.write(write_error(bytearray(), "ERR EXEC without MULTI"))
+        return
+    queued_commands, client.multi = client.multi, None
+    if client.multi_error:
+        unwatch_all_keys(client)
+        client.write(write_error(bytearray(), "EXECABORT Transaction discarded because of previous errors."))
+        return
+    if watched_keys_changed(client):
+        unwatch_all_keys(client)
+        client.write(NULL_ARRAY)
+        return
+    unwatch_all_keys(client)
+    client.write(write_array_header(bytearray(), len(queued_commands)))
+    client.deny_blocking = True
+    client.propagated = []
+    try:
+        for command, queued_message_arr in queued_commands:
+            command.handler(queued_message_arr, len(queued_message_arr), client)
+    finally:
+        client.deny_blocking = False
+        propagated, client.propagated = client.propagated, None
+        replication.propagate_transaction(propagated, client)
 
 
-def choose_argument_and_send_output(
-        message_arr: List[str], n_args: int, client_socket: socket, addr: str, is_multi_command: bool = False
-):
+def discard_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the DISCARD command, drops every queued command of the transaction and unwatches every key
+
+    Args:
+        message_arr (List[str]): The parsed message array
+        n_args (int): The number of arguments in the message array
+        client (ConnContext): The client connection to write responses to
+    """
+    if client.multi is None:
+        client.write(write_error(bytearray(), "ERR DISCARD without MULTI"))
+        return
+    client.multi = None
+    client.multi_error = False
+    unwatch_all_keys(client)
+    client.write(OK)
+
+
+def watch_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the WATCH command, the next EXEC of the client aborts if one of the keys changes meanwhile
+
+    Example:
+        watch_command_helper(["WATCH", "balance", "history"], 3, client)
+
+    Args:
+        message_arr (List[str]): The parsed message array
+        n_args (int): The number of arguments in the message array
+        client (ConnContext): The client connection to write responses to
+    """
+    if client.multi is not None:
+        client.write(write_error(bytearray(), "ERR WATCH inside MULTI is not allowed"))
+        return
+    keyspace = redis_utils.keyspace
+    for key in message_arr[1:]:
+        if key not in client.watched:
+            client.watched[key] = keyspace.watch(key)
+    client.write(OK)
+
+
+def unwatch_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the UNWATCH command, forgets every key WATCHed by the client
+
+    Args:
+        message_arr (List[str]): The parsed message array
+        n_args (int): The number of arguments in the message array
+        client (ConnContext): The client connection to write responses to
+    """
+    unwatch_all_keys(client)
+    client.write(OK)
+
+
+def watched_keys_changed(client: ConnContext) -> bool:
+    """
+    Checks whether one of the keys WATCHed by a client changed since WATCH, including keys that expired
+
+    Args:
+        client (ConnContext): The client connection
+
+    Returns:
+        bool: True if the transaction of the client must abort
+    """
+    keyspace = redis_utils.keyspace
+    for key, version in client.watched.items():
+        keyspace.lookup(key)
+        if keyspace.version(key) != version:
+            return True
+    return False
+
+
+def unwatch_all_keys(client: ConnContext):
+    """
+    Forgets every key WATCHed by a client, after EXEC and DISCARD and when the connection closes
+
+    Args:
+        client (ConnContext): The client connection
+    """
+    if not client.watched:
+        return
+    keyspace = redis_utils.keyspace
+    with keyspace.locks.hold(list(client.watched)):
+        for key in client.watched:
+            keyspace.unwatch(key)
+    client.watched.clear()
+
+
+def write_command_info(out: bytearray, command: RedisCommand) -> bytearray:
+    """
+    Appends the COMMAND INFO reply of one command, in the Redis 7 layout: name, arity, flags, first key,
+    last key, step, ACL categories, tips, key specs and subcommands
+
+    Args:
+        out (bytearray): The buffer the reply is written to
+        command (RedisCommand): The command table entry
+
+    Returns:
+        bytearray: The same buffer, for chaining
+    """
+    write_array_header(out, 10)
+    write_bulk_string(out, command.name)
+    write_integer(out, command.arity)
+    write_array_header(out, len(command.flags))
+    for flag in sorted(command.flags):
+        write_simple_string(out, flag)
+    write_integer(out, command.first_key)
+    write_integer(out, command.last_key)
+    write_integer(out, command.step)
+    categories = sorted(ACL_CATEGORIES[flag] for flag in command.flags if flag in ACL_CATEGORIES)
+    write_array_header(out, len(categories))
+    for category in categories:
+        write_simple_string(out, category)
+    out += EMPTY_ARRAY
+    out += EMPTY_ARRAY
+    out += EMPTY_ARRAY
+    return out
+
+
+def command_command_helper(message_arr: List[str], n_args: int, client: ConnContext):
+    """
+    Handles the COMMAND command and its COUNT, INFO and DOCS subcommands, generated from the command table
+
+    Example:
+        command_command_helper(["COMMAND", "INFO", "get"], 3, client)
+
+    Args:
+        message_arr (List[str]): The parsed message array
+        n_args (int): The number of arguments in the message array
+        client (ConnContext): The client connection to write responses to
+    """
+    out = bytearray()
+    subcommand = message_arr[1].lower() if n_args > 1 else ""
+    if subcommand == "":
+        write_array_header(out, len(COMMAND_TABLE))
+        for command in COMMAND_TABLE.values():
+            write_command_info(out, command)
+    elif subcommand == "count":
+        write_integer(out, len(COMMAND_TABLE))
+    elif subcommand == "info":
+        write_array_header(out, n_args - 2)
+        for name in message_arr[2:]:
+            command = COMMAND_TABLE.get(name.lower())
+            if command is None:
+                out += NULL_BULK
+            else:
+                write_command_info(out, command)
+    elif subcommand == "docs":
+        out += EMPTY_ARRAY
+    else:
+        write_error(out, f"ERR unknown subcommand '{message_arr[1]}'. Try COMMAND HELP.")
+    client.write(out)
+
+
+def choose_argument_and_send_output(message_arr: List[str], n_args: int, client: ConnContext):
     """
     Handles various Redis commands and sends appropriate responses to the client.
 
-    This function processes a list of command arguments and determines the appropriate
-    action based on the command type (e.g., PING, ECHO, SET, GET). It utilizes helper
-    functions to handle specific commands and sends the corresponding response back
-    to the client.
+    The command is looked up once in the command table, its arity is checked and then its helper runs
+    holding the keyspace lock stripes of the keys it accesses. While the RDB file is loading only commands flagged "loading"
+    run, the others get a LOADING error. While the client is inside MULTI every command except EXEC, DISCARD,
+    MULTI and WATCH is queued instead, and a command rejected while queuing makes EXEC abort.
+    With --workers, commands whose keys belong to another worker are forwarded to it (see forward_command), and
+    KEYS and INFO, which report on the whole keyspace, run on every worker and their replies are merged (see
+    FAN_OUT_MERGES), they cannot be queued in a transaction.
+    In cluster mode, commands on keys of a slot this node does not serve are redirected (see cluster.redirect),
+    the client keeps the ASKING flag until the end of its transaction.
 
     Args:
         message_arr (List[str]): The parsed message array containing command arguments.
         n_args (int): The number of arguments in the message array.
-        client_socket (socket): The socket representing the connection to the client.
-        addr (str): The address of the client for IP sockets.
-        is_multi_command (bool, optional): Whether the command is part of a MULTI/EXEC block. Defaults to False.
+        client (ConnContext): The client connection to write responses to.
 
     Returns:
         None
     """
-    if message_arr[0].lower() == "ping":
-        client_socket.send("+PONG\r\n".encode())
-    elif message_arr[0].lower() == "echo":
-        resp_msg = redis_utils.convert_to_resp(message_arr[1])
-        client_socket.send(resp_msg.encode())
-    elif message_arr[0].lower() == "set":
-        redis_commands.set_command_helper(message_arr, n_args, client_socket, addr, is_multi_command=is_multi_command)
-    elif message_arr[0].lower() == "get":
-        if redis_utils.dir or redis_utils.dbfilename:
-            redis_commands.rdb_get_command_helper(message_arr, n_args, client_socket)
-        else:
-            redis_commands.get_command_helper(message_arr, n_args, client_socket, addr,
-                                              is_multi_command=is_multi_command)
-    elif message_arr[0].lower() == "config":
-        redis_commands.config_get_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "keys":
-        redis_commands.keys_get_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "info":
-        redis_commands.info_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "replconf":
-        if message_arr[1].lower() == "listening-port" or message_arr[1].lower() == "capa":
-            client_socket.send("+OK\r\n".encode())
-        elif message_arr[1].lower() == "ack":
-            redis_utils.num_replicas_ack += 1
-    elif message_arr[0].lower() == "psync":
-        if message_arr[1] == "?" and message_arr[2] == "-1":
-            client_socket.send(
-                "+FULLRESYNC 8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb 0\r\n".encode()
-            )
-            rdb_hex = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
-            rdb_content = bytes.fromhex(rdb_hex)
-            rdb_length = f"${len(rdb_content)}\r\n".encode()
-            client_socket.send(rdb_length + rdb_content)
-            redis_utils.replica_sockets.update({addr: client_socket})
-    elif message_arr[0].lower() == "wait":
-        redis_commands.wait_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "type":
-        redis_commands.type_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "xadd":
-        redis_commands.xadd_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "xrange":
-        redis_commands.xrange_command_helper(message_arr, n_args, client_socket)
-    elif message_arr[0].lower() == "xread":
-        prev_copy_redis_streams_dict = copy.deepcopy(redis_utils.redis_streams_dict)
-        redis_commands.handle_blocking_in_xread(message_arr)
-        new_copy_redis_streams_dict = copy.deepcopy(redis_utils.redis_streams_dict)
-        redis_commands.handle_dollar_in_xread(client_socket, n_args, message_arr, prev_copy_redis_streams_dict,
-                                              new_copy_redis_streams_dict)
-        redis_commands.xread_command_helper(message_arr, n_args, client_socket, new_copy_redis_streams_dict)
-    elif message_arr[0].lower() == "incr":
-        redis_commands.incr_command_helper(message_arr, n_args, client_socket, addr, is_multi_command=is_multi_command)
-    elif message_arr[0].lower() == "multi":
-        multi_command_helper(message_arr, n_args, client_socket, addr)
-    elif message_arr[0].lower() == "exec":
-        client_socket.send("-ERR EXEC without MULTI\r\n".encode())
-    elif message_arr[0].lower() == "discard":
-        client_socket.send("-ERR DISCARD without MULTI\r\n".encode())
+    command = COMMAND_TABLE.get(message_arr[0].lower())
+    if command is None:
+        args = " ".join(f"'{arg}'" for arg in message_arr[1:])
+        client.write(write_error(bytearray(),
+                                 f"ERR unknown command '{message_arr[0]}', with args beginning with: {args}"))
+        if client.multi is not None:
+            client.multi_error = True
+        return
+    if not command.check_arity(n_args):
+        client.write(write_error(bytearray(), f"ERR wrong number of arguments for '{command.name}' command"))
+        if client.multi is not None:
+            client.multi_error = True
+        return
+    if redis_utils.loading and "loading" not in command.flags:
+        client.write(write_error(bytearray(), "LOADING Redis is loading the dataset in memory"))
+        if client.multi is not None:
+            client.multi_error = True
+        return
+    keys = command_keys(command, message_arr, client)
+    if cluster.enabled and not client.from_master:
+        asking = client.asking
+        if client.multi is None and command.name != "multi":
+            client.asking = False
+        if keys and not (command.name == "exec" and client.multi_error):
+            error = cluster.redirect(keys, asking)
+            if error is not None:
+                if command.name == "exec":
+                    client.multi = None
+                    unwatch_all_keys(client)
+                elif client.multi is not None and command.name not in ("discard", "multi"):
+                    client.multi_error = True
+                client.write(write_error(bytearray(), error))
+                return
+    fan_out = redis_utils.workers > 1 and command.name in FAN_OUT_MERGES and not client.from_worker
+    if client.multi is not None and command.name not in ("exec", "discard", "multi", "watch"):
+        if fan_out:
+            client.multi_error = True
+            client.write(write_error(bytearray(),
+                                     f"ERR {command.name.upper()} inside MULTI is not supported with --workers"))
+            return
+        client.multi.append((command, message_arr))
+        client.write(QUEUED)
+        return
+    if fan_out:
+        fan_out_command(command, message_arr, client)
+        return
+    if redis_utils.workers > 1 and keys and forward_command(command, message_arr, keys, client):
+        return
+    if client.forward_queue:
+        client.flush_forwarded()
+    locks = redis_utils.keyspace.locks
+    stripes = locks.stripes_for(keys)
+    locks.acquire(stripes)
+    client.held_stripes = stripes
+    try:
+        command.handler(message_arr, n_args, client)
+    finally:
+        client.held_stripes = None
+        locks.release(stripes)
+
+
+def forward_command(command: RedisCommand, message_arr: List[str], keys: List[str], client: ConnContext) -> bool:
+    """
+    Forwards a command to the worker owning its keys, queued on the client so the commands of a pipeline go
+    together (see ConnContext.forward), and so is a transaction, as a whole: MULTI, the queued commands and EXEC
+    in one go, of which only the reply of EXEC is relayed. Commands that may block are forwarded right away, on
+    the thread the IO model runs them on. Commands whose keys belong to several workers, and WATCH of keys of
+    another worker, are rejected.
+
+    Args:
+        command (RedisCommand): The command table entry
+        message_arr (List[str]): The parsed message array
+        keys (List[str]): The keys of the command, see command_keys
+        client (ConnContext): The client connection to write responses to
+
+    Returns:
+        bool: True if the command was handled, False if it runs on this worker
+    """
+    try:
+        owner = workers.owner_of_keys(keys)
+    except workers.CrossWorkerError:
+        if command.name == "exec":
+            client.multi = None
+            unwatch_all_keys(client)
+        client.write(write_error(bytearray(), "CROSSSLOT Keys in request don't hash to the same worker"))
+        return True
+    if owner == workers.index or (command.name == "exec" and client.multi_error):
+        return False
+    if command.name == "watch":
+        client.write(write_error(bytearray(), "ERR WATCH of keys owned by another worker is not supported"))
+        return True
+    if "blocking" in command.flags:
+        client.flush_forwarded()
+        client.write(workers.forward([(owner, message_arr)])[0])
+    elif command.name == "exec":
+        commands = [["MULTI"], *(queued_message_arr for _, queued_message_arr in client.multi), ["EXEC"]]
+        client.multi = None
+        client.forward([(owner, command) for command in commands], last_reply)
+    else:
+        client.forward([(owner, message_arr)])
+    return True
+
+
+def fan_out_command(command: RedisCommand, message_arr: List[str], client: ConnContext):
+    """
+    Runs a command that reports on the whole keyspace on every worker and merges their replies into one, see
+    FAN_OUT_MERGES. The part of this worker runs right away on a connection context of its own, so like the
+    other workers, which get the command behind the ones the client forwarded before, it sees every command
+    the client sent before it.
+
+    Args:
+        command (RedisCommand): The command table entry
+        message_arr (List[str]): The parsed message array
+        client (ConnContext): The client connection to write responses to
+    """
+    local = ConnContext(client.id, client.conn, client.addr, from_worker=True)
+    choose_argument_and_send_output(message_arr, len(message_arr), local)
+    local_reply = bytes(local.out_buf)
+    merge = FAN_OUT_MERGES[command.name]
+    client.forward([(worker, message_arr) for worker in range(redis_utils.workers) if worker != workers.index],
+                   lambda replies: merge(replies[:workers.index] + [local_reply] + replies[workers.index:]))
+
+
+def last_reply(replies: List[bytes]) -> bytes:
+    """
+    Returns the last of the replies of forwarded commands, the reply of EXEC for a forwarded transaction
+    """
+    return replies[-1]
+
+
+FAN_OUT_MERGES: Dict[str, Callable[[List[bytes]], bytes]] = {
+    "keys": workers.merge_arrays,
+    "info": workers.merge_info,
+}
+
+
+def _command(name: str, handler: Callable, arity: int, flags: str, first_key: int = 0, last_key: int = 0,
+             step: int = 0) -> RedisCommand:
+    return RedisCommand(name, handler, arity, frozenset(flags.split()), first_key, last_key, step)
+
+
+COMMAND_TABLE: Dict[str, RedisCommand] = {command.name: command for command in (
+    _command("ping", redis_commands.ping_command_helper, -1, "fast"),
+    _command("echo", redis_commands.echo_command_helper, 2, "fast"),
+    _command("command", command_command_helper, -1, "loading stale"),
+    _command("set", redis_commands.set_command_helper, -3, "write denyoom", 1, 1, 1),
+    _command("get", redis_commands.get_command_helper, 2, "readonly fast", 1, 1, 1),
+    _command("incr", redis_commands.incr_command_helper, 2, "write denyoom fast", 1, 1, 1),
+    _command("type", redis_commands.type_command_helper, 2, "readonly fast", 1, 1, 1),
+    _command("expire", redis_commands.expire_command_helper, -3, "write fast", 1, 1, 1),
+    _command("pexpire", redis_commands.pexpire_command_helper, -3, "write fast", 1, 1, 1),
+    _command("expireat", redis_commands.expireat_command_helper, -3, "write fast", 1, 1, 1),
+    _command("pexpireat", redis_commands.pexpireat_command_helper, -3, "write fast", 1, 1, 1),
+    _command("del", redis_commands.del_command_helper, -2, "write", 1, -1, 1),
+    _command("ttl", redis_commands.ttl_command_helper, 2, "readonly fast", 1, 1, 1),
+    _command("pttl", redis_commands.pttl_command_helper, 2, "readonly fast", 1, 1, 1),
+    _command("persist", redis_commands.persist_command_helper, 2, "write fast", 1, 1, 1),
+    _command("keys", redis_commands.keys_get_command_helper, 2, "readonly"),
+    _command("memory", redis_commands.memory_command_helper, -2, "readonly", 2, 2, 1),
+    _command("config", redis_commands.config_get_command_helper, -3, "admin noscript loading stale"),
+    _command("info", redis_commands.info_command_helper, -1, "loading stale"),
+    _command("xadd", redis_commands.xadd_command_helper, -5, "write denyoom fast", 1, 1, 1),
+    _command("xrange", redis_commands.xrange_command_helper, -4, "readonly", 1, 1, 1),
+    _command("xtrim", redis_commands.xtrim_command_helper, -4, "write", 1, 1, 1),
+    _command("xlen", redis_commands.xlen_command_helper, 2, "readonly fast", 1, 1, 1),
+    _command("xread", redis_commands.xread_command_helper, -4, "readonly blocking movablekeys"),
+    _command("xgroup", redis_commands.xgroup_command_helper, -2, "write", 2, 2, 1),
+    _command("xreadgroup", redis_commands.xreadgroup_command_helper, -7, "write blocking movablekeys"),
+    _command("xack", redis_commands.xack_command_helper, -4, "write fast", 1, 1, 1),
+    _command("xpending", redis_commands.xpending_command_helper, -3, "readonly", 1, 1, 1),
+    _command("xclaim", redis_commands.xclaim_command_helper, -6, "write fast", 1, 1, 1),
+    _command("xautoclaim", redis_commands.xautoclaim_command_helper, -6, "write fast", 1, 1, 1),
+    _command("replconf", redis_commands.replconf_command_helper, -2, "admin noscript loading stale"),
+    _command("psync", redis_commands.psync_command_helper, -3, "admin noscript"),
+    _command("wait", redis_commands.wait_command_helper, 3, "noscript blocking"),
+    _command("multi", multi_command_helper, 1, "noscript loading stale fast"),
+    _command("exec", exec_command_helper, 1, "noscript loading stale"),
+    _command("discard", discard_command_helper, 1, "noscript loading stale fast"),
+    _command("watch", watch_command_helper, -2, "noscript loading stale fast", 1, -1, 1),
+    _command("unwatch", unwatch_command_helper, 1, "noscript loading stale fast"),
+    _command("cluster", redis_commands.cluster_command_helper, -2, "admin loading stale"),
+    _command("asking", redis_commands.asking_command_helper, 1, "fast"),
+)}
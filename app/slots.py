@@ -0,0 +1,59 @@
+from typing import List
+
+HASH_SLOTS = 16384
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes) -> int:
+    """
+    Computes the CRC16 of Redis Cluster (XMODEM: polynomial 0x1021, initial value 0)
+
+    Example:
+        crc16(b"123456789") -> 12739
+
+    Args:
+        data (bytes): The bytes to checksum
+
+    Returns:
+        int: The 16 bit checksum
+    """
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def key_hash_slot(key: str) -> int:
+    """
+    Returns the hash slot of a key like Redis Cluster: the CRC16 of the key modulo 16384, or of its hash tag,
+    the part between the first { and the next }, when that part is not empty, so related keys can share a slot
+
+    Example:
+        key_hash_slot("foo") -> 12182
+        key_hash_slot("{user1000}.following") == key_hash_slot("{user1000}.followers")
+
+    Args:
+        key (str): The key
+
+    Returns:
+        int: The slot, from 0 to 16383
+    """
+    data = key.encode("utf-8", "surrogateescape")
+    start = data.find(b"{")
+    if start != -1:
+        end = data.find(b"}", start + 1)
+        if end > start + 1:
+            data = data[start + 1:end]
+    return crc16(data) & (HASH_SLOTS - 1)
@@ -0,0 +1,564 @@
+import sys
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterator, List, Tuple
+
+from .keyspace import MEMORY_USAGE_SAMPLES, RedisObject, element_size
+
+STREAM_NODE_MAX_ENTRIES = 100
+STREAM_ID_SEQ_BITS = 64
+STREAM_ID_PART_MAX = (1 << 64) - 1
+STREAM_ID_MIN = 0
+STREAM_ID_MAX = (1 << 128) - 1
+STREAM_NODES_COMPACT_MIN = 64
+STREAM_PEL_COMPACT_MIN = 64
+
+
+def pack_stream_id(ms: int, seq: int) -> int:
+    """
+    Packs the two parts of a stream ID into one integer, so IDs compare and bisect as plain ints
+
+    Example:
+        pack_stream_id(1, 2) -> 18446744073709551618
+
+    Args:
+        ms (int): The milliseconds part
+        seq (int): The sequence number part
+
+    Returns:
+        int: The packed ID
+    """
+    return (ms << STREAM_ID_SEQ_BITS) | seq
+
+
+def unpack_stream_id(stream_id: int) -> Tuple[int, int]:
+    """
+    Returns the milliseconds and sequence number parts of a packed stream ID
+    """
+    return stream_id >> STREAM_ID_SEQ_BITS, stream_id & STREAM_ID_PART_MAX
+
+
+def format_stream_id(stream_id: int) -> str:
+    """
+    Formats a packed stream ID the way clients see it
+
+    Example:
+        format_stream_id(pack_stream_id(1526919030474, 3)) -> '1526919030474-3'
+    """
+    return f"{stream_id >> STREAM_ID_SEQ_BITS}-{stream_id & STREAM_ID_PART_MAX}"
+
+
+def parse_stream_id(value: str, missing_seq: int = 0) -> int:
+    """
+    Parses a stream ID given by a client, "-" and "+" being the smallest and the greatest possible IDs
+
+    Example:
+        parse_stream_id("5-1") == pack_stream_id(5, 1)
+        parse_stream_id("5", STREAM_ID_PART_MAX) == pack_stream_id(5, STREAM_ID_PART_MAX)
+
+    Args:
+        value (str): The ID, "<ms>-<seq>" or "<ms>"
+        missing_seq (int, optional): The sequence number used when only the milliseconds are given. Defaults to 0.
+
+    Raises:
+        ValueError: If the ID is not valid
+
+    Returns:
+        int: The packed ID
+    """
+    if value == "-":
+        return STREAM_ID_MIN
+    if value == "+":
+        return STREAM_ID_MAX
+    ms, sep, seq = value.partition("-")
+    if not ms.isdigit() or (sep and not seq.isdigit()):
+        raise ValueError("ERR Invalid stream ID specified as stream command argument")
+    ms = int(ms)
+    seq = int(seq) if sep else missing_seq
+    if ms > STREAM_ID_PART_MAX or seq > STREAM_ID_PART_MAX:
+        raise ValueError("ERR Invalid stream ID specified as stream command argument")
+    return pack_stream_id(ms, seq)
+
+
+class StreamNode:
+    """
+    A block of consecutive stream entries, the Python counterpart of the listpack hanging
+    from every node of the radix tree of a Redis stream
+
+    Entries keep their values only, `fields` holds for every entry a reference to the tuple of its field names.
+    Consecutive entries with the same field names share one interned tuple, like the master entry of a Redis
+    listpack, so a stream written with a fixed schema pays for its field names once per block instead of once
+    per entry.
+
+    Args:
+        ids (List[int]): The packed IDs of the entries, sorted
+        fields (List[tuple]): The field names tuple of every entry
+        values (List[tuple]): The values tuple of every entry
+    """
+    __slots__ = ("ids", "fields", "values")
+
+    def __init__(self):
+        self.ids: List[int] = []
+        self.fields: List[tuple] = []
+        self.values: List[tuple] = []
+
+    def append(self, stream_id: int, fields: tuple, values: tuple):
+        if not self.fields or fields != self.fields[-1]:
+            if self.fields and fields == self.fields[0]:
+                fields = self.fields[0]
+            else:
+                fields = tuple(sys.intern(field) for field in fields)
+        else:
+            fields = self.fields[-1]
+        self.ids.append(stream_id)
+        self.fields.append(fields)
+        self.values.append(values)
+
+    def entries(self, start: int, stop: int) -> Iterator[Tuple[int, tuple, tuple]]:
+        return zip(self.ids[start:stop], self.fields[start:stop], self.values[start:stop])
+
+    def remove_head(self, count: int):
+        del self.ids[:count]
+        del self.fields[:count]
+        del self.values[:count]
+
+
+class RedisStream(RedisObject):
+    """
+    Value object of a stream key
+
+    Entries are appended to blocks of at most STREAM_NODE_MAX_ENTRIES entries, `first_ids` holds the first ID
+    of every block. A seek bisects `first_ids` to find the block and then the IDs of the block, so XRANGE and
+    XREAD find their starting point in O(log n) and then only walk the entries they return, and IDs are
+    compared as packed integers instead of being split and parsed for every entry.
+
+    Trimming drops blocks from the head by moving `head` forward, the dropped slots are compacted away once
+    they make up half of the block list, so trimming on every append stays O(1) amortized. The last ID is
+    kept even when the entry holding it is trimmed, new IDs must always be greater.
+
+    `groups` holds the consumer groups of the stream by name, trimming leaves their pending entries alone
+    like Redis does, XCLAIM and XAUTOCLAIM clean up the ones whose entry is gone.
+    """
+    __slots__ = ("nodes", "first_ids", "head", "length", "last_id", "groups")
+    type_name = "stream"
+
+    def __init__(self):
+        self.nodes: List[StreamNode] = []
+        self.first_ids: List[int] = []
+        self.head = 0
+        self.length = 0
+        self.last_id = STREAM_ID_MIN
+        self.groups: Dict[str, "ConsumerGroup"] = {}
+
+    def container(self):
+        return self.nodes
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def first_id(self) -> int:
+        """
+        Returns the ID of the first entry, 0-0 for an empty stream
+        """
+        return self.first_ids[self.head] if self.length else STREAM_ID_MIN
+
+    def next_id(self, requested: str, now_ms: int) -> int:
+        """
+        Returns the ID of the entry XADD is about to append, validated against the last ID of this stream
+
+        Example:
+            stream.next_id("*", 1526919030474)
+            stream.next_id("1526919030474-*", 1526919030474)
+
+        Args:
+            requested (str): "*", "<ms>-*", "<ms>-<seq>" or "<ms>", meaning "<ms>-0"
+            now_ms (int): The current unix time in milliseconds, used for "*"
+
+        Raises:
+            ValueError: If the ID is invalid or not greater than the last ID, with the error to reply
+
+        Returns:
+            int: The packed ID
+        """
+        last_ms, last_seq = unpack_stream_id(self.last_id)
+        if requested == "*":
+            if now_ms > last_ms:
+                return pack_stream_id(now_ms, 0)
+            if last_seq == STREAM_ID_PART_MAX:
+                return pack_stream_id(last_ms + 1, 0)
+            return pack_stream_id(last_ms, last_seq + 1)
+        ms, sep, seq = requested.partition("-")
+        if sep and seq == "*":
+            stream_id = parse_stream_id(ms)
+            if stream_id >> STREAM_ID_SEQ_BITS == last_ms and self.last_id:
+                if last_seq == STREAM_ID_PART_MAX:
+                    raise ValueError("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+                stream_id = self.last_id + 1
+            elif stream_id == STREAM_ID_MIN:
+                stream_id = pack_stream_id(0, 1)
+        else:
+            stream_id = parse_stream_id(requested)
+        if stream_id == STREAM_ID_MIN:
+            raise ValueError("ERR The ID specified in XADD must be greater than 0-0")
+        if stream_id <= self.last_id:
+            raise ValueError("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+        return stream_id
+
+    def append(self, stream_id: int, fields: tuple, values: tuple):
+        """
+        Appends an entry, its ID must be greater than the ID of the last entry
+
+        Args:
+            stream_id (int): The packed ID of the entry
+            fields (tuple): The field names of the entry
+            values (tuple): The values of the entry, in the order of its field names
+        """
+        if not self.nodes or len(self.nodes[-1].ids) >= STREAM_NODE_MAX_ENTRIES:
+            self.nodes.append(StreamNode())
+            self.first_ids.append(stream_id)
+        self.nodes[-1].append(stream_id, fields, values)
+        self.length += 1
+        self.last_id = stream_id
+
+    def range(self, start: int, end: int, count: int | None = None) -> List[Tuple[int, tuple, tuple]]:
+        """
+        Returns the entries whose ID is between start and end, both included
+
+        Args:
+            start (int): The smallest packed ID to return
+            end (int): The greatest packed ID to return
+            count (int | None, optional): The maximum number of entries to return. Defaults to None.
+
+        Returns:
+            List[Tuple[int, tuple, tuple]]: The (packed ID, field names, values) entries in ID order
+        """
+        result = []
+        if start > end or count == 0 or not self.length:
+            return result
+        node_index = max(bisect_right(self.first_ids, start, self.head) - 1, self.head)
+        pos = bisect_left(self.nodes[node_index].ids, start)
+        while node_index < len(self.nodes):
+            node = self.nodes[node_index]
+            ids = node.ids
+            stop = bisect_right(ids, end, pos)
+            if count is not None:
+                stop = min(stop, pos + count - len(result))
+            result.extend(node.entries(pos, stop))
+            if stop < len(ids) or (count is not None and len(result) >= count):
+                break
+            node_index += 1
+            pos = 0
+        return result
+
+    def get(self, stream_id: int) -> Tuple[tuple, tuple] | None:
+        """
+        Returns the field names and the values of the entry with the given ID, None if there is none
+        """
+        entries = self.range(stream_id, stream_id, 1)
+        return entries[0][1:] if entries else None
+
+    def range_after(self, stream_id: int, count: int | None = None) -> List[Tuple[int, tuple, tuple]]:
+        """
+        Returns the entries whose ID is greater than the given one, the XREAD semantics
+
+        Args:
+            stream_id (int): The packed ID to read after
+            count (int | None, optional): The maximum number of entries to return. Defaults to None.
+
+        Returns:
+            List[Tuple[int, tuple, tuple]]: The (packed ID, field names, values) entries in ID order
+        """
+        if stream_id >= self.last_id:
+            return []
+        return self.range(stream_id + 1, STREAM_ID_MAX, count)
+
+    def trim_maxlen(self, maxlen: int, approx: bool = False, limit: int | None = None) -> int:
+        """
+        Trims the oldest entries until at most maxlen are left
+
+        With approx ("~") only whole blocks are dropped, so the stream may keep up to a block more than maxlen
+        but no entry is ever moved, which is what keeps the per-append trimming cost O(1).
+
+        Args:
+            maxlen (int): The number of entries to keep
+            approx (bool, optional): Whether to trim whole blocks only. Defaults to False.
+            limit (int | None, optional): The maximum number of entries to remove, only with approx.
+
+        Returns:
+            int: The number of entries removed
+        """
+        removed = 0
+        while self.length > maxlen:
+            node = self.nodes[self.head]
+            excess = self.length - maxlen
+            if len(node.ids) <= excess:
+                if limit is not None and removed + len(node.ids) > limit:
+                    break
+                removed += self._drop_head_node()
+            elif approx:
+                break
+            else:
+                removed += self._trim_head_node(excess)
+        return removed
+
+    def trim_minid(self, minid: int, approx: bool = False, limit: int | None = None) -> int:
+        """
+        Trims the entries whose ID is lower than minid, whole blocks only with approx
+
+        Args:
+            minid (int): The smallest packed ID to keep
+            approx (bool, optional): Whether to trim whole blocks only. Defaults to False.
+            limit (int | None, optional): The maximum number of entries to remove, only with approx.
+
+        Returns:
+            int: The number of entries removed
+        """
+        removed = 0
+        while self.length and self.first_ids[self.head] < minid:
+            node = self.nodes[self.head]
+            if node.ids[-1] < minid:
+                if limit is not None and removed + len(node.ids) > limit:
+                    break
+                removed += self._drop_head_node()
+            elif approx:
+                break
+            else:
+                removed += self._trim_head_node(bisect_left(node.ids, minid))
+        return removed
+
+    def _drop_head_node(self) -> int:
+        node = self.nodes[self.head]
+        self.nodes[self.head] = None
+        self.head += 1
+        self.length -= len(node.ids)
+        if self.head == len(self.nodes):
+            self.nodes.clear()
+            self.first_ids.clear()
+            self.head = 0
+        elif self.head >= STREAM_NODES_COMPACT_MIN and self.head * 2 >= len(self.nodes):
+            del self.nodes[:self.head]
+            del self.first_ids[:self.head]
+            self.head = 0
+        return len(node.ids)
+
+    def _trim_head_node(self, count: int) -> int:
+        node = self.nodes[self.head]
+        node.remove_head(count)
+        self.first_ids[self.head] = node.ids[0]
+        self.length -= count
+        return count
+
+    def memory_usage(self, samples: int = MEMORY_USAGE_SAMPLES) -> int:
+        """
+        Estimates the bytes used by the stream: its blocks, the field names shared by each block and a sample of
+        its entries, like MEMORY USAGE does. A field names tuple is only counted for the entries that do not
+        share the one of the first entry of their block.
+
+        Args:
+            samples (int, optional): The number of entries to sample, 0 for all of them. Defaults to 5.
+
+        Returns:
+            int: The estimated size in bytes
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.nodes) + sys.getsizeof(self.first_ids)
+        for node in self.nodes[self.head:]:
+            size += (sys.getsizeof(node) + sys.getsizeof(node.ids) + sys.getsizeof(node.fields)
+                     + sys.getsizeof(node.values) + element_size(node.fields[0]))
+        if not self.length:
+            return size
+        sampled = self.range(STREAM_ID_MIN, STREAM_ID_MAX, samples or None)
+        sampled_size = 0
+        for stream_id, fields, values in sampled:
+            sampled_size += sys.getsizeof(stream_id) + element_size(values)
+            node = self.nodes[max(bisect_right(self.first_ids, stream_id, self.head) - 1, self.head)]
+            if fields is not node.fields[0]:
+                sampled_size += element_size(fields)
+        return size + sampled_size * self.length // len(sampled)
+
+
+class StreamNACK:
+    """
+    A pending entry of a consumer group: delivered to a consumer and not acknowledged yet
+
+    Args:
+        consumer (StreamConsumer): The consumer that owns the entry
+        delivery_time (int): The unix time in milliseconds of the last delivery
+        delivery_count (int): The number of times the entry was delivered
+    """
+    __slots__ = ("consumer", "delivery_time", "delivery_count")
+
+    def __init__(self, consumer: "StreamConsumer", delivery_time: int, delivery_count: int = 1):
+        self.consumer = consumer
+        self.delivery_time = delivery_time
+        self.delivery_count = delivery_count
+
+
+class PendingIndex:
+    """
+    Pending entries by ID, the counterpart of the radix trees Redis keeps for the PEL of a group and of each
+    consumer
+
+    `entries` gives O(1) lookups and removals, `ids` keeps the IDs sorted for range scans. Deliveries of new
+    entries append to `ids` since their IDs only grow, and removals only drop the dict entry and leave a dead ID
+    that scans skip, `ids` is compacted once half of it is dead. XREADGROUP and XACK are O(1) amortized and a
+    range scan bisects to its start and then walks what it returns.
+    """
+    __slots__ = ("entries", "ids", "dead")
+
+    def __init__(self):
+        self.entries: Dict[int, StreamNACK] = {}
+        self.ids: List[int] = []
+        self.dead = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, stream_id: int) -> bool:
+        return stream_id in self.entries
+
+    def get(self, stream_id: int) -> StreamNACK | None:
+        return self.entries.get(stream_id)
+
+    def add(self, stream_id: int, nack: StreamNACK):
+        if stream_id in self.entries:
+            self.entries[stream_id] = nack
+            return
+        if not self.ids or stream_id > self.ids[-1]:
+            self.ids.append(stream_id)
+        else:
+            pos = bisect_left(self.ids, stream_id)
+            if pos < len(self.ids) and self.ids[pos] == stream_id:
+                self.dead -= 1
+            else:
+                self.ids.insert(pos, stream_id)
+        self.entries[stream_id] = nack
+
+    def remove(self, stream_id: int) -> StreamNACK | None:
+        nack = self.entries.pop(stream_id, None)
+        if nack is not None:
+            self.dead += 1
+            if self.dead >= STREAM_PEL_COMPACT_MIN and self.dead * 2 >= len(self.ids):
+                self.ids = [pending_id for pending_id in self.ids if pending_id in self.entries]
+                self.dead = 0
+        return nack
+
+    def range(self, start: int, end: int, count: int | None = None) -> Iterator[Tuple[int, StreamNACK]]:
+        """
+        Yields the pending entries whose ID is between start and end, both included, in ID order
+
+        Args:
+            start (int): The smallest packed ID
+            end (int): The greatest packed ID
+            count (int | None, optional): The maximum number of entries. Defaults to None.
+        """
+        if count == 0:
+            return
+        for pos in range(bisect_left(self.ids, start), len(self.ids)):
+            stream_id = self.ids[pos]
+            if stream_id > end:
+                return
+            nack = self.entries.get(stream_id)
+            if nack is not None:
+                yield stream_id, nack
+                if count is not None:
+                    count -= 1
+                    if not count:
+                        return
+
+    def first_id(self) -> int | None:
+        return next((stream_id for stream_id in self.ids if stream_id in self.entries), None)
+
+    def last_id(self) -> int | None:
+        return next((stream_id for stream_id in reversed(self.ids) if stream_id in self.entries), None)
+
+
+class StreamConsumer:
+    """
+    A consumer of a group, created by the first XREADGROUP or XCLAIM naming it
+
+    Args:
+        name (str): The name of the consumer
+        seen_time (int): The unix time in milliseconds it was last seen
+    """
+    __slots__ = ("name", "seen_time", "pending")
+
+    def __init__(self, name: str, seen_time: int):
+        self.name = name
+        self.seen_time = seen_time
+        self.pending = PendingIndex()
+
+
+class ConsumerGroup:
+    """
+    A consumer group of a stream: the last ID delivered to its consumers and the entries they did not
+    acknowledge yet, indexed by ID for the whole group and for each consumer
+
+    Args:
+        last_id (int): The packed ID of the last entry delivered to the group
+    """
+    __slots__ = ("last_id", "pending", "consumers")
+
+    def __init__(self, last_id: int):
+        self.last_id = last_id
+        self.pending = PendingIndex()
+        self.consumers: Dict[str, StreamConsumer] = {}
+
+    def consumer(self, name: str, now_ms: int, create: bool = True) -> StreamConsumer | None:
+        """
+        Returns a consumer of the group, creating it when create is set, and marks it as seen
+        """
+        consumer = self.consumers.get(name)
+        if consumer is None:
+            if not create:
+                return None
+            consumer = self.consumers[name] = StreamConsumer(name, now_ms)
+        consumer.seen_time = now_ms
+        return consumer
+
+    def deliver(self, stream_id: int, consumer: StreamConsumer, now_ms: int):
+        """
+        Records the delivery of an entry to a consumer: a new pending entry, or an existing one that now
+        belongs to that consumer with one more delivery
+        """
+        nack = self.pending.get(stream_id)
+        if nack is None:
+            nack = StreamNACK(consumer, now_ms)
+            self.pending.add(stream_id, nack)
+        else:
+            nack.delivery_time = now_ms
+            nack.delivery_count += 1
+            if nack.consumer is not consumer:
+                nack.consumer.pending.remove(stream_id)
+                nack.consumer = consumer
+        consumer.pending.add(stream_id, nack)
+
+    def claim(self, stream_id: int, consumer: StreamConsumer):
+        """
+        Moves a pending entry to another consumer
+        """
+        nack = self.pending.get(stream_id)
+        if nack.consumer is not consumer:
+            nack.consumer.pending.remove(stream_id)
+            nack.consumer = consumer
+            consumer.pending.add(stream_id, nack)
+
+    def ack(self, stream_id: int) -> bool:
+        """
+        Acknowledges a pending entry, returns False if it was not pending
+        """
+        nack = self.pending.remove(stream_id)
+        if nack is None:
+            return False
+        nack.consumer.pending.remove(stream_id)
+        return True
+
+    def delete_consumer(self, name: str) -> int:
+        """
+        Deletes a consumer and its pending entries, returns how many it had
+        """
+        consumer = self.consumers.pop(name, None)
+        if consumer is None:
+            return 0
+        for stream_id in consumer.pending.entries:
+            self.pending.remove(stream_id)
+        return len(consumer.pending)
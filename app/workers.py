@@ -0,0 +1,413 @@
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import itertools
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from app import redis_utils
+from .resp_encoder import encode_command, write_bulk_string, write_error
+from .slots import HASH_SLOTS, key_hash_slot
+
+PEER_CONNECT_TIMEOUT = 5
+FORWARD_BATCH_BYTES = 64 * 1024
+FORWARD_READ_SIZE = 64 * 1024
+
+index = 0
+peer_links = threading.local()
+
+
+class CrossWorkerError(Exception):
+    """
+    Raised when the keys of a command belong to more than one worker
+    """
+
+
+def owner_of_slot(slot: int) -> int:
+    """
+    Returns the worker owning a hash slot, every worker owns one contiguous range of slots
+
+    Args:
+        slot (int): The hash slot
+
+    Returns:
+        int: The index of the worker
+    """
+    return slot * redis_utils.workers // HASH_SLOTS
+
+
+def owner_of_keys(keys: List[str]) -> int:
+    """
+    Returns the worker owning some keys
+
+    Args:
+        keys (List[str]): The keys of a command, at least one
+
+    Returns:
+        int: The index of the worker
+
+    Raises:
+        CrossWorkerError: If the keys belong to different workers
+    """
+    owners = {owner_of_slot(key_hash_slot(key)) for key in keys}
+    if len(owners) > 1:
+        raise CrossWorkerError
+    return owners.pop()
+
+
+def owns_key(key: str) -> bool:
+    """
+    Checks whether a key belongs to this worker, always True without --workers
+    """
+    return redis_utils.workers <= 1 or owner_of_slot(key_hash_slot(key)) == index
+
+
+def socket_path(worker: int) -> str:
+    """
+    Returns the path of the Unix socket on which a worker serves the commands forwarded by the other workers
+    """
+    return os.path.join(tempfile.gettempdir(), f"redis-{redis_utils.port}-worker{worker}.sock")
+
+
+def scan_reply(buf: bytes, pos: int, pending: int = 1) -> Tuple[int, int]:
+    """
+    Scans the RESP replies buffered so far without blocking, see ReplyReader. A partial reply is scanned again
+    from where the previous scan stopped once more data came.
+
+    Example:
+        scan_reply(b"*2\r\n:1\r\n$3\r\nfo", 0) -> (8, 1)
+        scan_reply(b"*2\r\n:1\r\n$3\r\nfoo\r\n", 8, 1) -> (17, 0)
+
+    Args:
+        buf (bytes): The buffered data
+        pos (int): The position to scan from
+        pending (int, optional): The number of values still missing to complete the reply. Defaults to 1.
+
+    Returns:
+        Tuple[int, int]: The position the scan reached and the number of values still missing, 0 once the reply
+            is complete and ends at that position
+    """
+    while pending:
+        line_end = buf.find(b"\r\n", pos)
+        if line_end < 0:
+            break
+        kind, size = buf[pos:pos + 1], buf[pos + 1:line_end]
+        end = line_end + 2
+        if kind == b"$" and not size.startswith(b"-"):
+            end += int(size) + 2
+            if end > len(buf):
+                break
+        pending -= 1
+        if kind == b"*" and not size.startswith(b"-"):
+            pending += int(size)
+        pos = end
+    return pos, pending
+
+
+class ReplyReader:
+    """
+    Splits the data read from the connection to a worker into complete RESP replies, nested arrays included,
+    without ever waiting for the end of a reply
+    """
+    __slots__ = ("buf", "pos", "pending")
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.pending = 1
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        Buffers data read from the connection
+
+        Args:
+            data (bytes): The data
+
+        Returns:
+            List[bytes]: The replies completed by the data, as sent
+        """
+        self.buf += data
+        replies = []
+        start = 0
+        while True:
+            self.pos, self.pending = scan_reply(self.buf, self.pos, self.pending)
+            if self.pending:
+                break
+            replies.append(bytes(self.buf[start:self.pos]))
+            start, self.pending = self.pos, 1
+        del self.buf[:start]
+        self.pos -= start
+        return replies
+
+
+class ForwardBatch:
+    """
+    The commands forward sends to one worker and their replies. The connection stays blocking, the commands are
+    sent without waiting (MSG_DONTWAIT) and, while some of them do not fit in the socket buffer, the replies are
+    read as they come, so however large the batch or its replies neither worker waits for the other to read.
+
+    Args:
+        conn (socket.socket): The connection to the worker
+        commands (List[List[str]]): The commands
+    """
+    __slots__ = ("conn", "out_buf", "count", "reader", "replies")
+
+    def __init__(self, conn: socket.socket, commands: List[List[str]]):
+        self.conn = conn
+        self.out_buf = bytearray(b"".join(encode_command(command) for command in commands))
+        self.count = len(commands)
+        self.reader = ReplyReader()
+        self.replies: List[bytes] = []
+
+    def send(self) -> bool:
+        """
+        Sends as much of the commands as the socket accepts without blocking, returns whether they are all sent
+        """
+        try:
+            del self.out_buf[:self.conn.send(self.out_buf, socket.MSG_DONTWAIT)]
+        except BlockingIOError:
+            pass
+        return not self.out_buf
+
+    def read(self, block: bool = True) -> bool:
+        """
+        Reads the replies available, returns whether every reply arrived
+
+        Args:
+            block (bool, optional): Whether to wait for data. Defaults to True.
+
+        Raises:
+            ConnectionError: If the connection closed before the last reply
+        """
+        try:
+            data = self.conn.recv(FORWARD_READ_SIZE, 0 if block else socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        if not data:
+            raise ConnectionError("Worker connection closed")
+        self.replies += self.reader.feed(data)
+        return len(self.replies) == self.count
+
+
+def unreachable_error(worker: int, error: OSError) -> bytes:
+    """
+    Returns the error reply of the commands forwarded to a worker that cannot be reached
+    """
+    return bytes(write_error(bytearray(), f"ERR worker {worker} unreachable: {error}"))
+
+
+def connect_peer(worker: int) -> socket.socket:
+    """
+    Connects to the Unix socket of a worker, retrying while it starts up
+    """
+    deadline = time.monotonic() + PEER_CONNECT_TIMEOUT
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(socket_path(worker))
+            return conn
+        except OSError:
+            conn.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def forward(commands: List[Tuple[int, List[str]]]) -> List[bytes]:
+    """
+    Runs commands on the workers owning their keys and returns their replies in the order of the commands.
+    The commands of each worker are pipelined over one Unix socket connection per worker and per thread, every
+    worker gets its batch before any reply is read, so a batch costs one round trip whatever the number of
+    workers. A batch that does not fit in the socket buffer is sent while its replies are read (see
+    ForwardBatch), so two workers forwarding large batches to each other never wait on one another.
+
+    Example:
+        forward([(2, ["SET", "foo", "bar"]), (0, ["GET", "baz"])]) -> [b'+OK\r\n', b'$-1\r\n']
+
+    Args:
+        commands (List[Tuple[int, List[str]]]): The index of the owning worker and the command, for each command
+
+    Returns:
+        List[bytes]: The raw reply of each command, an error reply for the commands of an unreachable worker
+    """
+    links = getattr(peer_links, "links", None)
+    if links is None:
+        links = peer_links.links = {}
+    batches: Dict[int, List[List[str]]] = {}
+    for worker, command in commands:
+        batches.setdefault(worker, []).append(command)
+    failures: Dict[int, OSError] = {}
+    sent: Dict[int, ForwardBatch] = {}
+    for worker, batch in batches.items():
+        try:
+            if worker not in links:
+                links[worker] = connect_peer(worker)
+            sent[worker] = ForwardBatch(links[worker], batch)
+            sent[worker].send()
+        except OSError as e:
+            failures[worker] = e
+    if any(sent[worker].out_buf for worker in sent if worker not in failures):
+        with selectors.DefaultSelector() as selector:
+            for worker, forward_batch in sent.items():
+                if forward_batch.out_buf and worker not in failures:
+                    selector.register(forward_batch.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, worker)
+            while selector.get_map():
+                for key, mask in selector.select():
+                    worker = key.data
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            sent[worker].read(block=False)
+                        if mask & selectors.EVENT_WRITE and sent[worker].send():
+                            selector.unregister(key.fileobj)
+                    except OSError as e:
+                        failures[worker] = e
+                        selector.unregister(key.fileobj)
+    for worker, forward_batch in sent.items():
+        if worker not in failures:
+            try:
+                while len(forward_batch.replies) < forward_batch.count:
+                    forward_batch.read()
+            except OSError as e:
+                failures[worker] = e
+    replies: Dict[int, Iterator[bytes]] = {}
+    for worker in batches:
+        if worker in failures:
+            if worker in links:
+                links.pop(worker).close()
+            replies[worker] = itertools.repeat(unreachable_error(worker, failures[worker]))
+        else:
+            replies[worker] = iter(sent[worker].replies)
+    return [next(replies[worker]) for worker, _ in commands]
+
+
+def merge_arrays(replies: List[bytes]) -> bytes:
+    """
+    Merges the array replies of a command fanned out to every worker into one array, for KEYS
+
+    Example:
+        merge_arrays([b"*1\r\n$1\r\na\r\n", b"*0\r\n"]) -> b'*1\r\n$1\r\na\r\n'
+
+    Args:
+        replies (List[bytes]): The raw reply of each worker
+
+    Returns:
+        bytes: The merged array, the first error reply if a worker replied with an error
+    """
+    for reply in replies:
+        if reply[:1] == b"-":
+            return reply
+    header_ends = [reply.index(b"\r\n") for reply in replies]
+    count = sum(int(reply[1:end]) for reply, end in zip(replies, header_ends))
+    return b"*%d\r\n" % count + b"".join(reply[end + 2:] for reply, end in zip(replies, header_ends))
+
+
+def merge_info(replies: List[bytes]) -> bytes:
+    """
+    Merges the INFO replies of every worker: the integer fields are added up, so are the fields of the
+    keyspace section, and the other fields (role...) are the ones of this worker. The overhead per key is
+    computed again from the totals.
+
+    Args:
+        replies (List[bytes]): The raw reply of each worker, in the order of the workers
+
+    Returns:
+        bytes: The merged reply, the first error reply if a worker replied with an error
+    """
+    for reply in replies:
+        if reply[:1] == b"-":
+            return reply
+    texts = [reply[reply.index(b"\r\n") + 2:-2].decode() for reply in replies]
+    totals: Dict[str, int] = {}
+    databases: Dict[str, Dict[str, int]] = {}
+    for text in texts:
+        for line in text.split("\r\n"):
+            name, _, value = line.partition(":")
+            if name.startswith("db") and "=" in value:
+                fields = databases.setdefault(name, {})
+                for field in value.split(","):
+                    field_name, _, field_value = field.partition("=")
+                    fields[field_name] = fields.get(field_name, 0) + int(field_value)
+            elif value.isdigit():
+                totals[name] = totals.get(name, 0) + int(value)
+    if "overhead_per_key" in totals:
+        keys = totals.get("keys", 0)
+        totals["overhead_per_key"] = totals.get("used_memory_overhead", 0) // keys if keys else 0
+    lines = []
+    for line in texts[index].split("\r\n"):
+        name, separator, value = line.partition(":")
+        if name.startswith("db") and "=" in value:
+            continue
+        lines.append(f"{name}:{totals[name]}" if separator and name in totals else line)
+        if line == "# Keyspace":
+            lines += [f"{name}:" + ",".join(f"{field}={value}" for field, value in fields.items())
+                      for name, fields in databases.items()]
+    return bytes(write_bulk_string(bytearray(), "\r\n".join(lines)))
+
+
+def start_forward_server(handle_connection: Callable[[socket.socket, str, bool], None]):
+    """
+    Listens on the Unix socket of this worker and serves every peer connection on a thread of its own, like
+    the threaded IO model, so a forwarded command that blocks (XREAD BLOCK) only holds up the peer waiting for it
+
+    Args:
+        handle_connection (Callable[[socket.socket, str, bool], None]): Serves a connection until it closes, told
+            it comes from another worker
+    """
+    path = socket_path(index)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def accept_loop():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle_connection, args=(conn, f"worker:{path}", True), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+
+def run_workers(serve: Callable[[], None], handle_connection: Callable[[socket.socket, str, bool], None]):
+    """
+    Forks --workers processes, each one binding the server port with SO_REUSEPORT so the kernel spreads the
+    client connections among them, and owning a contiguous range of the 16384 hash slots of the keyspace.
+    The parent only supervises: it stops every worker when one of them exits or when it is terminated.
+
+    Args:
+        serve (Callable[[], None]): Runs the server in a worker, never returns
+        handle_connection (Callable[[socket.socket, str, bool], None]): Serves a connection from another worker
+    """
+    global index
+    children = []
+    for worker in range(redis_utils.workers):
+        pid = os.fork()
+        if pid == 0:
+            index = worker
+            try:
+                start_forward_server(handle_connection)
+                serve()
+            finally:
+                os._exit(1)
+        children.append(pid)
+
+    def stop_workers(signum=None, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if signum is not None:
+            sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    print(f"Started {len(children)} workers on port {redis_utils.port}")
+    try:
+        os.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_workers()
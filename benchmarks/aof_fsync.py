@@ -0,0 +1,108 @@
+"""
+AOF fsync policy benchmark
+
+Starts the server once per appendfsync policy (and once without the AOF for reference) with an empty append only
+file, runs concurrent clients each sending SET commands one at a time, and reports the SET throughput together
+with the number of commands covered by each fsync, the group commit of the AOF flusher.
+
+Usage:
+    python -m benchmarks.aof_fsync --clients 8 --seconds 5
+"""
+import argparse
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+POLICIES = ("off", "no", "everysec", "always")
+STARTUP_TIMEOUT = 10
+
+
+def command(*args: str) -> bytes:
+    return b"".join([b"*%d\r\n" % len(args)] + [b"$%d\r\n%s\r\n" % (len(arg), arg.encode()) for arg in args])
+
+
+def wait_for_server(port: int) -> socket.socket:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            return socket.create_connection(("localhost", port))
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_client(port: int, client: int, stop: threading.Event, counts: list):
+    with socket.create_connection(("localhost", port)) as conn:
+        value = "v" * 32
+        done = 0
+        while not stop.is_set():
+            conn.sendall(command("SET", f"key:{client}:{done % 10000}", value))
+            if conn.recv(64) != b"+OK\r\n":
+                raise RuntimeError("unexpected reply to SET")
+            done += 1
+        counts[client] = done
+
+
+def persistence_info(port: int) -> dict:
+    with wait_for_server(port) as conn:
+        conn.sendall(command("INFO", "persistence"))
+        reply = b""
+        while not reply.endswith(b"\r\n\r\n"):
+            reply += conn.recv(65536)
+    return dict(line.split(":", 1) for line in reply.decode().split("\r\n")[1:] if ":" in line)
+
+
+def bench_policy(policy: str, port: int, clients: int, seconds: float, io_model: str) -> str:
+    with tempfile.TemporaryDirectory() as tmp:
+        args = [sys.executable, "-m", "app.main", "--port", str(port), "--io-model", io_model]
+        if policy != "off":
+            args += ["--dir", tmp, "--appendonly", "yes", "--appendfsync", policy]
+        server = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(port).close()
+            stop = threading.Event()
+            counts = [0] * clients
+            threads = [threading.Thread(target=run_client, args=(port, client, stop, counts))
+                       for client in range(clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            info = persistence_info(port)
+        finally:
+            server.terminate()
+            server.wait()
+    total = sum(counts)
+    line = f"{policy:>8}: {total / elapsed:8.0f} SET/s"
+    if policy != "off":
+        fsyncs = int(info["aof_fsyncs"])
+        line += f", {fsyncs} fsyncs"
+        if fsyncs:
+            line += f", {int(info['aof_commands']) / fsyncs:.1f} commands per fsync"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AOF fsync policy benchmark")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument("--seconds", type=float, default=5, help="Duration of each run")
+    parser.add_argument("--port", type=int, default=6399, help="Port of the benchmarked server")
+    parser.add_argument("--io-model", type=str, default="eventloop", choices=["eventloop", "threaded"])
+    parser.add_argument("--policies", type=str, nargs="+", default=POLICIES, choices=POLICIES,
+                        help="The appendfsync policies to run, off runs without the AOF")
+    args = parser.parse_args()
+
+    for policy in args.policies:
+        print(bench_policy(policy, args.port, args.clients, args.seconds, args.io_model), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+RDB load throughput benchmark
+
+Builds a fixture RDB file holding every encoding the loader understands (plain, integer and LZF compressed
+strings, listpack hashes, sets and sorted sets, intsets and quicklist lists) and reports how many MB/s
+the loader decodes and inserts into the keyspace.
+
+Usage:
+    python -m benchmarks.rdb_load --keys 200000
+"""
+import argparse
+import os
+import struct
+import tempfile
+import time
+
+from app import rdb, redis_utils
+
+
+def length(n: int) -> bytes:
+    if n < 1 << 6:
+        return bytes([n])
+    if n < 1 << 14:
+        return bytes([0x40 | (n >> 8), n & 0xFF])
+    return b"\x80" + struct.pack(">I", n)
+
+
+def string(value: bytes) -> bytes:
+    return length(len(value)) + value
+
+
+def int_string(value: int) -> bytes:
+    return b"\xc2" + struct.pack("<i", value)
+
+
+def lzf_compress(data: bytes) -> bytes:
+    """
+    Greedy LZF compressor, good enough to produce the compressed strings of the fixture
+    """
+    out = bytearray()
+    literal = bytearray()
+    table = {}
+    i = 0
+    n = len(data)
+
+    def flush_literal():
+        for start in range(0, len(literal), 32):
+            chunk = literal[start:start + 32]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+        literal.clear()
+
+    while i < n:
+        if i + 2 < n:
+            key = data[i:i + 3]
+            ref = table.get(key)
+            table[key] = i
+            if ref is not None and i - ref - 1 < 8192:
+                match = 3
+                max_match = min(264, n - i)
+                while match < max_match and data[ref + match] == data[i + match]:
+                    match += 1
+                flush_literal()
+                distance = i - ref - 1
+                if match - 2 < 7:
+                    out.append(((match - 2) << 5) | (distance >> 8))
+                else:
+                    out.append((7 << 5) | (distance >> 8))
+                    out.append(match - 2 - 7)
+                out.append(distance & 0xFF)
+                i += match
+                continue
+        literal.append(data[i])
+        i += 1
+    flush_literal()
+    return bytes(out)
+
+
+def lzf_string(value: bytes) -> bytes:
+    compressed = lzf_compress(value)
+    return b"\xc3" + length(len(compressed)) + length(len(value)) + compressed
+
+
+def listpack(elements) -> bytes:
+    entries = bytearray()
+    for element in elements:
+        if len(element) < 64:
+            entry = bytes([0x80 | len(element)]) + element
+        else:
+            entry = bytes([0xE0 | (len(element) >> 8), len(element) & 0xFF]) + element
+        entries += entry + (bytes([len(entry)]) if len(entry) <= 127 else
+                            bytes([len(entry) >> 7, (len(entry) & 127) | 128]))
+    return struct.pack("<IH", 6 + len(entries) + 1, len(elements)) + entries + b"\xff"
+
+
+def intset(members) -> bytes:
+    return struct.pack("<II", 4, len(members)) + b"".join(struct.pack("<i", m) for m in members)
+
+
+def build_fixture(path: str, keys: int):
+    """
+    Writes an RDB file with `keys` keys cycling through the supported encodings
+    """
+    with open(path, "wb") as f:
+        f.write(b"REDIS0011" + b"\xfa" + string(b"redis-ver") + string(b"7.2.0") + b"\xfe\x00")
+        chunk = bytearray()
+        for i in range(keys):
+            key = string(b"key:%d" % i)
+            kind = i % 7
+            if kind == 0:
+                chunk += b"\x00" + key + string(b"value-%d-" % i + b"x" * 32)
+            elif kind == 1:
+                chunk += b"\x00" + key + int_string(i)
+            elif kind == 2:
+                chunk += b"\x00" + key + lzf_string(b"payload-%d-" % i + b"abcdefgh" * 32)
+            elif kind == 3:
+                fields = [b"field-%d" % j if j % 2 == 0 else b"value-%d" % j for j in range(16)]
+                chunk += bytes([rdb.RDB_TYPE_HASH_LISTPACK]) + key + string(listpack(fields))
+            elif kind == 4:
+                chunk += bytes([rdb.RDB_TYPE_SET_INTSET]) + key + string(intset(list(range(i, i + 16))))
+            elif kind == 5:
+                members = [b"member-%d" % j if j % 2 == 0 else b"%d" % j for j in range(16)]
+                chunk += bytes([rdb.RDB_TYPE_ZSET_LISTPACK]) + key + string(listpack(members))
+            else:
+                chunk += (bytes([rdb.RDB_TYPE_LIST_QUICKLIST_2]) + key + length(1) + length(2)
+                          + string(listpack([b"item-%d" % j for j in range(16)])))
+            if len(chunk) > 1 << 20:
+                f.write(chunk)
+                chunk.clear()
+        f.write(chunk + b"\xff" + b"\x00" * 8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RDB load throughput benchmark")
+    parser.add_argument("--keys", type=int, default=200_000, help="Number of keys of the fixture")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "dump.rdb")
+        build_fixture(path, args.keys)
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        redis_utils.dir = tmp
+        redis_utils.dbfilename = "dump.rdb"
+        start = time.perf_counter()
+        loaded = rdb.load_rdb()
+        elapsed = time.perf_counter() - start
+    print(f"{loaded} keys, {size_mb:.1f} MB in {elapsed:.2f} s: {size_mb / elapsed:.1f} MB/s, "
+          f"{loaded / elapsed:.0f} keys/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 10
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class Client:
+    """
+    Minimal blocking RESP client, replies are decoded to bytes, ints, lists, None or RuntimeError for errors
+    """
+
+    def __init__(self, port: int):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                self.conn = socket.create_connection(("localhost", port))
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.reader = self.conn.makefile("rb")
+
+    def __call__(self, *args):
+        self.conn.sendall(b"".join([b"*%d\r\n" % len(args)] +
+                                   [b"$%d\r\n%s\r\n" % (len(str(arg)), str(arg).encode()) for arg in args]))
+        return self.read()
+
+    def read(self):
+        line = self.reader.readline()[:-2]
+        kind, rest = line[:1], line[1:]
+        if kind == b"$":
+            return None if int(rest) < 0 else self.reader.read(int(rest) + 2)[:-2]
+        if kind == b"*":
+            return None if int(rest) < 0 else [self.read() for _ in range(int(rest))]
+        if kind == b":":
+            return int(rest)
+        if kind == b"-":
+            return RuntimeError(rest.decode())
+        return rest.decode()
+
+    def close(self):
+        self.reader.close()
+        self.conn.close()
+
+
+class Server:
+    """
+    Runs the server with an AOF in a temporary directory, restart() stops it and starts it again on the same files
+    """
+
+    def __init__(self, tmp_path, appendfsync: str = "always", io_model: str = "threaded"):
+        self.port = free_port()
+        self.path = tmp_path / "appendonly.aof"
+        self.args = [sys.executable, "-m", "app.main", "--port", str(self.port), "--dir", str(tmp_path),
+                     "--appendonly", "yes", "--appendfsync", appendfsync, "--io-model", io_model]
+        self.process = None
+        self.clients = []
+
+    def start(self) -> Client:
+        self.process = subprocess.Popen(self.args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self.client()
+
+    def client(self) -> Client:
+        client = Client(self.port)
+        self.clients.append(client)
+        return client
+
+    def stop(self):
+        for client in self.clients:
+            client.close()
+        self.clients.clear()
+        self.process.terminate()
+        self.process.wait()
+
+    def restart(self) -> Client:
+        self.stop()
+        return self.start()
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = Server(tmp_path)
+    yield server
+    server.stop()
+
+
+def test_replays_writes(server):
+    client = server.start()
+    assert client("SET", "a", "1") == "OK"
+    assert client("INCR", "n") == 1
+    assert client("INCR", "n") == 2
+    client = server.restart()
+    assert client("GET", "a") == b"1"
+    assert client("GET", "n") == b"2"
+
+
+def test_replays_consumer_group_deliveries(server):
+    client = server.start()
+    client("XADD", "s", "1-0", "f", "v")
+    client("XADD", "s", "2-0", "f", "v")
+    assert client("XGROUP", "CREATE", "s", "g", "0") == "OK"
+    client("XREADGROUP", "GROUP", "g", "alice", "STREAMS", "s", ">")
+    assert client("XACK", "s", "g", "1-0") == 1
+    client = server.restart()
+    assert client("XPENDING", "s", "g") == [1, b"2-0", b"2-0", [[b"alice", b"1"]]]
+
+
+def test_replays_expire_times_as_absolute(server):
+    client = server.start()
+    assert client("SET", "a", "1", "PX", "3000") == "OK"
+    assert client("SET", "b", "1") == "OK"
+    assert client("PEXPIRE", "b", "3000") == 1
+    time.sleep(1)
+    client = server.restart()
+    assert 0 < client("PTTL", "a") <= 2000
+    assert 0 < client("PTTL", "b") <= 2000
+
+
+def test_logs_expired_keys_as_del(server):
+    client = server.start()
+    assert client("SET", "a", "1", "PX", "100") == "OK"
+    time.sleep(0.3)
+    assert client("GET", "a") is None
+    time.sleep(0.1)
+    assert b"$3\r\nDEL\r\n$1\r\na\r\n" in server.path.read_bytes()
+    client = server.restart()
+    assert client("GET", "a") is None
+
+
+def test_logs_transactions_as_one_block(tmp_path):
+    server = Server(tmp_path, appendfsync="no")
+    server.start()
+    done = threading.Event()
+
+    def transactions(client):
+        for _ in range(40):
+            client("MULTI")
+            for i in range(500):
+                client("SET", "{tx}a", i)
+            client("EXEC")
+
+    def writes(client, prefix):
+        i = 0
+        while not done.is_set():
+            client("SET", f"{prefix}{i}", i)
+            i += 1
+
+    threads = [threading.Thread(target=transactions, args=(server.client(),)) for _ in range(2)]
+    writers = [threading.Thread(target=writes, args=(server.client(), f"w{n}:")) for n in range(4)]
+    try:
+        for thread in threads + writers:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        for thread in writers:
+            thread.join()
+        time.sleep(0.2)
+        blocks = server.path.read_bytes().split(b"$5\r\nMULTI\r\n")[1:]
+    finally:
+        server.stop()
+    assert len(blocks) == 80
+    for block in blocks:
+        assert block.split(b"$4\r\nEXEC\r\n")[0].count(b"$3\r\nSET\r\n") == 500
+
+
+def test_truncates_only_an_unterminated_transaction(server):
+    client = server.start()
+    assert client("SET", "a", "1") == "OK"
+    assert client("MULTI") == "OK"
+    assert client("SET", "b", "1") == "QUEUED"
+    assert client("EXEC") == ["OK"]
+    assert client("SET", "c", "1") == "OK"
+    server.stop()
+    size = server.path.stat().st_size
+    with open(server.path, "ab") as aof_file:
+        aof_file.write(b"*1\r\n$5\r\nMULTI\r\n*3\r\n$3\r\nSET\r\n$1\r\nd\r\n$1\r\n1\r\n")
+    client = server.start()
+    assert [client("GET", key) for key in "abcd"] == [b"1", b"1", b"1", None]
+    assert server.path.stat().st_size == size
+    assert client("SET", "e", "1") == "OK"
+    client = server.restart()
+    assert client("GET", "e") == b"1"
@@ -0,0 +1,160 @@
+import struct
+import time
+
+import pytest
+
+from app import redis_utils
+from app.keyspace import Keyspace, now_ms
+from app.rdb import (INTSET_FORMATS, RDB_TYPE_HASH_LISTPACK, RDB_TYPE_SET_INTSET, RdbReader, iter_intset,
+                     iter_listpack, load_rdb, lzf_decompress, read_object, save_rdb)
+from app.stream import STREAM_ID_MAX, STREAM_ID_MIN, ConsumerGroup, RedisStream, pack_stream_id
+
+
+def listpack(*entries: bytes) -> bytes:
+    body = b"".join(entries)
+    return struct.pack("<IH", 6 + len(body) + 1, len(entries)) + body + b"\xff"
+
+
+def intset(size: int, *members: int) -> bytes:
+    return struct.pack(f"<II{len(members)}{INTSET_FORMATS[size]}", size, len(members), *members)
+
+
+def rdb_blob(data: bytes) -> bytes:
+    return bytes((len(data),)) + data
+
+
+def test_lzf_copies_literal_runs():
+    assert lzf_decompress(memoryview(b"\x04hello"), 5) == b"hello"
+
+
+def test_lzf_expands_back_references():
+    assert lzf_decompress(memoryview(b"\x05hello \x60\x05"), 11) == b"hello hello"
+
+
+def test_lzf_expands_overlapping_back_references():
+    assert lzf_decompress(memoryview(b"\x02abc\xe0\x00\x02"), 12) == b"abc" * 4
+
+
+def test_lzf_rejects_a_wrong_length():
+    with pytest.raises(Exception):
+        lzf_decompress(memoryview(b"\x04hello"), 6)
+
+
+def test_lzf_rejects_a_reference_before_the_start():
+    with pytest.raises(Exception):
+        lzf_decompress(memoryview(b"\x00a\x20\x05"), 4)
+
+
+def test_reads_an_lzf_compressed_string():
+    compressed = b"\x02abc\xe0\x00\x02"
+    reader = RdbReader(memoryview(b"\xc3" + bytes((len(compressed), 12)) + compressed))
+    assert reader.read_string() == "abc" * 4
+    assert reader.pos == len(reader)
+
+
+def test_listpack_decodes_every_encoding():
+    data = listpack(
+        b"\x05\x01",
+        b"\x83abc\x04",
+        b"\xdf\xff\x02",
+        b"\xc4\x00\x02",
+        b"\xe0\x46" + b"x" * 70 + b"\x48",
+        b"\xf1\xe8\x03\x03",
+        b"\xf2\x00\x00\x80\x04",
+        b"\xf3\xff\xff\xff\x7f\x05",
+        b"\xf4" + (-(1 << 40)).to_bytes(8, "little", signed=True) + b"\x09",
+    )
+    assert list(iter_listpack(data)) == ["5", "abc", "-1", "1024", "x" * 70, "1000", str(-(1 << 23)),
+                                         str((1 << 31) - 1), str(-(1 << 40))]
+
+
+def test_listpack_decodes_a_32_bit_string_length():
+    value = b"y" * 5000
+    backlen = 5005
+    data = listpack(b"\xf0" + len(value).to_bytes(4, "little") + value + bytes((backlen >> 7, 0x80 | backlen & 127)))
+    assert list(iter_listpack(data)) == ["y" * 5000]
+
+
+def test_listpack_rejects_an_unknown_encoding():
+    with pytest.raises(Exception):
+        list(iter_listpack(listpack(b"\xf5\x01")))
+
+
+@pytest.mark.parametrize("size, members", [
+    (2, [-2, 5, 300]),
+    (4, [-(1 << 20), 0, 1 << 20]),
+    (8, [-(1 << 40), 1 << 40]),
+])
+def test_intset_decodes_every_width(size, members):
+    assert list(iter_intset(intset(size, *members))) == [str(member) for member in members]
+
+
+def test_reads_an_intset_encoded_set():
+    reader = RdbReader(memoryview(rdb_blob(intset(2, 1, 2, 3))))
+    assert read_object(reader, RDB_TYPE_SET_INTSET).members == {"1", "2", "3"}
+
+
+def test_reads_a_listpack_encoded_hash():
+    reader = RdbReader(memoryview(rdb_blob(listpack(b"\x81f\x02", b"\x81v\x02", b"\x82n1\x03", b"\x07\x01"))))
+    assert read_object(reader, RDB_TYPE_HASH_LISTPACK).fields == {"f": "v", "n1": "7"}
+
+
+def round_trip(tmp_path, monkeypatch, keyspace: Keyspace) -> Keyspace:
+    path = tmp_path / "dump.rdb"
+    with open(path, "wb") as out:
+        save_rdb(out, keyspace)
+    monkeypatch.setattr(redis_utils, "keyspace", Keyspace())
+    load_rdb(str(path))
+    return redis_utils.keyspace
+
+
+def test_round_trips_strings_with_their_ttl(tmp_path, monkeypatch):
+    keyspace = Keyspace()
+    keyspace.set("plain", "value")
+    keyspace.set("number", "-42")
+    keyspace.set("big", str(1 << 40))
+    keyspace.set("binary", str(b"\xff\x00", "utf-8", "surrogateescape"))
+    keyspace.set("ttl", "v")
+    keyspace.set_expire("ttl", now_ms() + 60_000)
+    keyspace.set("gone", "v")
+    keyspace.set_expire("gone", now_ms() + 1)
+    time.sleep(0.01)
+    loaded = round_trip(tmp_path, monkeypatch, keyspace)
+    assert loaded.data == {key: value for key, value in keyspace.data.items() if key != "gone"}
+    assert (redis_utils.rdb_last_load_keys_loaded, redis_utils.rdb_last_load_keys_expired) == (5, 1)
+    assert list(loaded.expires) == ["ttl"]
+    assert abs(loaded.get_expire("ttl") - keyspace.get_expire("ttl")) <= 5
+
+
+def test_round_trips_streams_with_their_consumer_groups(tmp_path, monkeypatch):
+    stream = RedisStream()
+    for ms in range(1, 251):
+        fields = ("f", "g") if ms % 7 else ("other",)
+        stream.append(pack_stream_id(ms, ms % 3), fields, tuple(f"{name}{ms}" for name in fields))
+    stream.trim_maxlen(180)
+    group = ConsumerGroup(pack_stream_id(100, 1))
+    alice = group.consumer("alice", 1000)
+    bob = group.consumer("bob", 2000)
+    group.deliver(pack_stream_id(80, 2), alice, 1500)
+    group.deliver(pack_stream_id(90, 0), bob, 2500)
+    group.deliver(pack_stream_id(90, 0), bob, 3000)
+    group.consumer("idle", 4000)
+    stream.groups["g"] = group
+    stream.groups["empty"] = ConsumerGroup(0)
+    keyspace = Keyspace()
+    keyspace.set("s", stream)
+
+    loaded = round_trip(tmp_path, monkeypatch, keyspace).lookup("s")
+    assert loaded.range(STREAM_ID_MIN, STREAM_ID_MAX) == stream.range(STREAM_ID_MIN, STREAM_ID_MAX)
+    assert (len(loaded), loaded.last_id) == (180, pack_stream_id(250, 1))
+    assert list(loaded.groups) == ["g", "empty"]
+    loaded_group = loaded.groups["g"]
+    assert loaded_group.last_id == group.last_id
+    pending = [(stream_id, nack.consumer.name, nack.delivery_time, nack.delivery_count)
+               for stream_id, nack in loaded_group.pending.range(STREAM_ID_MIN, STREAM_ID_MAX)]
+    assert pending == [(pack_stream_id(80, 2), "alice", 1500, 1), (pack_stream_id(90, 0), "bob", 3000, 2)]
+    consumers = {name: (consumer.seen_time, [stream_id for stream_id, _ in consumer.pending.range(0, STREAM_ID_MAX)])
+                 for name, consumer in loaded_group.consumers.items()}
+    assert consumers == {"alice": (1000, [pack_stream_id(80, 2)]), "bob": (2000, [pack_stream_id(90, 0)]),
+                         "idle": (4000, [])}
+    assert loaded.groups["empty"].last_id == 0 and not loaded.groups["empty"].consumers
@@ -0,0 +1,91 @@
+import pytest
+
+from app.resp_parser import MAX_INLINE_SIZE, ProtocolError, RespParser
+
+
+def parse(*chunks: bytes) -> list:
+    parser = RespParser()
+    commands = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        commands.extend(parser.commands())
+    return commands
+
+
+def test_parses_one_command():
+    assert parse(b"*2\r\n$4\r\nECHO\r\n$2\r\nhi\r\n") == [[b"ECHO", b"hi"]]
+
+
+def test_parses_a_command_split_at_every_byte():
+    frame = b"*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nva\r\nl\r\n"
+    assert parse(*[frame[i:i + 1] for i in range(len(frame))]) == [[b"SET", b"key", b"va\r\nl"]]
+
+
+def test_waits_for_the_rest_of_a_split_bulk_string():
+    parser = RespParser()
+    parser.feed(b"*2\r\n$4\r\nECHO\r\n$10\r\n01234")
+    assert list(parser.commands()) == []
+    parser.feed(b"56789")
+    assert list(parser.commands()) == []
+    parser.feed(b"\r\n")
+    assert list(parser.commands()) == [[b"ECHO", b"0123456789"]]
+    assert parser.pending() == 0
+
+
+def test_parses_pipelined_commands_from_one_read():
+    frames = b"*1\r\n$4\r\nPING\r\n" * 3 + b"*2\r\n$3\r\nGET\r\n$1\r\na\r\n"
+    assert parse(frames) == [[b"PING"]] * 3 + [[b"GET", b"a"]]
+
+
+def test_keeps_the_partial_tail_of_a_pipeline():
+    parser = RespParser()
+    parser.feed(b"*1\r\n$4\r\nPING\r\n*2\r\n$4\r\nECHO\r\n$2\r\nhi")
+    assert list(parser.commands()) == [[b"PING"]]
+    parser.feed(b"\r\n")
+    assert list(parser.commands()) == [[b"ECHO", b"hi"]]
+    assert parser.pending() == 0
+
+
+def test_skips_empty_multibulk_requests():
+    assert parse(b"*0\r\n*-1\r\n*1\r\n$4\r\nPING\r\n") == [[b"PING"]]
+
+
+def test_parses_inline_commands():
+    assert parse(b"PING\r\nSET a  1\nGET a\r\n") == [[b"PING"], [b"SET", b"a", b"1"], [b"GET", b"a"]]
+
+
+def test_parses_a_split_inline_command():
+    assert parse(b"SET a", b" 1\r", b"\n") == [[b"SET", b"a", b"1"]]
+
+
+def test_skips_empty_inline_lines():
+    assert parse(b"\r\n\nPING\r\n") == [[b"PING"]]
+
+
+def test_mixes_inline_and_multibulk_commands():
+    assert parse(b"PING\r\n*1\r\n$4\r\nPING\r\nPING\r\n") == [[b"PING"]] * 3
+
+
+@pytest.mark.parametrize("frame", [
+    b"*x\r\n",
+    b"*1\r\n+PING\r\n",
+    b"*1\r\n$x\r\n",
+    b"*1\r\n$-1\r\n",
+])
+def test_rejects_malformed_requests(frame):
+    with pytest.raises(ProtocolError):
+        parse(frame)
+
+
+def test_rejects_an_oversized_inline_request():
+    with pytest.raises(ProtocolError):
+        parse(b"a" * (MAX_INLINE_SIZE + 1))
+
+
+def test_yields_commands_parsed_before_a_protocol_error():
+    parser = RespParser()
+    parser.feed(b"*1\r\n$4\r\nPING\r\n*1\r\n+PING\r\n")
+    commands = parser.commands()
+    assert next(commands) == [b"PING"]
+    with pytest.raises(ProtocolError):
+        next(commands)